@@ -3,23 +3,43 @@
 from . import config  # re-export for convenience
 from . import database
 from . import models
+from . import migrations
 from . import logic
 from . import exceptions
+from . import events
 from . import api
+from . import archive
+from . import purge
+from . import backup
+from . import ratelimit
+from . import shared_index
+from . import tracing
 from . import fastapi_app
+from . import loadtest
+from . import cli
 
 
 def main() -> None:
-    print("Hello from license package!")
+    raise SystemExit(cli.main())
 
 
 __all__ = [
     "config",
     "database",
     "models",
+    "migrations",
     "logic",
     "exceptions",
+    "events",
     "api",
+    "archive",
+    "purge",
+    "backup",
+    "ratelimit",
+    "shared_index",
+    "tracing",
     "main",
     "fastapi_app",
+    "loadtest",
+    "cli",
 ]
@@ -3,12 +3,14 @@
 这些函数都接受一个 SQLAlchemy Session（db）作为第一个参数，方便在 web 框架中把会话注入进来。
 部分函数会在成功时执行 commit/refresh，以便调用者能获得最新状态；出错时会返回带错误信息的 dict。
 """
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
-from . import database, exceptions, logic, models
+from . import archive, database, events, exceptions, logic, models, purge, ratelimit, shared_index, tracing
 
 
 def _iso(dt: Optional[datetime]) -> Optional[str]:
@@ -22,6 +24,9 @@ def _channel_to_dict(ch: models.Channel) -> Dict[str, Any]:
         "max_devices": ch.max_devices,
         "license_duration_days": ch.license_duration_days,
         "description": ch.description,
+        "rate_limit_per_minute": ch.rate_limit_per_minute,
+        "expiry_jitter_seconds": ch.expiry_jitter_seconds,
+        "early_renewal_seconds": ch.early_renewal_seconds,
         "created_at": _iso(ch.created_at),
     }
 
@@ -39,32 +44,91 @@ def _license_to_dict(lic: models.License) -> Dict[str, Any]:
     }
 
 
-def _device_to_dict(dev: models.Device, latest_license: Optional[models.License]) -> Dict[str, Any]:
+def _archived_license_to_dict(lic: models.LicenseArchive) -> Dict[str, Any]:
     return {
-        "id": dev.id,
-        "device_id": dev.device_id_str,
-        "channel": _channel_to_dict(dev.channel) if dev.channel is not None else None,
-        "created_at": _iso(dev.created_at),
-        "latest_license": _license_to_dict(latest_license) if latest_license is not None else None,
+        "id": lic.id,
+        "license_key": lic.license_key,
+        "version": lic.version,
+        "request_ip": lic.request_ip,
+        "status": lic.status,
+        "created_at": _iso(lic.created_at),
+        "expires_at": _iso(lic.expires_at),
+        "device_id": lic.device_id,
+        "archived_at": _iso(lic.archived_at),
     }
 
 
-def get_all_device_licenses(db: Session, include_expired: bool = False) -> Dict[str, Any]:
+LICENSE_FIELDS = ("id", "license_key", "version", "request_ip", "status", "created_at", "expires_at", "device_id")
+
+
+def parse_license_fields(value: Optional[str]) -> Optional[List[str]]:
+    """解析 fields 查询参数（逗号分隔）。
+
+    None 表示返回全部字段；空字符串表示不返回 latest_license。
+    出现未知字段时抛出 ValueError。
+    """
+    if value is None:
+        return None
+    fields = [f.strip() for f in value.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in LICENSE_FIELDS]
+    if unknown:
+        raise ValueError(f"未知的 license 字段: {', '.join(unknown)}")
+    return fields
+
+
+def _device_to_dict(
+    dev: models.Device,
+    latest_license: Optional[models.License],
+    compact: bool = False,
+    license_fields: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    item: Dict[str, Any] = {"id": dev.id, "device_id": dev.device_id_str}
+    if compact:
+        item["channel_id"] = dev.channel_id
+    else:
+        item["channel"] = _channel_to_dict(dev.channel) if dev.channel is not None else None
+    item["created_at"] = _iso(dev.created_at)
+    if license_fields is None:
+        item["latest_license"] = _license_to_dict(latest_license) if latest_license is not None else None
+    elif license_fields:
+        if latest_license is None:
+            item["latest_license"] = None
+        else:
+            full = _license_to_dict(latest_license)
+            item["latest_license"] = {f: full[f] for f in license_fields}
+    return item
+
+
+def get_all_device_licenses(
+    db: Session,
+    include_expired: bool = False,
+    compact: bool = False,
+    license_fields: Optional[List[str]] = None,
+) -> Dict[str, Any]:
     """返回所有设备及其（最新）许可证信息。
 
     Args:
         db: SQLAlchemy Session
         include_expired: 如果为 True，则 latest_license 不过滤过期/非 active；否则使用 logic.find_latest_active_license_for_device
+        compact: 为 True 时设备只带 channel_id，channel 详情放在顶层 channels 映射中（按 id 去重）
+        license_fields: latest_license 只保留这些字段；None 表示全部，空列表表示不返回 latest_license
 
     返回:
-        dict: {"devices": [...]}，每个元素包含 device 信息和 latest_license（或 null）
+        dict: {"devices": [...]}，每个元素包含 device 信息和 latest_license（或 null）；
+        compact 模式下额外包含 {"channels": {"<id>": {...}}}
     """
+    if license_fields is not None:
+        unknown = [f for f in license_fields if f not in LICENSE_FIELDS]
+        if unknown:
+            raise ValueError(f"未知的 license 字段: {', '.join(unknown)}")
+
     devices: List[models.Device] = db.query(models.Device).all()
     result: List[Dict[str, Any]] = []
 
-    now = datetime.now()
     for d in devices:
-        if include_expired:
+        if license_fields is not None and not license_fields:
+            latest = None
+        elif include_expired:
             latest = (
                 db.query(models.License)
                 .filter(models.License.device_id == d.id)
@@ -74,9 +138,32 @@ def get_all_device_licenses(db: Session, include_expired: bool = False) -> Dict[
         else:
             latest = logic.find_latest_active_license_for_device(db, d)
 
-        result.append(_device_to_dict(d, latest))
+        with tracing.span("hydrate"):
+            result.append(_device_to_dict(d, latest, compact=compact, license_fields=license_fields))
+
+    if not compact:
+        return {"devices": result}
+
+    channel_ids = {d.channel_id for d in devices if d.channel_id is not None}
+    channels: Dict[str, Any] = {}
+    if channel_ids:
+        for ch in db.query(models.Channel).filter(models.Channel.id.in_(channel_ids)).all():
+            with tracing.span("hydrate"):
+                channels[str(ch.id)] = _channel_to_dict(ch)
+    return {"devices": result, "channels": channels}
 
-    return {"devices": result}
+
+def _check_renewal_settings(license_duration_days: int, expiry_jitter_seconds: int, early_renewal_seconds: int) -> Optional[str]:
+    """校验渠道的过期抖动和提前续期设置，合法时返回 None，否则返回错误信息。
+
+    提前续期窗口必须小于许可证有效期，否则每次请求都会签发新许可证。
+    """
+    if expiry_jitter_seconds < 0:
+        return "expiry_jitter_seconds must be >= 0"
+    duration_seconds = license_duration_days * 86400
+    if not 0 <= early_renewal_seconds < duration_seconds:
+        return f"early_renewal_seconds must be >= 0 and < license duration ({duration_seconds} seconds)"
+    return None
 
 
 def add_channel(
@@ -85,11 +172,18 @@ def add_channel(
     max_devices: int = 1000,
     license_duration_days: int = 30,
     description: Optional[str] = None,
+    rate_limit_per_minute: Optional[int] = None,
+    expiry_jitter_seconds: int = 0,
+    early_renewal_seconds: int = 0,
 ) -> Dict[str, Any]:
     """添加一个新的 Channel。
 
-    在成功时会 commit 并返回新 channel 的字典表示；如果 name 已存在则返回错误信息。
+    在成功时会 commit 并返回新 channel 的字典表示；如果 name 已存在或续期设置不合法则返回错误信息。
     """
+    error = _check_renewal_settings(license_duration_days, expiry_jitter_seconds, early_renewal_seconds)
+    if error is not None:
+        return {"success": False, "message": error}
+
     existing = db.query(models.Channel).filter(models.Channel.name == name).one_or_none()
     if existing is not None:
         return {"success": False, "message": f"channel already exists: {name}"}
@@ -99,10 +193,17 @@ def add_channel(
         max_devices=max_devices,
         license_duration_days=license_duration_days,
         description=description,
+        rate_limit_per_minute=rate_limit_per_minute,
+        expiry_jitter_seconds=expiry_jitter_seconds,
+        early_renewal_seconds=early_renewal_seconds,
     )
     db.add(ch)
+    db.flush()
+    logic.record_change(db, "channel", ch.id)
+    events.queue_event(db, "channel-changed", {"op": "created", "channel": _channel_to_dict(ch)})
     db.commit()
     db.refresh(ch)
+    ratelimit.limiter.set_channel_limit(ch.name, ch.rate_limit_per_minute, ch.id)
     return {"success": True, "channel": _channel_to_dict(ch)}
 
 
@@ -123,12 +224,16 @@ def delete_channel(db: Session, channel_id: Optional[int] = None, channel_name:
     if ch is None:
         return {"success": False, "message": "channel not found"}
 
-    device_count = db.query(models.Device).filter(models.Device.channel_id == ch.id).count()
+    # 分片模式下设备不在主库中，需要对所有分片计数
+    device_count = logic.count_devices_in_channel(db, ch.id)
     if device_count > 0:
         return {"success": False, "message": "channel has devices and cannot be deleted"}
 
+    logic.record_change(db, "channel", ch.id, "delete")
+    events.queue_event(db, "channel-changed", {"op": "deleted", "channel": _channel_to_dict(ch)})
     db.delete(ch)
     db.commit()
+    ratelimit.limiter.set_channel_limit(ch.name, None, ch.id)
     return {"success": True}
 
 
@@ -141,10 +246,13 @@ def edit_channel(
     max_devices: Optional[int] = None,
     license_duration_days: Optional[int] = None,
     description: Optional[str] = None,
+    rate_limit_per_minute: Optional[int] = None,
+    expiry_jitter_seconds: Optional[int] = None,
+    early_renewal_seconds: Optional[int] = None,
 ) -> Dict[str, Any]:
     """编辑 channel 的字段。接受 channel_id 或 channel_name 定位 channel。
 
-    成功时 commit 并返回更新后的 channel。
+    成功时 commit 并返回更新后的 channel；修改后的续期设置不合法时返回错误信息，不做任何修改。
     """
     q = db.query(models.Channel)
     if channel_id is not None:
@@ -157,6 +265,17 @@ def edit_channel(
     if ch is None:
         return {"success": False, "message": "channel not found"}
 
+    # 按修改后的最终值校验，只改有效期时也不能让已有的续期窗口超过有效期
+    error = _check_renewal_settings(
+        license_duration_days if license_duration_days is not None else ch.license_duration_days,
+        expiry_jitter_seconds if expiry_jitter_seconds is not None else ch.expiry_jitter_seconds or 0,
+        early_renewal_seconds if early_renewal_seconds is not None else ch.early_renewal_seconds or 0,
+    )
+    if error is not None:
+        return {"success": False, "message": error}
+
+    old_name = ch.name
+    old_early_renewal_seconds = ch.early_renewal_seconds or 0
     if name is not None:
         ch.name = name
     if max_devices is not None:
@@ -165,31 +284,79 @@ def edit_channel(
         ch.license_duration_days = license_duration_days
     if description is not None:
         ch.description = description
-
+    if rate_limit_per_minute is not None:
+        # 传入负数表示清除渠道限额，恢复默认值
+        ch.rate_limit_per_minute = rate_limit_per_minute if rate_limit_per_minute >= 0 else None
+    if expiry_jitter_seconds is not None:
+        ch.expiry_jitter_seconds = expiry_jitter_seconds
+    if early_renewal_seconds is not None:
+        ch.early_renewal_seconds = early_renewal_seconds
+
+    logic.record_change(db, "channel", ch.id)
+    events.queue_event(
+        db,
+        "channel-changed",
+        {"op": "updated", "channel": _channel_to_dict(ch), "old_early_renewal_seconds": old_early_renewal_seconds},
+    )
     db.commit()
     db.refresh(ch)
+    ratelimit.limiter.set_channel_limit(old_name, None)
+    ratelimit.limiter.set_channel_limit(ch.name, ch.rate_limit_per_minute, ch.id)
     return {"success": True, "channel": _channel_to_dict(ch)}
 
 
-def edit_license_status(db: Session, license_id: int, new_status: str) -> Dict[str, Any]:
+def edit_license_status(
+    db: Session, license_id: int, new_status: str, device_id_str: Optional[str] = None
+) -> Dict[str, Any]:
     """修改指定 license 的状态（例如 'active', 'revoked', 'expired' 等）。
 
+    给出 device_id_str 时只修改属于该设备的 license（分片模式下 license id 只在分片内唯一）。
     成功时 commit 并返回更新后的 license 字典。
     """
-    lic = db.query(models.License).filter(models.License.id == license_id).one_or_none()
+    q = db.query(models.License).filter(models.License.id == license_id)
+    if device_id_str is not None:
+        q = q.join(models.Device, models.License.device_id == models.Device.id).filter(
+            models.Device.device_id_str == device_id_str
+        )
+    lic = q.one_or_none()
     if lic is None:
         return {"success": False, "message": "license not found"}
 
+    old_status = lic.status
     lic.status = new_status
+    logic.record_change(db, "license", lic.id)
+    events.queue_event(
+        db,
+        "status-changed",
+        {**logic.license_event_data(lic.device, lic), "old_status": old_status},
+    )
     db.commit()
     db.refresh(lic)
     return {"success": True, "license": _license_to_dict(lic)}
 
 
 # 便捷的带会话管理的封装：如果应用希望直接调用而无需手动管理 session，可用这些函数
-def get_all_device_licenses_with_session(include_expired: bool = False) -> Dict[str, Any]:
-    with database.get_db_session() as db:
-        return get_all_device_licenses(db, include_expired=include_expired)
+def get_all_device_licenses_with_session(
+    include_expired: bool = False, compact: bool = False, license_fields: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """同 get_all_device_licenses；分片模式下对所有分片扇出查询并合并，每个设备额外带有 shard 字段。"""
+    kwargs = dict(include_expired=include_expired, compact=compact, license_fields=license_fields)
+    if not database.is_sharded():
+        with database.get_db_session() as db:
+            return get_all_device_licenses(db, **kwargs)
+
+    devices: List[Dict[str, Any]] = []
+    channels: Dict[str, Any] = {}
+    for db in database.iter_device_sessions():
+        shard = db.info["shard"]
+        part = get_all_device_licenses(db, **kwargs)
+        for d in part["devices"]:
+            d["shard"] = shard
+            devices.append(d)
+        channels.update(part.get("channels", {}))
+    if compact:
+        return {"devices": devices, "channels": channels}
+    return {"devices": devices}
 
 
 def add_channel_with_session(
@@ -228,18 +395,477 @@ def delete_device(db: Session, device_id: Optional[int] = None, device_id_str: O
         return {"success": False, "message": "device not found"}
 
     license_count = db.query(models.License).filter(models.License.device_id == dev.id).count()
+    license_count += db.query(models.LicenseArchive).filter(models.LicenseArchive.device_id == dev.id).count()
+    last_license_id = (
+        db.query(func.max(models.License.id)).filter(models.License.device_id == dev.id).scalar()
+    )
     if license_count > 0 and not force:
         return {"success": False, "message": "device has licenses and cannot be deleted (use force=true to remove licenses)"}
 
     if license_count > 0 and force:
-        # delete licenses first
+        # delete licenses first (including archived history)
+        for (lic_id,) in db.query(models.License.id).filter(models.License.device_id == dev.id).all():
+            logic.record_change(db, "license", lic_id, "delete")
         db.query(models.License).filter(models.License.device_id == dev.id).delete(synchronize_session=False)
+        db.query(models.LicenseArchive).filter(models.LicenseArchive.device_id == dev.id).delete(synchronize_session=False)
 
+    logic.record_change(db, "device", dev.id, "delete")
+    events.queue_event(
+        db,
+        "device-deleted",
+        {"device_id": dev.device_id_str, "channel_id": dev.channel_id, "last_license_id": last_license_id},
+    )
     db.delete(dev)
     db.commit()
     return {"success": True}
 
 
+def edit_license_status_with_session(
+    license_id: int, new_status: str, device_id_str: Optional[str] = None
+) -> Dict[str, Any]:
+    """同 edit_license_status；分片模式下按 device_id_str 路由到所属分片。"""
+    if not database.is_sharded():
+        with database.get_db_session() as db:
+            return edit_license_status(db, license_id, new_status, device_id_str)
+
+    if device_id_str is None:
+        return {"success": False, "message": "device_id_str required in sharded mode"}
+    with database.session_for_device(device_id_str) as db:
+        return edit_license_status(db, license_id, new_status, device_id_str)
+
+
 def delete_device_with_session(device_id: Optional[int] = None, device_id_str: Optional[str] = None, force: bool = False) -> Dict[str, Any]:
+    """同 delete_device；分片模式下按 device_id_str 路由到所属分片（各分片的 device_id 不唯一）。"""
+    if not database.is_sharded():
+        with database.get_db_session() as db:
+            return delete_device(db, device_id=device_id, device_id_str=device_id_str, force=force)
+
+    if device_id_str is None:
+        return {"success": False, "message": "device_id_str required in sharded mode"}
+    with database.session_for_device(device_id_str) as db:
+        return delete_device(db, device_id_str=device_id_str, force=force)
+
+
+def get_device_license_history(
+    db: Session,
+    device_id: Optional[int] = None,
+    device_id_str: Optional[str] = None,
+    include_archived: bool = False,
+) -> Dict[str, Any]:
+    """返回指定设备的全部许可证（按 expires_at 降序）。
+
+    默认只读 licenses 热表；include_archived=True 时再按需查询 licenses_archive。
+    """
+    q = db.query(models.Device)
+    if device_id is not None:
+        dev = q.filter(models.Device.id == device_id).one_or_none()
+    elif device_id_str is not None:
+        dev = q.filter(models.Device.device_id_str == device_id_str).one_or_none()
+    else:
+        return {"success": False, "message": "device_id or device_id_str required"}
+
+    if dev is None:
+        return {"success": False, "message": "device not found"}
+
+    licenses = (
+        db.query(models.License)
+        .filter(models.License.device_id == dev.id)
+        .order_by(models.License.expires_at.desc())
+        .all()
+    )
+    res: Dict[str, Any] = {
+        "success": True,
+        "device_id": dev.device_id_str,
+        "licenses": [_license_to_dict(lic) for lic in licenses],
+    }
+    if include_archived:
+        archived = (
+            db.query(models.LicenseArchive)
+            .filter(models.LicenseArchive.device_id == dev.id)
+            .order_by(models.LicenseArchive.expires_at.desc())
+            .all()
+        )
+        res["archived_licenses"] = [_archived_license_to_dict(lic) for lic in archived]
+    return res
+
+
+def get_device_license_history_with_session(
+    device_id: Optional[int] = None,
+    device_id_str: Optional[str] = None,
+    include_archived: bool = False,
+) -> Dict[str, Any]:
+    """同 get_device_license_history；分片模式下按 device_id_str 路由到设备所属分片。
+
+    分片模式下设备主键只在分片内唯一，必须给出 device_id_str。
+    """
+    if not database.is_sharded():
+        with database.get_read_db_session() as db:
+            return get_device_license_history(db, device_id, device_id_str, include_archived)
+    if device_id_str is None:
+        return {"success": False, "message": "device_id_str required in sharded mode"}
+    with database.session_for_device(device_id_str) as db:
+        return get_device_license_history(db, device_id_str=device_id_str, include_archived=include_archived)
+
+
+def archive_licenses(
+    db: Session,
+    retention_days: int = archive.DEFAULT_RETENTION_DAYS,
+    batch_size: int = archive.DEFAULT_BATCH_SIZE,
+) -> Dict[str, Any]:
+    """执行一次许可证归档任务（见 archive.archive_licenses）。"""
+    if retention_days < 0 or batch_size <= 0:
+        return {"success": False, "message": "retention_days must be >= 0 and batch_size > 0"}
+    res = archive.archive_licenses(db, retention_days=retention_days, batch_size=batch_size)
+    return {"success": True, **res}
+
+
+def archive_licenses_with_session(
+    retention_days: int = archive.DEFAULT_RETENTION_DAYS,
+    batch_size: int = archive.DEFAULT_BATCH_SIZE,
+) -> Dict[str, Any]:
+    """同 archive_licenses；分片模式下逐个分片归档并合并统计。"""
+    if retention_days < 0 or batch_size <= 0:
+        return {"success": False, "message": "retention_days must be >= 0 and batch_size > 0"}
+    totals: Dict[str, Any] = {"archived": 0, "batches": 0}
+    for db in database.iter_device_sessions():
+        res = archive.archive_licenses(db, retention_days=retention_days, batch_size=batch_size)
+        totals["archived"] += res["archived"]
+        totals["batches"] += res["batches"]
+        totals["cutoff"] = res["cutoff"]
+    return {"success": True, **totals}
+
+
+def _resolve_purge_channel(
+    db: Session, channel_id: Optional[int], channel_name: Optional[str]
+) -> Optional[models.Channel]:
+    q = db.query(models.Channel)
+    if channel_id is not None:
+        return q.filter(models.Channel.id == channel_id).one_or_none()
+    return q.filter(models.Channel.name == channel_name).one_or_none()
+
+
+def _purge_report(db: Session, totals: Dict[str, Any], freed: Dict[int, int], dry_run: bool) -> Dict[str, Any]:
+    """把各渠道释放的配额整理成列表；device_count 为清理后（dry_run 时为预计）的设备数。"""
+    channels: List[Dict[str, Any]] = []
+    for ch_id in sorted(freed):
+        ch = db.get(models.Channel, ch_id)
+        count = logic.count_devices_in_channel(db, ch_id)
+        if dry_run:
+            count -= freed[ch_id]
+        channels.append(
+            {
+                "channel_id": ch_id,
+                "name": ch.name if ch is not None else None,
+                "max_devices": ch.max_devices if ch is not None else None,
+                "freed": freed[ch_id],
+                "device_count": count,
+            }
+        )
+    return {"success": True, "dry_run": dry_run, **totals, "channels": channels}
+
+
+def purge_stale_devices(
+    db: Session,
+    channel_id: Optional[int] = None,
+    channel_name: Optional[str] = None,
+    stale_days: int = purge.DEFAULT_STALE_DAYS,
+    batch_size: int = purge.DEFAULT_BATCH_SIZE,
+    dry_run: bool = False,
+) -> Dict[str, Any]:
+    """清理超过 stale_days 天没有有效许可证的设备（见 purge.purge_stale_devices）。
+
+    channel_id / channel_name 都为空时清理所有渠道。
+    返回 {"success": True, "dry_run", "devices", "licenses", "batches", "cutoff",
+    "channels": [{"channel_id", "name", "max_devices", "freed", "device_count"}]}。
+    """
+    if stale_days <= 0 or batch_size <= 0:
+        return {"success": False, "message": "stale_days and batch_size must be > 0"}
+    if channel_id is not None or channel_name is not None:
+        ch = _resolve_purge_channel(db, channel_id, channel_name)
+        if ch is None:
+            return {"success": False, "message": "channel not found"}
+        channel_id = ch.id
+
+    res = purge.purge_stale_devices(db, channel_id=channel_id, stale_days=stale_days, batch_size=batch_size, dry_run=dry_run)
+    freed = res.pop("freed")
+    return _purge_report(db, res, freed, dry_run)
+
+
+def purge_stale_devices_with_session(
+    channel_id: Optional[int] = None,
+    channel_name: Optional[str] = None,
+    stale_days: int = purge.DEFAULT_STALE_DAYS,
+    batch_size: int = purge.DEFAULT_BATCH_SIZE,
+    dry_run: bool = False,
+) -> Dict[str, Any]:
+    """同 purge_stale_devices；分片模式下逐个分片清理并合并统计。"""
+    if not database.is_sharded():
+        with database.get_db_session() as db:
+            return purge_stale_devices(db, channel_id, channel_name, stale_days, batch_size, dry_run)
+
+    if stale_days <= 0 or batch_size <= 0:
+        return {"success": False, "message": "stale_days and batch_size must be > 0"}
     with database.get_db_session() as db:
-        return delete_device(db, device_id=device_id, device_id_str=device_id_str, force=force)
+        if channel_id is not None or channel_name is not None:
+            ch = _resolve_purge_channel(db, channel_id, channel_name)
+            if ch is None:
+                return {"success": False, "message": "channel not found"}
+            channel_id = ch.id
+
+        totals: Dict[str, Any] = {"devices": 0, "licenses": 0, "batches": 0}
+        freed: Dict[int, int] = {}
+        for shard_db in database.iter_device_sessions():
+            res = purge.purge_stale_devices(
+                shard_db, channel_id=channel_id, stale_days=stale_days, batch_size=batch_size, dry_run=dry_run
+            )
+            for k in ("devices", "licenses", "batches"):
+                totals[k] += res[k]
+            totals["cutoff"] = res["cutoff"]
+            for ch_id, n in res["freed"].items():
+                freed[ch_id] = freed.get(ch_id, 0) + n
+        return _purge_report(db, totals, freed, dry_run)
+
+
+# 单条 IN 查询最多携带的 key 数（低于 SQLite 的绑定变量上限）
+LOOKUP_CHUNK_SIZE = 5000
+MAX_LOOKUP_KEYS = 20000
+
+
+def lookup_licenses_by_keys(db: Session, keys: List[str]) -> Dict[str, Any]:
+    """按 license key 批量反查许可证。
+
+    先在 licenses 热表上按 license_key_hash 索引做 IN 查询，未命中的再查 licenses_archive。
+    key 不保证唯一，多条许可证使用同一 key 时返回 id 最大（最新）的一条。
+    返回 {"licenses": {key: license 或 null}, "found": n, "missing": n}；
+    归档中的许可证带有 archived_at 字段。
+    """
+    if len(keys) > MAX_LOOKUP_KEYS:
+        return {"success": False, "message": f"too many keys (max {MAX_LOOKUP_KEYS})"}
+
+    by_hash: Dict[str, str] = {logic.hash_license_key(k): k for k in keys}
+    found: Dict[str, Dict[str, Any]] = {}
+    hashes = list(by_hash)
+    for i in range(0, len(hashes), LOOKUP_CHUNK_SIZE):
+        # 结果按 id 升序，后出现的（更新的）许可证覆盖之前的
+        for lic in logic.find_licenses_by_key_hashes(db, hashes[i:i + LOOKUP_CHUNK_SIZE]):
+            # 防御哈希碰撞：以原始 key 再确认一次
+            if lic.license_key == by_hash[lic.license_key_hash]:
+                found[lic.license_key] = _license_to_dict(lic)
+
+    missing_hashes = [h for h, k in by_hash.items() if k not in found]
+    for i in range(0, len(missing_hashes), LOOKUP_CHUNK_SIZE):
+        archived = (
+            db.query(models.LicenseArchive)
+            .filter(models.LicenseArchive.license_key_hash.in_(missing_hashes[i:i + LOOKUP_CHUNK_SIZE]))
+            .order_by(models.LicenseArchive.id.desc())
+            .all()
+        )
+        for lic in archived:
+            if lic.license_key == by_hash[lic.license_key_hash] and lic.license_key not in found:
+                found[lic.license_key] = _archived_license_to_dict(lic)
+
+    return {
+        "success": True,
+        "licenses": {k: found.get(k) for k in by_hash.values()},
+        "found": len(found),
+        "missing": len(by_hash) - len(found),
+    }
+
+
+def _newer_license(a: Optional[Dict[str, Any]], b: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """合并不同分片的查询结果：热表优先于归档，其次取创建时间较新的一条（id 只在分片内可比）。"""
+    if a is None or b is None:
+        return a if b is None else b
+    rank_a = ("archived_at" not in a, a["created_at"] or "")
+    rank_b = ("archived_at" not in b, b["created_at"] or "")
+    return b if rank_b > rank_a else a
+
+
+def lookup_licenses_by_keys_with_session(keys: List[str]) -> Dict[str, Any]:
+    """同 lookup_licenses_by_keys；分片模式下在每个分片上查询并合并。"""
+    if not database.is_sharded():
+        with database.get_read_db_session() as db:
+            return lookup_licenses_by_keys(db, keys)
+    if len(keys) > MAX_LOOKUP_KEYS:
+        return {"success": False, "message": f"too many keys (max {MAX_LOOKUP_KEYS})"}
+
+    merged: Dict[str, Optional[Dict[str, Any]]] = {k: None for k in keys}
+    for db in database.iter_device_sessions():
+        for k, lic in lookup_licenses_by_keys(db, keys)["licenses"].items():
+            merged[k] = _newer_license(merged[k], lic)
+    found = sum(1 for lic in merged.values() if lic is not None)
+    return {"success": True, "licenses": merged, "found": found, "missing": len(merged) - found}
+
+
+def get_license_by_key(db: Session, key: str) -> Dict[str, Any]:
+    """按单个 license key 查找许可证。"""
+    res = lookup_licenses_by_keys(db, [key])
+    return _single_license_result(res["licenses"][key])
+
+
+def get_license_by_key_with_session(key: str) -> Dict[str, Any]:
+    """同 get_license_by_key；分片模式下在每个分片上查找。"""
+    res = lookup_licenses_by_keys_with_session([key])
+    return _single_license_result(res["licenses"][key])
+
+
+def _single_license_result(lic: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if lic is None:
+        return {"success": False, "message": "license not found"}
+    return {"success": True, "license": lic}
+
+
+def _device_summary_to_dict(dev: models.Device) -> Dict[str, Any]:
+    return {
+        "id": dev.id,
+        "device_id": dev.device_id_str,
+        "channel_id": dev.channel_id,
+        "created_at": _iso(dev.created_at),
+    }
+
+
+MAX_CHANGES_LIMIT = 10000
+
+_CHANGE_ENTITIES = {
+    "channel": ("channels", models.Channel, _channel_to_dict),
+    "device": ("devices", models.Device, _device_summary_to_dict),
+    "license": ("licenses", models.License, _license_to_dict),
+}
+
+
+def get_changes(db: Session, since: int = 0, limit: int = 1000) -> Dict[str, Any]:
+    """返回游标 since 之后发生变化的 channel/device/license。
+
+    同一实体在本页内多次变化只返回一次（当前状态）；已删除的实体只返回 id。
+    返回:
+        dict: {"channels": [...], "devices": [...], "licenses": [...],
+               "deleted": {"channels": [id], "devices": [id], "licenses": [id]},
+               "next_cursor": int, "has_more": bool}
+        调用方把 next_cursor 作为下一次的 since 即可。
+    """
+    if limit <= 0 or limit > MAX_CHANGES_LIMIT:
+        return {"success": False, "message": f"limit must be between 1 and {MAX_CHANGES_LIMIT}"}
+
+    rows = (
+        db.query(models.ChangeLog)
+        .filter(models.ChangeLog.id > since)
+        .order_by(models.ChangeLog.id.asc())
+        .limit(limit)
+        .all()
+    )
+
+    # 每个实体以本页内最后一次变更为准
+    last_op: Dict[str, Dict[int, str]] = {t: {} for t in _CHANGE_ENTITIES}
+    for row in rows:
+        if row.entity_type in last_op:
+            last_op[row.entity_type][row.entity_id] = row.op
+
+    res: Dict[str, Any] = {"success": True, "deleted": {}}
+    for entity_type, (key, model, to_dict) in _CHANGE_ENTITIES.items():
+        upserted = [i for i, op in last_op[entity_type].items() if op != "delete"]
+        deleted = [i for i, op in last_op[entity_type].items() if op == "delete"]
+        current = db.query(model).filter(model.id.in_(upserted)).all() if upserted else []
+        found = {obj.id for obj in current}
+        # 本页之后才被删除或已归档的实体不再存在于热表中，视为删除
+        deleted.extend(i for i in upserted if i not in found)
+        res[key] = [to_dict(obj) for obj in sorted(current, key=lambda o: o.id)]
+        res["deleted"][key] = sorted(deleted)
+
+    res["next_cursor"] = rows[-1].id if rows else since
+    res["has_more"] = len(rows) == limit
+    return res
+
+
+def _parse_shard_cursor(since: str, shard_count: int) -> Optional[Dict[str, int]]:
+    """解析分片模式的变更游标 "main:<id>,0:<id>,1:<id>,..."；"0" 或空串表示从头开始。"""
+    cursors = {"main": 0, **{str(i): 0 for i in range(shard_count)}}
+    if since in ("", "0"):
+        return cursors
+    for part in since.split(","):
+        name, sep, value = part.partition(":")
+        if not sep or name not in cursors or not value.isdigit():
+            return None
+        cursors[name] = int(value)
+    return cursors
+
+
+def get_changes_with_session(since: str = "0", limit: int = 1000) -> Dict[str, Any]:
+    """同 get_changes，自行管理会话。
+
+    非分片模式下 since / next_cursor 为整数（字符串形式的 since 也接受）。
+    分片模式下每个文件各有自己的 change_log，游标为 "main:<id>,0:<id>,1:<id>,..."，limit 按每个文件计；
+    设备和许可证的 id 只在分片内唯一，因此返回的 device/license 带有 "shard" 字段，
+    deleted 中的设备和许可证为 {"shard": i, "id": id}。
+    """
+    if not database.is_sharded():
+        try:
+            since_id = int(since)
+        except ValueError:
+            return {"success": False, "message": "invalid cursor"}
+        with database.get_read_db_session() as db:
+            return get_changes(db, since=since_id, limit=limit)
+
+    cursors = _parse_shard_cursor(since, len(database.ShardSessionLocals))
+    if cursors is None:
+        return {"success": False, "message": "invalid cursor"}
+    with database.get_read_db_session() as db:
+        res = get_changes(db, since=cursors["main"], limit=limit)
+    if not res["success"]:
+        return res
+    cursors["main"] = res["next_cursor"]
+    for i in range(len(database.ShardSessionLocals)):
+        with database.get_shard_session(i) as db:
+            part = get_changes(db, since=cursors[str(i)], limit=limit)
+        for key in ("devices", "licenses"):
+            res[key].extend({**item, "shard": i} for item in part[key])
+            res["deleted"][key].extend({"shard": i, "id": item_id} for item_id in part["deleted"][key])
+        cursors[str(i)] = part["next_cursor"]
+        res["has_more"] = res["has_more"] or part["has_more"]
+    res["next_cursor"] = ",".join(f"{name}:{value}" for name, value in cursors.items())
+    return res
+
+
+# 经由写入串行器申请许可证时等待结果的最长时间（秒）
+WRITE_QUEUE_TIMEOUT = 10.0
+
+
+def request_license(
+    device_id_str: str,
+    channel_name: str,
+    request_ip: str,
+    generate_key_fn: Callable[[str, datetime], str] = logic.generate_license_key,
+) -> Dict[str, Any]:
+    """设备申请许可证（自行管理会话，分片模式下路由到设备所属分片）。
+
+    若已启动写入串行器，则通过组提交写入；否则直接在独立会话中处理并 commit。
+    generate_key_fn 可传入 logic.SigningService 实例，把签名卸载到进程池。
+    ChannelNotFound / DeviceLimitExceeded / SigningUnavailable 原样抛出。
+    写入串行器在 WRITE_QUEUE_TIMEOUT 内没有完成时抛出 WriteQueueTimeout：尚未开始执行的请求会被取消，
+    已在执行中的请求结果未知（可能稍后 commit，客户端重试时会复用该许可证）。
+    启用了共享索引（shared_index）时，可复用的重复设备请求直接由索引答复，不访问数据库。
+    """
+    index = shared_index.index
+    if index is not None:
+        with tracing.span("index"):
+            entry = index.reusable(device_id_str)
+        if entry is not None:
+            events.bus.publish("license-reused", entry.event_data(device_id_str))
+            return {"success": True, "license": entry.license_dict()}
+
+    if database.get_write_queue(device_id_str) is not None:
+        fut = logic.submit_license_request(device_id_str, channel_name, request_ip, generate_key_fn)
+        try:
+            ids = fut.result(WRITE_QUEUE_TIMEOUT)
+        except FuturesTimeoutError:
+            if fut.cancel():
+                raise exceptions.WriteQueueTimeout("write queue timed out; request was not processed", cancelled=True)
+            raise exceptions.WriteQueueTimeout("write queue timed out; outcome unknown", cancelled=False)
+        with database.session_for_device(device_id_str) as db:
+            lic = db.get(models.License, ids["license_id"])
+            return {"success": True, "license": _license_to_dict(lic)}
+
+    with database.session_for_device(device_id_str) as db:
+        lic = logic.process_license_request(db, device_id_str, channel_name, request_ip, generate_key_fn)
+        db.commit()
+        db.refresh(lic)
+        return {"success": True, "license": _license_to_dict(lic)}
@@ -0,0 +1,104 @@
+"""许可证历史归档：把已被取代或早已过期的许可证从 licenses 表迁移到 licenses_archive 表。
+
+每次续期都会新增一条 License，旧记录只增不减；归档任务按批次迁移这些历史记录，
+让热路径上的 licenses 表保持在“每台设备少量记录”的规模。
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import DateTime, and_, exists, insert, literal, or_, select
+from sqlalchemy.orm import Session, aliased
+
+from . import models
+
+DEFAULT_RETENTION_DAYS = 90
+DEFAULT_BATCH_SIZE = 1000
+
+_ARCHIVE_COLUMNS = (
+    "id",
+    "license_key",
+    "license_key_hash",
+    "version",
+    "request_ip",
+    "status",
+    "created_at",
+    "expires_at",
+    "device_id",
+)
+
+
+def _archivable_ids_query(cutoff: datetime, limit: int):
+    """选出可归档的 license id。
+
+    条件：不是该设备最新的一条（按 expires_at、id 排序），并且
+    已过期超过保留期，或已非 active 且创建时间早于保留期。
+    每台设备最新的许可证始终保留在热表中，include_expired 列表不受影响。
+    """
+    lic = models.License
+    newer = aliased(models.License)
+    superseded = exists().where(
+        and_(
+            newer.device_id == lic.device_id,
+            or_(
+                newer.expires_at > lic.expires_at,
+                and_(newer.expires_at == lic.expires_at, newer.id > lic.id),
+            ),
+        )
+    )
+    return (
+        select(lic.id)
+        .where(superseded)
+        .where(
+            or_(
+                lic.expires_at < cutoff,
+                and_(lic.status != "active", lic.created_at < cutoff),
+            )
+        )
+        .order_by(lic.id)
+        .limit(limit)
+    )
+
+
+def archive_licenses(
+    db: Session,
+    retention_days: int = DEFAULT_RETENTION_DAYS,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_batches: Optional[int] = None,
+    now: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    """按批迁移历史许可证到 licenses_archive，每批一个事务。
+
+    Args:
+        db: SQLAlchemy Session
+        retention_days: 保留窗口（天），只归档早于该窗口的记录
+        batch_size: 每批迁移的最大行数，控制单个写事务的持锁时间
+        max_batches: 本次最多执行的批数，None 表示直到没有可归档记录
+
+    返回:
+        dict: {"archived": 迁移总行数, "batches": 提交的批次数, "cutoff": ISO 时间}
+    """
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=retention_days)
+    archived = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        ids: List[int] = list(db.execute(_archivable_ids_query(cutoff, batch_size)).scalars())
+        if not ids:
+            break
+
+        src = models.License
+        cols = [getattr(src, c) for c in _ARCHIVE_COLUMNS]
+        db.execute(
+            insert(models.LicenseArchive).from_select(
+                list(_ARCHIVE_COLUMNS) + ["archived_at"],
+                select(*cols, literal(now, DateTime)).where(src.id.in_(ids)),
+            )
+        )
+        db.query(models.License).filter(models.License.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+
+        archived += len(ids)
+        batches += 1
+
+    return {"archived": archived, "batches": batches, "cutoff": cutoff.isoformat()}
@@ -0,0 +1,199 @@
+"""在线备份：在一个读事务中用 SQLite 在线备份 API 分步复制数据库。
+
+数据库使用 WAL 日志模式（见 database.init_db），读事务不阻塞写入，因此备份期间许可证签发照常进行；
+整个复制过程读取同一个快照，其他连接的写入不会使备份从头开始。
+备份文件转换为 DELETE 日志模式，是不依赖 -wal/-shm 文件的单个自包含文件。
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGES_PER_STEP = 256
+DEFAULT_STEP_PAUSE_SECONDS = 0.005
+
+# progress(copied_pages, total_pages)
+ProgressFn = Callable[[int, int], None]
+
+
+def verify_database(path: str) -> str:
+    """对数据库文件运行 PRAGMA integrity_check，返回结果（正常为 "ok"）。"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        conn.close()
+    return "; ".join(str(r[0]) for r in rows)
+
+
+def backup_database(
+    source_path: str,
+    dest_path: str,
+    pages_per_step: int = DEFAULT_PAGES_PER_STEP,
+    step_pause_seconds: float = DEFAULT_STEP_PAUSE_SECONDS,
+    progress: Optional[ProgressFn] = None,
+    verify: bool = True,
+) -> Dict[str, Any]:
+    """把 source_path 在线备份到 dest_path。
+
+    先写入 dest_path + ".tmp"，校验通过后再原子替换为 dest_path；校验失败时抛出 RuntimeError。
+    源库不是 WAL 模式时，读事务会阻塞写入的提交，直到备份完成。
+
+    返回:
+        dict: {"source", "destination", "pages", "steps", "elapsed_seconds", "bytes", "integrity"}
+    """
+    tmp_path = dest_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    os.makedirs(os.path.dirname(os.path.abspath(dest_path)), exist_ok=True)
+
+    stats = {"steps": 0, "pages": 0}
+
+    def _on_step(status: int, remaining: int, total: int) -> None:
+        stats["steps"] += 1
+        stats["pages"] = total
+        if progress is not None:
+            progress(total - remaining, total)
+        if step_pause_seconds > 0 and remaining > 0:
+            time.sleep(step_pause_seconds)
+
+    started = time.monotonic()
+    # isolation_level=None：由这里显式管理读事务
+    src = sqlite3.connect(source_path, timeout=30, isolation_level=None)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        # 在整个复制期间持有同一个读事务：各步读取同一快照，写入不会让备份重启
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=pages_per_step, progress=_on_step)
+        src.execute("COMMIT")
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+
+    integrity = verify_database(tmp_path) if verify else "skipped"
+    if verify and integrity != "ok":
+        os.remove(tmp_path)
+        raise RuntimeError(f"backup integrity check failed: {integrity}")
+    os.replace(tmp_path, dest_path)
+
+    return {
+        "source": source_path,
+        "destination": dest_path,
+        "pages": stats["pages"],
+        "steps": stats["steps"],
+        "elapsed_seconds": round(time.monotonic() - started, 3),
+        "bytes": os.path.getsize(dest_path),
+        "integrity": integrity,
+    }
+
+
+def snapshot_name(source_path: str, when: Optional[datetime] = None) -> str:
+    stem, ext = os.path.splitext(os.path.basename(source_path))
+    return f"{stem}-{(when or datetime.now()).strftime('%Y%m%d-%H%M%S')}{ext or '.db'}"
+
+
+def prune_snapshots(directory: str, source_path: str, keep: int) -> List[str]:
+    """只保留 directory 中 source_path 最新的 keep 份快照，返回被删除的文件。"""
+    stem, ext = os.path.splitext(os.path.basename(source_path))
+    prefix, suffix = f"{stem}-", ext or ".db"
+    snapshots = sorted(
+        name for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith(suffix) and name[len(prefix):-len(suffix)].replace("-", "").isdigit()
+    )
+    removed = snapshots[:-keep] if keep > 0 else snapshots
+    for name in removed:
+        os.remove(os.path.join(directory, name))
+    return [os.path.join(directory, name) for name in removed]
+
+
+def snapshot(
+    source_paths: List[str],
+    directory: str,
+    keep: int,
+    progress: Optional[ProgressFn] = None,
+    **backup_kwargs: Any,
+) -> Dict[str, Any]:
+    """为每个源文件（主库及分片文件）生成一份带时间戳的快照，并按 keep 清理旧快照。"""
+    os.makedirs(directory, exist_ok=True)
+    when = datetime.now()
+    results = []
+    removed: List[str] = []
+    for path in source_paths:
+        dest = os.path.join(directory, snapshot_name(path, when))
+        results.append(backup_database(path, dest, progress=progress, **backup_kwargs))
+        removed.extend(prune_snapshots(directory, path, keep))
+    return {"backups": results, "removed": removed}
+
+
+class SnapshotScheduler:
+    """按固定间隔在后台线程中生成快照。"""
+
+    def __init__(self, source_paths: List[str], directory: str, interval_seconds: float, keep: int, **backup_kwargs: Any):
+        self.source_paths = source_paths
+        self.directory = directory
+        self.interval_seconds = interval_seconds
+        self.keep = keep
+        self.backup_kwargs = backup_kwargs
+        self.last_result: Optional[Dict[str, Any]] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="license-snapshots", daemon=True)
+
+    def start(self) -> "SnapshotScheduler":
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.last_result = snapshot(self.source_paths, self.directory, self.keep, **self.backup_kwargs)
+            except Exception:
+                logger.exception("scheduled snapshot failed")
+            self._stop.wait(self.interval_seconds)
+
+
+class BackupJob:
+    """管理接口使用的后台备份任务，记录进度供查询。同一时间只允许一个任务运行。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.status: Dict[str, Any] = {"state": "idle"}
+
+    def start(self, source_paths: List[str], directory: str, keep: int) -> bool:
+        with self._lock:
+            if self.status.get("state") == "running":
+                return False
+            self.status = {
+                "state": "running",
+                "started_at": datetime.now().isoformat(),
+                "files": len(source_paths),
+                "copied_pages": 0,
+                "total_pages": 0,
+            }
+        threading.Thread(target=self._run, args=(source_paths, directory, keep), name="license-backup", daemon=True).start()
+        return True
+
+    def _progress(self, copied: int, total: int) -> None:
+        self.status["copied_pages"] = copied
+        self.status["total_pages"] = total
+
+    def _run(self, source_paths: List[str], directory: str, keep: int) -> None:
+        try:
+            result = snapshot(source_paths, directory, keep, progress=self._progress)
+            self.status.update({"state": "done", "finished_at": datetime.now().isoformat(), **result})
+        except Exception as e:
+            logger.exception("backup failed")
+            self.status.update({"state": "failed", "finished_at": datetime.now().isoformat(), "error": str(e)})
+
+
+backup_job = BackupJob()
@@ -0,0 +1,122 @@
+"""命令行入口：channel-license <command>。"""
+import argparse
+import json
+import sys
+import time
+from typing import List, Optional
+
+from . import backup, database, loadtest
+from .config import BACKUP_KEEP, DATABASE_FILE_PATH, DATABASE_SHARD_COUNT
+
+
+def _print_progress(copied: int, total: int) -> None:
+    percent = 100.0 * copied / total if total else 100.0
+    print(f"\r  {copied}/{total} pages ({percent:.1f}%)", end="", file=sys.stderr, flush=True)
+
+
+def _source_paths(args: argparse.Namespace) -> List[str]:
+    return [args.db] + [database.shard_file_path(args.db, i) for i in range(args.shards)]
+
+
+def cmd_backup(args: argparse.Namespace) -> int:
+    kwargs = {"pages_per_step": args.pages, "step_pause_seconds": args.pause}
+    progress = None if args.quiet else _print_progress
+
+    if args.output:
+        if args.shards:
+            print("--output only supports a single file; use --snapshot-dir for sharded databases", file=sys.stderr)
+            return 2
+        result = backup.backup_database(args.db, args.output, progress=progress, **kwargs)
+        if not args.quiet:
+            print(file=sys.stderr)
+        print(f"backup written to {result['destination']} ({result['bytes']} bytes, "
+              f"{result['steps']} steps, integrity {result['integrity']})")
+        return 0
+
+    if not args.snapshot_dir:
+        print("either --output or --snapshot-dir is required", file=sys.stderr)
+        return 2
+
+    sources = _source_paths(args)
+    while True:
+        result = backup.snapshot(sources, args.snapshot_dir, args.keep, progress=progress, **kwargs)
+        if not args.quiet:
+            print(file=sys.stderr)
+        for item in result["backups"]:
+            print(f"snapshot {item['destination']} ({item['bytes']} bytes, integrity {item['integrity']})")
+        for path in result["removed"]:
+            print(f"removed old snapshot {path}")
+        if not args.interval:
+            return 0
+        time.sleep(args.interval)
+
+
+def cmd_loadtest(args: argparse.Namespace) -> int:
+    try:
+        mix = loadtest.parse_mix(args.mix)
+        summary = loadtest.run_loadtest(
+            rps=args.rps,
+            duration=args.duration,
+            mix=mix,
+            concurrency=args.concurrency,
+            db_path=args.db,
+            shards=args.shards,
+            use_uvicorn=args.uvicorn,
+            host=args.host,
+            port=args.port,
+            keep_ratelimit=args.ratelimit,
+            write_queue=args.write_queue,
+            seed=args.seed,
+        )
+    except (ValueError, RuntimeError) as e:
+        print(str(e), file=sys.stderr)
+        return 2
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print(loadtest.format_summary(summary))
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="channel-license", description="ChannelLicense 管理工具")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("backup", help="在线备份数据库（不停服务）")
+    p.add_argument("--db", default=DATABASE_FILE_PATH, help="数据库文件路径")
+    p.add_argument("--shards", type=int, default=DATABASE_SHARD_COUNT, help="分片数量（同时备份分片文件）")
+    p.add_argument("--output", "-o", help="备份到指定文件")
+    p.add_argument("--snapshot-dir", help="生成带时间戳的快照到该目录")
+    p.add_argument("--keep", type=int, default=BACKUP_KEEP, help="快照保留份数")
+    p.add_argument("--interval", type=float, default=0, help="周期性快照间隔（秒），0 表示只做一次")
+    p.add_argument("--pages", type=int, default=backup.DEFAULT_PAGES_PER_STEP, help="每步复制的页数")
+    p.add_argument("--pause", type=float, default=backup.DEFAULT_STEP_PAUSE_SECONDS, help="步间暂停（秒）")
+    p.add_argument("--quiet", "-q", action="store_true", help="不输出进度")
+    p.set_defaults(func=cmd_backup)
+
+    p = sub.add_parser("loadtest", help="对完整的 HTTP 应用发压并统计延迟")
+    p.add_argument("--rps", type=float, default=100.0, help="目标每秒请求数")
+    p.add_argument("--duration", type=float, default=10.0, help="持续时间（秒）")
+    p.add_argument("--mix", default="new=20,repeat=60,list=15,admin=5", help="流量配比：new/repeat/list/admin 的权重")
+    p.add_argument("--concurrency", type=int, default=64, help="同时在途的最大请求数")
+    p.add_argument("--db", help="数据库文件路径（默认使用临时新库）")
+    p.add_argument("--shards", type=int, default=0, help="分片数量")
+    p.add_argument("--uvicorn", action="store_true", help="在本地端口启动 uvicorn，而不是进程内 ASGI 调用")
+    p.add_argument("--host", default="127.0.0.1", help="uvicorn 监听地址")
+    p.add_argument("--port", type=int, default=0, help="uvicorn 端口，0 表示随机空闲端口")
+    p.add_argument("--ratelimit", action="store_true", help="保留许可证限流（默认压测期间关闭）")
+    p.add_argument("--write-queue", action="store_true", help="启用写入串行器")
+    p.add_argument("--seed", type=int, help="随机种子")
+    p.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    p.set_defaults(func=cmd_loadtest)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not hasattr(args, "func"):
+        parser.print_help()
+        return 0
+    return args.func(args)
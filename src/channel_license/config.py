@@ -2,3 +2,22 @@
 
 DATABASE_FILE_PATH = "license_server.db"
 CURRENT_LICENSE_VERSION = "1.0.1"
+# 大于 0 时启用分片存储：devices/licenses 按 device_id 哈希分布到多个 SQLite 文件
+DATABASE_SHARD_COUNT = 0
+
+# 许可证请求限流（令牌桶）：按请求 IP 和按设备分别限流
+# 渠道可通过 Channel.rate_limit_per_minute 覆盖单设备的限额
+RATE_LIMIT_IP_PER_SECOND = 50.0
+RATE_LIMIT_IP_BURST = 100
+RATE_LIMIT_DEVICE_PER_MINUTE = 30
+RATE_LIMIT_SHARDS = 16
+
+# 在线备份：管理接口生成的快照目录与保留份数
+BACKUP_DIR = "backups"
+BACKUP_KEEP = 7
+
+# 多进程共享的活跃许可证索引（mmap 文件）；为 None 时不启用
+SHARED_INDEX_PATH = None
+SHARED_INDEX_CAPACITY = 1 << 16
+# 每条记录为 license key 预留的字节数，更长的 key 不走索引快速路径
+SHARED_INDEX_KEY_SLOT = 352
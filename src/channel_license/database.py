@@ -1,14 +1,43 @@
 """数据库连接与会话管理。"""
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future
 from contextlib import contextmanager
-from sqlalchemy import Engine, create_engine
-from sqlalchemy.orm import sessionmaker
-from .config import DATABASE_FILE_PATH
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+from .config import DATABASE_FILE_PATH, DATABASE_SHARD_COUNT
+from .exceptions import ChannelNotFound, DeviceLimitExceeded, SigningUnavailable
 
 # SQLite 文件数据库
 engine: Engine = None
 
 SessionLocal = None
 
+# 只读引擎：GET 类接口使用，与写引擎分开连接池；可通过 configure_read_engine 指向副本文件
+read_engine: Engine = None
+
+ReadSessionLocal = None
+
+# 只读引擎指向的文件，get_data_version 读取它的变更标识
+_read_database_file_path: Optional[str] = None
+
+# 可选的写入串行器（见 start_write_queue）
+write_queue: Optional["WriteQueue"] = None
+
+# 分片模式（shard_count > 0）：devices/licenses 按 device_id_str 的哈希分布到多个 SQLite 文件，
+# channels 只保存在主库文件中。各分片会话对 Channel 的读写仍路由到主库引擎。
+shard_engines: List[Engine] = []
+ShardSessionLocals: List[sessionmaker] = []
+shard_write_queues: List["WriteQueue"] = []
+_version_file_paths: List[str] = []
+
 @contextmanager
 def get_db_session():
     if SessionLocal is None:
@@ -20,14 +49,377 @@ def get_db_session():
     finally:
         db.close()
 
-def init_db(database_file_path: str = DATABASE_FILE_PATH):
-    """创建所有模型对应的表（若不存在）。"""
+@contextmanager
+def get_read_db_session():
+    """只读会话上下文管理器：会话绑定到 read_engine，任何写操作都会被 SQLite 拒绝。"""
+    if ReadSessionLocal is None:
+        raise Exception("Database not initialized")
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def _on_write_connect(dbapi_connection, connection_record):
+    # WAL 模式下读事务（包括在线备份）不阻塞写入；journal_mode 会持久保存在数据库文件中
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+
+def _create_write_engine(path: str) -> Engine:
+    new_engine = create_engine(f"sqlite:///{path}", echo=False, future=True)
+    event.listen(new_engine, "connect", _on_write_connect)
+    return new_engine
+
+
+def init_db(
+    database_file_path: str = DATABASE_FILE_PATH,
+    read_pool_size: int = 10,
+    shard_count: int = DATABASE_SHARD_COUNT,
+):
+    """按 migrations 把数据库升级到最新 schema，并创建指向同一文件的只读引擎。
+
+    数据库文件使用 WAL 日志模式。
+
+    shard_count > 0 时启用分片模式：database_file_path 作为保存 channels 的共享主库，
+    另建 shard_count 个分片文件（<name>.shard<i>.db）保存 devices/licenses。
+    """
     global engine
     global SessionLocal
     if engine is not None:
         return
-    engine = create_engine(f"sqlite:///{database_file_path}", echo=False, future=True)
+    engine = _create_write_engine(database_file_path)
     SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
-    # 延迟导入 models，避免循环导入问题
-    from .models import Base
-    Base.metadata.create_all(bind=engine)
+    # 延迟导入，避免循环导入问题；schema 已是最新版本时 migrate 只读取一次版本号
+    from . import migrations
+    migrations.migrate(engine)
+    if shard_count > 0:
+        _init_shards(database_file_path, shard_count)
+    # 只读引擎以 mode=ro 打开文件，所以必须在建表（文件已存在）之后创建
+    configure_read_engine(database_file_path, pool_size=read_pool_size)
+
+
+def shard_file_path(database_file_path: str, index: int) -> str:
+    root, ext = os.path.splitext(database_file_path)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+def _init_shards(database_file_path: str, shard_count: int) -> None:
+    from . import migrations
+    from .models import Channel
+
+    # 分片文件不包含 channels 表（devices.channel_id 的外键在 SQLite 中不强制检查）
+    for i in range(shard_count):
+        path = shard_file_path(database_file_path, i)
+        shard_engine = _create_write_engine(path)
+        migrations.migrate(shard_engine, role=migrations.ROLE_SHARD)
+        factory = sessionmaker(
+            bind=shard_engine,
+            binds={Channel: engine},
+            autocommit=False,
+            autoflush=False,
+            info={"shard": i},
+        )
+        shard_engines.append(shard_engine)
+        ShardSessionLocals.append(factory)
+        _version_file_paths.append(path)
+
+
+def database_file_paths() -> List[str]:
+    """当前使用的所有数据库文件：主库，以及分片模式下的各分片文件。"""
+    if engine is None:
+        raise Exception("Database not initialized")
+    return [engine.url.database] + [e.url.database for e in shard_engines]
+
+
+def is_sharded() -> bool:
+    return len(ShardSessionLocals) > 0
+
+
+def shard_index(device_id_str: str) -> int:
+    """device_id_str 所属的分片序号（跨进程稳定的 CRC32 哈希）。"""
+    return zlib.crc32(device_id_str.encode("utf-8")) % len(ShardSessionLocals)
+
+
+@contextmanager
+def get_shard_session(index: int):
+    """第 index 个分片的会话上下文管理器。"""
+    db = ShardSessionLocals[index]()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@contextmanager
+def session_for_device(device_id_str: str):
+    """返回处理该设备所用的会话：分片模式下为其所属分片，否则为主库会话。"""
+    if not is_sharded():
+        with get_db_session() as db:
+            yield db
+        return
+    with get_shard_session(shard_index(device_id_str)) as db:
+        yield db
+
+
+def iter_device_sessions() -> Iterator[Session]:
+    """依次 yield 保存设备数据的每个会话（分片模式下逐个分片，否则只有主库），用于扇出查询。"""
+    if not is_sharded():
+        with get_db_session() as db:
+            yield db
+        return
+    for i in range(len(ShardSessionLocals)):
+        with get_shard_session(i) as db:
+            yield db
+
+
+def _file_version(path: str) -> str:
+    """数据库文件的变更标识：每次提交都会改变，且对所有进程相同。
+
+    文件头偏移 24 处的 4 字节 file change counter 在回滚日志模式下每次提交递增，WAL 模式下在
+    checkpoint 时递增；WAL 模式下每次提交改变的是 -shm 中 wal-index 头部的 iChange / mxFrame / salt
+    （偏移 8 到 48）。两者各用一次 pread 读取。
+    """
+    parts = []
+    for file_path, offset, size in ((path, 24, 4), (path + "-shm", 8, 40)):
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            parts.append("0")
+            continue
+        try:
+            parts.append(os.pread(fd, size, offset).hex() or "0")
+        finally:
+            os.close(fd)
+    return ".".join(parts)
+
+
+def get_data_version() -> str:
+    """返回一个廉价的数据版本标识，数据变化时必然改变。
+
+    只由数据库文件（只读库及分片文件）中的共享状态组成（见 _file_version），同一份数据在每个
+    worker 进程中得到相同的值，任何进程的提交都会使它改变。不访问数据库。
+    """
+    paths = ([_read_database_file_path] if _read_database_file_path is not None else []) + _version_file_paths
+    return ".".join(_file_version(path) for path in paths)
+
+
+def _on_read_connect(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only = ON")
+    cursor.close()
+
+
+def configure_read_engine(
+    database_file_path: str = DATABASE_FILE_PATH, pool_size: int = 10, max_overflow: int = 10
+) -> Engine:
+    """（重新）创建只读引擎。
+
+    默认指向主库文件；传入副本文件路径即可把所有只读会话切换到副本，已有的只读连接会被释放。
+    """
+    global read_engine
+    global ReadSessionLocal
+    global _read_database_file_path
+    uri_path = quote(Path(database_file_path).absolute().as_posix())
+    new_engine = create_engine(
+        f"sqlite:///file:{uri_path}?mode=ro&uri=true",
+        echo=False,
+        future=True,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+    )
+    event.listen(new_engine, "connect", _on_read_connect)
+    old_engine = read_engine
+    read_engine = new_engine
+    _read_database_file_path = database_file_path
+    ReadSessionLocal = sessionmaker(bind=new_engine, autocommit=False, autoflush=False)
+    if old_engine is not None:
+        old_engine.dispose()
+    return new_engine
+
+
+class WriteQueue:
+    """组提交写入串行器：由一个专用写线程收集多个请求的写操作，合并为一次 commit。
+
+    每个写操作是一个 ``fn(db) -> result`` 可调用对象，在写线程的同一个会话中依次执行；
+    满 ``max_batch`` 个或等待 ``max_delay_ms`` 毫秒后统一 commit，再用各自的结果
+    resolve 调用方拿到的 Future。
+
+    ``prepare_batch(db, fns)`` 可选：每个批次开始写入之前，用一个单独的会话调用一次，
+    用于把耗时的准备工作（如签名）移出写事务。它返回 {fns 中的下标: 异常}，对应的操作
+    不进入写事务，异常直接设置到其 Future 上；它自身抛出的异常会被忽略。
+
+    约定：``passthrough_exceptions`` 中的异常必须在写入任何数据之前抛出（如
+    ChannelNotFound / DeviceLimitExceeded），它们只会被转交给对应的 Future，不影响同批次
+    的其他操作。其他任何异常都会回滚整个批次，然后逐个以独立事务重试，保证单个请求的语义
+    与直接调用时一致。
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        max_batch: int = 64,
+        max_delay_ms: float = 5.0,
+        passthrough_exceptions: Tuple[type, ...] = (ChannelNotFound, DeviceLimitExceeded, SigningUnavailable),
+        prepare_batch: Optional[
+            Callable[[Session, List[Callable[[Session], Any]]], Optional[Dict[int, BaseException]]]
+        ] = None,
+    ):
+        self.session_factory = session_factory
+        self.prepare_batch = prepare_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.0
+        self.passthrough_exceptions = passthrough_exceptions
+        self._queue: "queue.Queue[Optional[Tuple[Callable[[Session], Any], Future]]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="license-writer", daemon=True)
+        self._stopped = False
+        self._thread.start()
+
+    def submit(self, fn: Callable[[Session], Any]) -> Future:
+        """提交一个写操作，返回在其所在批次 commit 后才 resolve 的 Future。
+
+        在所在批次开始执行之前取消 Future（Future.cancel()），该写操作会被跳过。
+        """
+        if self._stopped:
+            raise Exception("Write queue stopped")
+        fut: Future = Future()
+        self._queue.put((fn, fut))
+        return fut
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """处理完已提交的操作后停止写线程。"""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _collect(self) -> Tuple[List[Tuple[Callable[[Session], Any], Future]], bool]:
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        while True:
+            batch, stop = self._collect()
+            if batch:
+                self._commit_batch(batch)
+            if stop:
+                return
+
+    def _prepare(
+        self, batch: List[Tuple[Callable[[Session], Any], Future]]
+    ) -> List[Tuple[Callable[[Session], Any], Future]]:
+        """执行 prepare_batch，返回仍需进入写事务的操作；准备失败的操作在此直接结束。"""
+        if self.prepare_batch is None:
+            return batch
+        db = self.session_factory()
+        try:
+            failed = self.prepare_batch(db, [fn for fn, _ in batch]) or {}
+        except Exception:
+            failed = {}
+        finally:
+            db.close()
+        for i, exc in failed.items():
+            batch[i][1].set_exception(exc)
+        return [item for i, item in enumerate(batch) if i not in failed]
+
+    def _commit_batch(self, batch: List[Tuple[Callable[[Session], Any], Future]]) -> None:
+        # 跳过已被调用方取消的操作；其余 Future 进入 running 状态，之后无法再取消
+        batch = [(fn, fut) for fn, fut in batch if fut.set_running_or_notify_cancel()]
+        batch = self._prepare(batch)
+        if not batch:
+            return
+        results: List[Tuple[Future, Any, Optional[BaseException]]] = []
+        db = self.session_factory()
+        try:
+            for fn, fut in batch:
+                try:
+                    results.append((fut, fn(db), None))
+                except self.passthrough_exceptions as e:
+                    results.append((fut, None, e))
+            db.commit()
+        except Exception:
+            db.rollback()
+            db.close()
+            self._run_isolated(batch)
+            return
+        db.close()
+
+        for fut, result, exc in results:
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(result)
+
+    def _run_isolated(self, batch: List[Tuple[Callable[[Session], Any], Future]]) -> None:
+        # 批次中出现了意外错误：逐个以独立事务执行，把错误隔离在出错的那个请求上
+        for fn, fut in batch:
+            db = self.session_factory()
+            try:
+                result = fn(db)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                fut.set_exception(e)
+            else:
+                fut.set_result(result)
+            finally:
+                db.close()
+
+
+def start_write_queue(
+    max_batch: int = 64, max_delay_ms: float = 5.0, generate_key_fn: Optional[Callable[..., str]] = None
+) -> None:
+    """启动全局写入串行器（可选）。需先调用 init_db。
+
+    分片模式下每个分片各有一个写线程，互不阻塞。
+    generate_key_fn 为服务使用的签名函数；它支持 sign_many（如 logic.SigningService）时，
+    每个批次在写事务之前统一预签名（logic.presign_license_batch）。默认的廉价签名函数不需要
+    预签名，省去每个请求额外的一次预判查询。
+    """
+    global write_queue
+    from .logic import presign_license_batch
+
+    if SessionLocal is None:
+        raise Exception("Database not initialized")
+    prepare_batch = presign_license_batch if hasattr(generate_key_fn, "sign_many") else None
+    kwargs = dict(max_batch=max_batch, max_delay_ms=max_delay_ms, prepare_batch=prepare_batch)
+    if is_sharded():
+        if not shard_write_queues:
+            shard_write_queues.extend(WriteQueue(factory, **kwargs) for factory in ShardSessionLocals)
+    elif write_queue is None:
+        write_queue = WriteQueue(SessionLocal, **kwargs)
+
+
+def get_write_queue(device_id_str: str) -> Optional[WriteQueue]:
+    """返回负责该设备写入的串行器；未启动时返回 None。"""
+    if shard_write_queues:
+        return shard_write_queues[shard_index(device_id_str)]
+    return write_queue
+
+
+def stop_write_queue() -> None:
+    """停止全局写入串行器，已提交的操作会先处理完。"""
+    global write_queue
+    if write_queue is not None:
+        write_queue.stop()
+        write_queue = None
+    for q in shard_write_queues:
+        q.stop()
+    shard_write_queues.clear()
@@ -0,0 +1,194 @@
+"""进程内事件发布/订阅：供 /api/events（Server-Sent Events）推送许可证生命周期事件。
+
+写操作通过 queue_event 把事件挂在会话上，只有事务 commit 之后才会真正发布，回滚则丢弃；
+不涉及写入的事件（如 license-reused）通过 publish_or_queue 发布：会话中没有未提交的写入时立即发布，
+否则（例如写入串行器的同一批次中刚签发的许可证被复用）同样等到 commit 之后。
+
+事件类型：license-issued, license-reused, status-changed, device-deleted, channel-changed。
+"""
+import asyncio
+import json
+import logging
+import threading
+import uuid
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# 每次进程启动不同，用于识别 Last-Event-ID 是否来自本进程
+BOOT_ID = uuid.uuid4().hex[:8]
+
+DEFAULT_HISTORY_SIZE = 1000
+DEFAULT_SUBSCRIBER_BUFFER = 256
+
+# (seq, type, data)
+Event = Tuple[int, str, Dict[str, Any]]
+
+
+def format_event_id(seq: int) -> str:
+    return f"{BOOT_ID}-{seq}"
+
+
+def parse_event_id(event_id: Optional[str]) -> Optional[int]:
+    """解析 Last-Event-ID；不是本进程发出的 id 返回 None。"""
+    if not event_id:
+        return None
+    boot, _, seq = event_id.strip().rpartition("-")
+    if boot != BOOT_ID or not seq.isdigit():
+        return None
+    return int(seq)
+
+
+def format_sse(ev: Event) -> str:
+    seq, ev_type, data = ev
+    return f"id: {format_event_id(seq)}\nevent: {ev_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class Subscription:
+    """一个订阅者的有界缓冲区。
+
+    缓冲区满时丢弃最旧的事件并标记 overflowed，下次读取时先收到一个 resync 事件，
+    提示客户端通过 /api/changes 等接口重新同步。
+    """
+
+    def __init__(self, buffer_size: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._buffer: Deque[Event] = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._loop = loop
+        self._wakeup = asyncio.Event() if loop is not None else None
+        self.overflowed = False
+
+    def push(self, ev: Event) -> None:
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.overflowed = True
+            self._buffer.append(ev)
+        if self._loop is not None and self._wakeup is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                # 事件循环已关闭，订阅者即将被移除
+                pass
+
+    def mark_resync(self) -> None:
+        with self._lock:
+            self.overflowed = True
+
+    def drain(self) -> List[Event]:
+        """取出缓冲区中的全部事件；若发生过丢弃，第一个元素是 resync 事件。"""
+        with self._lock:
+            events = list(self._buffer)
+            self._buffer.clear()
+            overflowed = self.overflowed
+            self.overflowed = False
+        if overflowed:
+            last_seq = events[0][0] - 1 if events else 0
+            events.insert(0, (last_seq, "resync", {"reason": "events dropped"}))
+        if self._wakeup is not None:
+            self._wakeup.clear()
+        return events
+
+    async def wait(self) -> None:
+        if self._wakeup is None:
+            raise RuntimeError("subscription was created without an event loop")
+        await self._wakeup.wait()
+
+
+class EventBus:
+    """线程安全的发布/订阅总线，保留最近 history_size 个事件用于断线续传。"""
+
+    def __init__(self, history_size: int = DEFAULT_HISTORY_SIZE, subscriber_buffer: int = DEFAULT_SUBSCRIBER_BUFFER):
+        self.subscriber_buffer = subscriber_buffer
+        self._history: Deque[Event] = deque(maxlen=history_size)
+        self._subscribers: List[Subscription] = []
+        self._listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def publish(self, ev_type: str, data: Dict[str, Any]) -> int:
+        with self._lock:
+            self._seq += 1
+            ev = (self._seq, ev_type, data)
+            self._history.append(ev)
+            subscribers = list(self._subscribers)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(ev_type, data)
+            except Exception:
+                # 监听器的错误不能影响已经 commit 的写操作
+                logger.exception("event listener failed for %s", ev_type)
+        for sub in subscribers:
+            sub.push(ev)
+        return ev[0]
+
+    def add_listener(self, listener: Callable[[str, Dict[str, Any]], None]) -> None:
+        """注册同步监听器：在发布事件的线程中（即 commit 之后）立即以 (type, data) 调用。"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[str, Dict[str, Any]], None]) -> None:
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def subscribe(
+        self, last_event_id: Optional[str] = None, loop: Optional[asyncio.AbstractEventLoop] = None
+    ) -> Subscription:
+        """创建订阅。带 Last-Event-ID 时先补发历史中之后的事件；无法补全则先发 resync。"""
+        sub = Subscription(self.subscriber_buffer, loop)
+        with self._lock:
+            if last_event_id:
+                last_seq = parse_event_id(last_event_id)
+                oldest = self._history[0][0] if self._history else self._seq + 1
+                if last_seq is None or last_seq + 1 < oldest:
+                    sub.mark_resync()
+                if last_seq is not None:
+                    for ev in self._history:
+                        if ev[0] > last_seq:
+                            sub.push(ev)
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    @property
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+
+bus = EventBus()
+
+
+def queue_event(db: Session, ev_type: str, data: Dict[str, Any]) -> None:
+    """把事件挂到会话上，待事务 commit 后发布到 bus。"""
+    db.info.setdefault("pending_events", []).append((ev_type, data))
+
+
+def publish_or_queue(db: Session, ev_type: str, data: Dict[str, Any]) -> None:
+    """会话中有尚未 commit 的写入时挂起事件（同 queue_event），否则立即发布。"""
+    if db.info.get("pending_events") or db.new or db.dirty or db.deleted:
+        queue_event(db, ev_type, data)
+    else:
+        bus.publish(ev_type, data)
+
+
+def _publish_pending(session: Session) -> None:
+    for ev_type, data in session.info.pop("pending_events", []):
+        bus.publish(ev_type, data)
+
+
+def _discard_pending(session: Session, *args) -> None:
+    session.info.pop("pending_events", None)
+
+
+event.listen(Session, "after_commit", _publish_pending)
+event.listen(Session, "after_soft_rollback", _discard_pending)
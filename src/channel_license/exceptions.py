@@ -7,3 +7,28 @@ class ChannelNotFound(Exception):
 
 class DeviceLimitExceeded(Exception):
     """当渠道设备数量达到上限时抛出。"""
+
+
+class RateLimited(Exception):
+    """当请求超出限流配额时抛出。"""
+
+    def __init__(self, message: str, scope: str, retry_after: float):
+        super().__init__(message)
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class SigningUnavailable(Exception):
+    """当签名服务排队已满或签名超时时抛出。"""
+
+
+class WriteQueueTimeout(Exception):
+    """当写入串行器未能在超时时间内完成请求时抛出。
+
+    cancelled 为 True 表示请求尚未开始执行且已被取消，没有写入任何数据；
+    为 False 表示请求已在执行中，结果未知（稍后可能仍会 commit）。
+    """
+
+    def __init__(self, message: str, cancelled: bool):
+        super().__init__(message)
+        self.cancelled = cancelled
@@ -1,13 +1,26 @@
-from typing import Optional, List
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, List
 
-from fastapi import Depends, FastAPI, HTTPException, Query, status
-from fastapi.responses import FileResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, status
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel
 
 from . import api as license_api
+from . import backup
 from . import database
+from . import events
+from . import exceptions
+from . import logic
+from . import ratelimit
+from . import shared_index
+from . import tracing
+from .config import BACKUP_DIR, BACKUP_KEEP, SHARED_INDEX_PATH
+from .http_cache import CachedStaticFiles, REVALIDATE_CACHE_CONTROL, etag_matches, render_index
+# JSON 编码耗时计入追踪的 encode 阶段
+from .tracing import TracedJSONResponse as JSONResponse
 
 import os
 import secrets
@@ -27,6 +40,11 @@ def hash_password(password: str) -> str:
 
 def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
     """验证 Basic Auth 凭据"""
+    with tracing.span("auth"):
+        return _check_credentials(credentials)
+
+
+def _check_credentials(credentials: HTTPBasicCredentials) -> str:
     # 确保 USERNAME 和 PASSWORD_HASH 不为 None，满足类型检查要求
     username = os.environ.get("LICENSE_ADMIN_USERNAME", "admin")
     password_hash = os.environ.get("LICENSE_ADMIN_PASSWORD_HASH", "5e884898da28047151d0e56f8dc6292773603d0d6aabbdd62a11ef721d1542d8")
@@ -47,11 +65,24 @@ def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
 
 
 def get_db():
-    db = database.SessionLocal()
+    with tracing.span("session"):
+        db = database.SessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        with tracing.span("session"):
+            db.close()
+
+
+def get_read_db():
+    """只读会话依赖：GET 路由使用，走 database.read_engine 的独立连接池。"""
+    with tracing.span("session"):
+        db = database.ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        with tracing.span("session"):
+            db.close()
 
 
 class ChannelCreate(BaseModel):
@@ -59,6 +90,9 @@ class ChannelCreate(BaseModel):
     max_devices: Optional[int] = 1000
     license_duration_days: Optional[int] = 30
     description: Optional[str] = None
+    rate_limit_per_minute: Optional[int] = None
+    expiry_jitter_seconds: Optional[int] = 0
+    early_renewal_seconds: Optional[int] = 0
 
 
 class ChannelEdit(BaseModel):
@@ -66,19 +100,76 @@ class ChannelEdit(BaseModel):
     max_devices: Optional[int] = None
     license_duration_days: Optional[int] = None
     description: Optional[str] = None
+    rate_limit_per_minute: Optional[int] = None
+    expiry_jitter_seconds: Optional[int] = None
+    early_renewal_seconds: Optional[int] = None
+
+
+class LicenseRequest(BaseModel):
+    device_id: str
+    channel: str
 
 
 class LicenseStatusUpdate(BaseModel):
     new_status: str
 
 
-def index():
-    return FileResponse(f"{os.path.dirname(__file__)}/static/index.html")
+class LicenseLookup(BaseModel):
+    keys: List[str]
 
 
-def api_list_devices(include_expired: bool = Query(False), db=Depends(get_db)):
-    res = license_api.get_all_device_licenses(db, include_expired=include_expired)
-    return JSONResponse(content=res)
+STATIC_DIR = f"{os.path.dirname(__file__)}/static"
+
+# 未过期过滤依赖当前时间：没有写入时结果也会随时间变化，因此 ETag 额外带上时间桶
+ACTIVE_LIST_ETAG_BUCKET_SECONDS = 60
+
+
+def index(request: Request):
+    html, etag = render_index(STATIC_DIR)
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=html, media_type="text/html", headers=headers)
+
+
+def _conditional_json(request: Request, scope: str, build: Callable[[], Dict[str, Any]]) -> Response:
+    """基于 database.get_data_version() 的条件 GET。
+
+    ETag 在执行查询之前计算；命中 If-None-Match 时直接返回 304，不访问数据库。
+    """
+    etag = f'W/"{scope}.{database.get_data_version()}"'
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    with tracing.span("api"):
+        content = build()
+    return JSONResponse(content=content, headers=headers)
+
+
+def api_list_devices(
+    request: Request,
+    include_expired: bool = Query(False),
+    compact: bool = Query(False),
+    fields: Optional[str] = Query(None),
+    db=Depends(get_read_db),
+):
+    try:
+        license_fields = license_api.parse_license_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if include_expired:
+        scope = "devices-all"
+    else:
+        scope = f"devices-active.{int(time.time()) // ACTIVE_LIST_ETAG_BUCKET_SECONDS}"
+    # 不同的响应形状必须使用不同的 ETag
+    if compact:
+        scope += ".compact"
+    if license_fields is not None:
+        scope += ".f-" + "-".join(license_fields)
+    kwargs = dict(include_expired=include_expired, compact=compact, license_fields=license_fields)
+    if database.is_sharded():
+        return _conditional_json(request, scope, lambda: license_api.get_all_device_licenses_with_session(**kwargs))
+    return _conditional_json(request, scope, lambda: license_api.get_all_device_licenses(db, **kwargs))
 
 
 def api_add_channel(payload: ChannelCreate, db=Depends(get_db)):
@@ -88,16 +179,18 @@ def api_add_channel(payload: ChannelCreate, db=Depends(get_db)):
         max_devices=payload.max_devices if payload.max_devices is not None else 1000,
         license_duration_days=payload.license_duration_days if payload.license_duration_days is not None else 30,
         description=payload.description,
+        rate_limit_per_minute=payload.rate_limit_per_minute,
+        expiry_jitter_seconds=payload.expiry_jitter_seconds if payload.expiry_jitter_seconds is not None else 0,
+        early_renewal_seconds=payload.early_renewal_seconds if payload.early_renewal_seconds is not None else 0,
     )
     if not res.get("success", False):
         raise HTTPException(status_code=400, detail=res.get("message", "add failed"))
     return JSONResponse(content=res)
 
 
-def api_get_channels(db=Depends(get_db)):
-    """返回所有渠道的列表（JSON）。"""
-    res = license_api.get_all_channels(db)
-    return JSONResponse(content=res)
+def api_get_channels(request: Request, db=Depends(get_read_db)):
+    """返回所有渠道的列表（JSON），支持 If-None-Match。"""
+    return _conditional_json(request, "channels", lambda: license_api.get_all_channels(db))
 
 
 def api_delete_channel(
@@ -119,9 +212,12 @@ def api_delete_device(
     force: bool = Query(False),
     db=Depends(get_db),
 ):
-    res = license_api.delete_device(
-        db, device_id=device_id, device_id_str=device_id_str, force=force
-    )
+    if database.is_sharded():
+        res = license_api.delete_device_with_session(device_id=device_id, device_id_str=device_id_str, force=force)
+    else:
+        res = license_api.delete_device(
+            db, device_id=device_id, device_id_str=device_id_str, force=force
+        )
     if not res.get("success", False):
         raise HTTPException(status_code=400, detail=res.get("message", "delete failed"))
     return JSONResponse(content=res)
@@ -135,6 +231,9 @@ def api_edit_channel(channel_id: int, payload: ChannelEdit, db=Depends(get_db)):
         max_devices=payload.max_devices if payload.max_devices is not None else None,
         license_duration_days=payload.license_duration_days if payload.license_duration_days is not None else None,
         description=payload.description,
+        rate_limit_per_minute=payload.rate_limit_per_minute,
+        expiry_jitter_seconds=payload.expiry_jitter_seconds,
+        early_renewal_seconds=payload.early_renewal_seconds,
     )
     if not res.get("success", False):
         raise HTTPException(status_code=400, detail=res.get("message", "edit failed"))
@@ -142,33 +241,213 @@ def api_edit_channel(channel_id: int, payload: ChannelEdit, db=Depends(get_db)):
 
 
 def api_edit_license_status(
-    license_id: int, payload: LicenseStatusUpdate, db=Depends(get_db)
+    license_id: int,
+    payload: LicenseStatusUpdate,
+    device_id_str: Optional[str] = None,
+    db=Depends(get_db),
 ):
-    res = license_api.edit_license_status(
-        db, license_id=license_id, new_status=payload.new_status
-    )
+    if database.is_sharded():
+        res = license_api.edit_license_status_with_session(
+            license_id, payload.new_status, device_id_str=device_id_str
+        )
+    else:
+        res = license_api.edit_license_status(
+            db, license_id=license_id, new_status=payload.new_status, device_id_str=device_id_str
+        )
     if not res.get("success", False):
         raise HTTPException(status_code=400, detail=res.get("message", "update failed"))
     return JSONResponse(content=res)
 
 
+def api_device_license_history(
+    device_id: Optional[int] = None,
+    device_id_str: Optional[str] = None,
+    include_archived: bool = Query(False),
+    db=Depends(get_read_db),
+):
+    if database.is_sharded():
+        res = license_api.get_device_license_history_with_session(
+            device_id=device_id, device_id_str=device_id_str, include_archived=include_archived
+        )
+    else:
+        res = license_api.get_device_license_history(
+            db, device_id=device_id, device_id_str=device_id_str, include_archived=include_archived
+        )
+    if not res.get("success", False):
+        raise HTTPException(status_code=400, detail=res.get("message", "query failed"))
+    return JSONResponse(content=res)
+
+
+def api_archive_licenses(
+    retention_days: int = Query(90),
+    batch_size: int = Query(1000),
+    db=Depends(get_db),
+):
+    if database.is_sharded():
+        res = license_api.archive_licenses_with_session(retention_days=retention_days, batch_size=batch_size)
+    else:
+        res = license_api.archive_licenses(db, retention_days=retention_days, batch_size=batch_size)
+    if not res.get("success", False):
+        raise HTTPException(status_code=400, detail=res.get("message", "archive failed"))
+    return JSONResponse(content=res)
+
+
+def api_purge_devices(
+    channel_id: Optional[int] = None,
+    channel: Optional[str] = None,
+    stale_days: int = Query(90),
+    batch_size: int = Query(500),
+    dry_run: bool = Query(False),
+):
+    res = license_api.purge_stale_devices_with_session(
+        channel_id=channel_id, channel_name=channel, stale_days=stale_days, batch_size=batch_size, dry_run=dry_run
+    )
+    if not res.get("success", False):
+        raise HTTPException(status_code=400, detail=res.get("message", "purge failed"))
+    return JSONResponse(content=res)
+
+
+def api_get_license_by_key(key: str, db=Depends(get_read_db)):
+    if database.is_sharded():
+        res = license_api.get_license_by_key_with_session(key)
+    else:
+        res = license_api.get_license_by_key(db, key)
+    if not res.get("success", False):
+        raise HTTPException(status_code=404, detail=res.get("message", "license not found"))
+    return JSONResponse(content=res)
+
+
+def api_lookup_licenses(payload: LicenseLookup, db=Depends(get_read_db)):
+    if database.is_sharded():
+        res = license_api.lookup_licenses_by_keys_with_session(payload.keys)
+    else:
+        res = license_api.lookup_licenses_by_keys(db, payload.keys)
+    if not res.get("success", False):
+        raise HTTPException(status_code=400, detail=res.get("message", "lookup failed"))
+    return JSONResponse(content=res)
+
+
+def api_get_changes(since: str = Query("0"), limit: int = Query(1000), db=Depends(get_read_db)):
+    """增量同步。分片模式下游标为字符串（见 api.get_changes_with_session），原样传回即可。"""
+    if database.is_sharded():
+        res = license_api.get_changes_with_session(since=since, limit=limit)
+    else:
+        try:
+            res = license_api.get_changes(db, since=int(since), limit=limit)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid cursor")
+    if not res.get("success", False):
+        raise HTTPException(status_code=400, detail=res.get("message", "query failed"))
+    return JSONResponse(content=res)
+
+
+def api_request_license(payload: LicenseRequest, request: Request):
+    """设备申请许可证。
+
+    先做内存限流检查，被限流的请求直接返回 429，不会打开任何数据库会话。
+    """
+    request_ip = request.client.host if request.client is not None else None
+    try:
+        ratelimit.limiter.check(request_ip, payload.device_id, payload.channel)
+    except exceptions.RateLimited as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(max(1, int(e.retry_after + 0.999)))},
+        )
+
+    generate_key_fn = getattr(request.app.state, "generate_key_fn", None) or logic.generate_license_key
+    try:
+        with tracing.span("api"):
+            res = license_api.request_license(payload.device_id, payload.channel, request_ip or "", generate_key_fn)
+    except exceptions.ChannelNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except exceptions.DeviceLimitExceeded as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except (exceptions.SigningUnavailable, exceptions.WriteQueueTimeout) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return JSONResponse(content=res)
+
+
+def api_ratelimit_stats():
+    return JSONResponse(content={"stats": ratelimit.limiter.stats()})
+
+
+# SSE 心跳间隔（秒），防止代理因空闲断开连接
+EVENTS_HEARTBEAT_SECONDS = 15.0
+
+
+async def api_events(request: Request, last_event_id: Optional[str] = Header(None)):
+    """Server-Sent Events：推送许可证生命周期事件，支持 Last-Event-ID 断线续传。"""
+    sub = events.bus.subscribe(last_event_id, loop=asyncio.get_running_loop())
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                pending = sub.drain()
+                for ev in pending:
+                    yield events.format_sse(ev)
+                if pending:
+                    continue
+                try:
+                    await asyncio.wait_for(sub.wait(), timeout=EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            events.bus.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def api_start_backup(keep: int = Query(BACKUP_KEEP)):
+    """在后台生成一份在线快照（主库及分片文件）到 config.BACKUP_DIR。"""
+    if not backup.backup_job.start(database.database_file_paths(), BACKUP_DIR, keep):
+        raise HTTPException(status_code=409, detail="backup already running")
+    return JSONResponse(status_code=202, content=dict(backup.backup_job.status))
+
+
+def api_backup_status():
+    return JSONResponse(content=dict(backup.backup_job.status))
+
+
 def api_init_db():
     # helper for local dev to create tables
     database.init_db()
     return {"success": True}
 
 
-def api_init_routes(app: FastAPI, prefix: str = "", enable_basic_auth: bool = False):
+def api_init_routes(
+    app: FastAPI,
+    prefix: str = "",
+    enable_basic_auth: bool = False,
+    generate_key_fn: Optional[Callable[[str, datetime], str]] = None,
+    enable_tracing: bool = True,
+    server_timing: Optional[bool] = None,
+    shared_index_path: Optional[str] = SHARED_INDEX_PATH,
+):
     """在给定的 FastAPI 实例上注册所有路由和静态挂载。
 
     设计契约：
-    - 输入: app: FastAPI
+    - 输入: app: FastAPI；generate_key_fn 可选，例如 logic.SigningService 实例；
+      enable_tracing 为 True 时添加 tracing.TracingMiddleware（抽样日志）；server_timing 为 True 时
+      额外输出 Server-Timing 头，会向匿名客户端暴露内部耗时，只应在调试时开启（None 时读环境变量）
+      shared_index_path 不为 None 时打开多进程共享的活跃许可证索引（见 shared_index）
     - 输出: None（通过修改 app 注册路由）
     - 错误模式: 若重复注册相同路由会抛出异常
     """
+    app.state.generate_key_fn = generate_key_fn
+    if enable_tracing:
+        app.add_middleware(tracing.TracingMiddleware, server_timing=server_timing)
+    if shared_index_path is not None:
+        shared_index.open_index(shared_index_path)
 
     # serve static web UI
-    app.mount(f"{prefix}/static", StaticFiles(directory=f"{os.path.dirname(__file__)}/static"), name="static")
+    app.mount(f"{prefix}/static", CachedStaticFiles(directory=STATIC_DIR), name="static")
 
     # 构建依赖项列表
     dependencies: List = [Depends(get_current_username)] if enable_basic_auth else []
@@ -176,10 +455,22 @@ def api_init_routes(app: FastAPI, prefix: str = "", enable_basic_auth: bool = Fa
     # register routes
     app.get(f"{prefix}/", include_in_schema=False)(index)
     app.get(f"{prefix}/api/devices", dependencies=dependencies)(api_list_devices)
+    app.get(f"{prefix}/api/devices/licenses", dependencies=dependencies)(api_device_license_history)
     app.post(f"{prefix}/api/channels", dependencies=dependencies)(api_add_channel)
     app.get(f"{prefix}/api/channels", dependencies=dependencies)(api_get_channels)
     app.delete(f"{prefix}/api/channels", dependencies=dependencies)(api_delete_channel)
     app.delete(f"{prefix}/api/devices", dependencies=dependencies)(api_delete_device)
+    app.post(f"{prefix}/api/devices/purge", dependencies=dependencies)(api_purge_devices)
     app.put(f"{prefix}/api/channels/{{channel_id}}", dependencies=dependencies)(api_edit_channel)
     app.patch(f"{prefix}/api/licenses/{{license_id}}/status", dependencies=dependencies)(api_edit_license_status)
+    app.post(f"{prefix}/api/licenses/archive", dependencies=dependencies)(api_archive_licenses)
+    app.get(f"{prefix}/api/licenses/by-key", dependencies=dependencies)(api_get_license_by_key)
+    app.post(f"{prefix}/api/licenses/lookup", dependencies=dependencies)(api_lookup_licenses)
+    app.get(f"{prefix}/api/changes", dependencies=dependencies)(api_get_changes)
+    app.get(f"{prefix}/api/events", dependencies=dependencies)(api_events)
+    app.get(f"{prefix}/api/ratelimit/stats", dependencies=dependencies)(api_ratelimit_stats)
+    app.post(f"{prefix}/api/admin/backup", dependencies=dependencies)(api_start_backup)
+    app.get(f"{prefix}/api/admin/backup", dependencies=dependencies)(api_backup_status)
+    # 设备端接口，不使用管理员 Basic Auth
+    app.post(f"{prefix}/api/license")(api_request_license)
     app.post(f"{prefix}/api/init_db", include_in_schema=False)(api_init_db)
@@ -0,0 +1,180 @@
+"""HTTP 缓存支持：静态资源长缓存与预压缩、管理页面的资源版本号、列表接口的 ETag。"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import stat
+from typing import Dict, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+try:  # brotli 为可选依赖，未安装时只提供 gzip
+    import brotli  # type: ignore
+except ImportError:  # pragma: no cover - 取决于运行环境
+    brotli = None
+
+# 静态资源通过 ?v=<内容哈希> 引用，可以放心长期缓存
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 不带版本号的入口页面每次都要向服务端确认
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+COMPRESSIBLE_SUFFIXES = (".html", ".js", ".css", ".json", ".svg", ".txt", ".map")
+MIN_COMPRESS_SIZE = 256
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def supported_encodings() -> Tuple[str, ...]:
+    """按优先级返回服务端能提供的压缩编码。"""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """根据 Accept-Encoding 选择压缩编码（忽略 q 值为 0 的编码）。"""
+    accepted = set()
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(token.strip().lower())
+    for enc in supported_encodings():
+        if enc in accepted:
+            return enc
+    return None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """判断 If-None-Match 是否命中（按 RFC 7232 做弱比较）。"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    target = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == target:
+            return True
+    return False
+
+
+class CachedStaticFiles(StaticFiles):
+    """带长缓存头和预压缩变体的 StaticFiles。
+
+    挂载时把目录下的文本资源预先压缩（gzip，安装了 brotli 时还有 br）并缓存在内存中；
+    文件变化（mtime/size 不同）时按需重新压缩。客户端支持时直接返回压缩后的内容。
+    """
+
+    def __init__(self, *args, cache_control: str = STATIC_CACHE_CONTROL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+        # full_path -> ((mtime_ns, size), {encoding: (body, etag)})
+        self._variants: Dict[str, Tuple[Tuple[int, int], Dict[str, Tuple[bytes, str]]]] = {}
+        if self.directory is not None:
+            self._precompress_directory(str(self.directory))
+
+    def _precompress_directory(self, directory: str) -> None:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                full_path = os.path.join(root, name)
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                self._get_variants(full_path, st)
+
+    def _get_variants(self, full_path: str, stat_result: os.stat_result) -> Dict[str, Tuple[bytes, str]]:
+        if not full_path.endswith(COMPRESSIBLE_SUFFIXES) or stat_result.st_size < MIN_COMPRESS_SIZE:
+            return {}
+        key = (stat_result.st_mtime_ns, stat_result.st_size)
+        cached = self._variants.get(full_path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with open(full_path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()[:16]
+        variants = {}
+        for enc in supported_encodings():
+            variants[enc] = (_compress(data, enc), f'"{digest}-{enc}"')
+        self._variants[full_path] = (key, variants)
+        return variants
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""))
+        variants = self._get_variants(str(full_path), stat_result) if stat.S_ISREG(stat_result.st_mode) else {}
+
+        if encoding is not None and encoding in variants:
+            body, etag = variants[encoding]
+            headers = {
+                "ETag": etag,
+                "Cache-Control": self.cache_control,
+                "Vary": "Accept-Encoding",
+            }
+            if etag_matches(request_headers.get("if-none-match"), etag):
+                return Response(status_code=304, headers=headers)
+            headers["Content-Encoding"] = encoding
+            response = Response(
+                content=body if scope["method"] != "HEAD" else b"",
+                status_code=status_code,
+                media_type=_guess_media_type(str(full_path)),
+                headers=headers,
+            )
+            response.headers["Content-Length"] = str(len(body))
+            return response
+
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers["Cache-Control"] = self.cache_control
+        if variants:
+            response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+
+def _guess_media_type(path: str) -> str:
+    media_type, _ = mimetypes.guess_type(path)
+    if media_type is None:
+        return "application/octet-stream"
+    if media_type.startswith("text/") or media_type in ("application/javascript", "application/json"):
+        return f"{media_type}; charset=utf-8"
+    return media_type
+
+
+_index_cache: Dict[str, Tuple[Tuple[int, ...], bytes, str]] = {}
+
+
+def render_index(static_dir: str, assets: Tuple[str, ...] = ("app.js",)) -> Tuple[bytes, str]:
+    """读取 index.html，并把其中引用的静态资源改写为带内容哈希的 URL（static/app.js?v=...）。
+
+    返回 (页面内容, ETag)。结果按相关文件的 mtime 缓存。
+    """
+    index_path = os.path.join(static_dir, "index.html")
+    paths = [index_path] + [os.path.join(static_dir, a) for a in assets]
+    key = tuple(os.stat(p).st_mtime_ns for p in paths)
+    cached = _index_cache.get(static_dir)
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
+
+    with open(index_path, "rb") as f:
+        html = f.read()
+    for asset, path in zip(assets, paths[1:]):
+        with open(path, "rb") as f:
+            version = hashlib.sha1(f.read()).hexdigest()[:12]
+        ref = f"static/{asset}".encode()
+        html = html.replace(b'"' + ref + b'"', b'"' + ref + b"?v=" + version.encode() + b'"')
+    etag = f'"{hashlib.sha1(html).hexdigest()[:16]}"'
+    _index_cache[static_dir] = (key, html, etag)
+    return html, etag
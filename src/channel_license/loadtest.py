@@ -0,0 +1,326 @@
+"""HTTP 压测：用 asyncio 客户端按目标 RPS 驱动完整的 FastAPI 应用。
+
+与直接压 logic 的微基准不同，这里的请求会经过 api_init_routes 注册的路由、get_db 依赖、
+Starlette 线程池以及 SQLite 的文件锁。应用可以在进程内通过 ASGI 调用，也可以在本地端口上用 uvicorn 启动。
+"""
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI
+
+from . import database, fastapi_app, models, ratelimit
+
+try:  # httpx 为可选依赖，只有压测需要
+    import httpx  # type: ignore
+except ImportError:  # pragma: no cover - 取决于运行环境
+    httpx = None
+
+LOADTEST_CHANNEL = "loadtest"
+DEFAULT_MIX = {"new": 20, "repeat": 60, "list": 15, "admin": 5}
+LOCKED_MESSAGE = "database is locked"
+# 关闭限流时使用的令牌桶容量/速率
+UNLIMITED = 1e12
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    """解析流量配比，如 "new=20,repeat=60,list=15,admin=5"。未列出的类型权重为 0。"""
+    mix = {k: 0 for k in DEFAULT_MIX}
+    for part in value.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in mix:
+            raise ValueError(f"unknown traffic type: {name} (expected one of {', '.join(mix)})")
+        mix[name] = int(weight)
+    if sum(mix.values()) <= 0:
+        raise ValueError("traffic mix must have a positive total weight")
+    return mix
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近秩百分位数；sorted_values 需已排序。"""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+@dataclass
+class LoadTestStats:
+    latencies: Dict[str, List[float]] = field(default_factory=dict)
+    errors: Dict[str, int] = field(default_factory=dict)
+    locked: int = 0
+    started: float = 0.0
+    finished: float = 0.0
+
+    def record(self, kind: str, seconds: float, error: Optional[str] = None) -> None:
+        self.latencies.setdefault(kind, []).append(seconds)
+        if error is not None:
+            key = f"{kind}: {error}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = max(self.finished - self.started, 1e-9)
+        by_kind: Dict[str, Any] = {}
+        all_values: List[float] = []
+        for kind, values in sorted(self.latencies.items()):
+            all_values.extend(values)
+            by_kind[kind] = _latency_summary(sorted(values), elapsed)
+        total = _latency_summary(sorted(all_values), elapsed)
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "requests": total["requests"],
+            "throughput_rps": total["rps"],
+            "latency_ms": {k: total[k] for k in ("p50", "p95", "p99", "max")},
+            "by_kind": by_kind,
+            "errors": dict(sorted(self.errors.items())),
+            "error_count": sum(self.errors.values()),
+            "database_locked": self.locked,
+        }
+
+
+def _latency_summary(values: List[float], elapsed: float) -> Dict[str, Any]:
+    return {
+        "requests": len(values),
+        "rps": round(len(values) / elapsed, 1),
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "max": round((values[-1] if values else 0.0) * 1000, 2),
+    }
+
+
+class LockedErrorCounter:
+    """包在应用外层的 ASGI 中间件：统计抛出到服务端顶层的 "database is locked" 异常。
+
+    未处理异常在客户端只表现为不带细节的 500，只能在服务端一侧计数。
+    """
+
+    def __init__(self, app, stats: LoadTestStats):
+        self.app = app
+        self.stats = stats
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.app(scope, receive, send)
+        except Exception as e:
+            if LOCKED_MESSAGE in str(e):
+                self.stats.locked += 1
+            raise
+
+
+def build_app(stats: LoadTestStats) -> Any:
+    app = FastAPI()
+    fastapi_app.api_init_routes(app, enable_basic_auth=False)
+    return LockedErrorCounter(app, stats)
+
+
+def prepare_database(db_path: str, shards: int, max_devices: int) -> int:
+    """初始化压测数据库并确保压测渠道存在，返回渠道 id。"""
+    database.init_db(db_path, shard_count=shards)
+    with database.get_db_session() as db:
+        ch = db.query(models.Channel).filter(models.Channel.name == LOADTEST_CHANNEL).one_or_none()
+        if ch is None:
+            ch = models.Channel(name=LOADTEST_CHANNEL, max_devices=max_devices, license_duration_days=30)
+            db.add(ch)
+        else:
+            ch.max_devices = max_devices
+        db.commit()
+        return ch.id
+
+
+class _TrafficGenerator:
+    def __init__(self, client, channel_id: int, mix: Dict[str, int], stats: LoadTestStats, seed: Optional[int]):
+        self.client = client
+        self.channel_id = channel_id
+        self.kinds = [k for k, w in mix.items() if w > 0]
+        self.weights = [mix[k] for k in self.kinds]
+        self.stats = stats
+        self.rng = random.Random(seed)
+        self.known_devices: List[str] = []
+        self._counter = itertools.count()
+        self._run_id = f"{os.getpid()}-{int(time.time())}"
+
+    def _request(self, kind: str):
+        if kind == "repeat" and not self.known_devices:
+            kind = "new"
+        if kind == "new":
+            device_id = f"lt-{self._run_id}-{next(self._counter)}"
+            return kind, device_id, self.client.post("/api/license", json={"device_id": device_id, "channel": LOADTEST_CHANNEL})
+        if kind == "repeat":
+            device_id = self.rng.choice(self.known_devices)
+            return kind, None, self.client.post("/api/license", json={"device_id": device_id, "channel": LOADTEST_CHANNEL})
+        if kind == "list":
+            return kind, None, self.client.get("/api/devices", params={"compact": "true"})
+        return kind, None, self.client.put(
+            f"/api/channels/{self.channel_id}", json={"description": f"loadtest {next(self._counter)}"}
+        )
+
+    async def one(self, semaphore: asyncio.Semaphore, scheduled: float) -> None:
+        """发出一个请求。延迟从计划发送时间 scheduled 算起，包含等待并发名额的排队时间，
+        避免服务变慢时因发压端排队而低估延迟（coordinated omission）。"""
+        async with semaphore:
+            kind, device_id, coro = self._request(self.rng.choices(self.kinds, self.weights)[0])
+            error = None
+            try:
+                resp = await coro
+                if resp.status_code >= 400:
+                    error = f"HTTP {resp.status_code}"
+                    if LOCKED_MESSAGE in resp.text:
+                        self.stats.locked += 1
+                elif device_id is not None:
+                    self.known_devices.append(device_id)
+            except Exception as e:
+                error = type(e).__name__
+                if LOCKED_MESSAGE in str(e):
+                    self.stats.locked += 1
+            self.stats.record(kind, time.perf_counter() - scheduled, error)
+
+
+async def drive(
+    client,
+    channel_id: int,
+    rps: float,
+    duration: float,
+    mix: Dict[str, int],
+    concurrency: int,
+    stats: LoadTestStats,
+    seed: Optional[int] = None,
+) -> None:
+    """开环发压：按固定间隔发出请求，不等待前一个请求完成（并发上限为 concurrency）。"""
+    gen = _TrafficGenerator(client, channel_id, mix, stats, seed)
+    semaphore = asyncio.Semaphore(concurrency)
+    total = max(1, int(rps * duration))
+    interval = 1.0 / rps
+    tasks = []
+    stats.started = time.perf_counter()
+    for i in range(total):
+        scheduled = stats.started + i * interval
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(gen.one(semaphore, scheduled)))
+    await asyncio.gather(*tasks)
+    stats.finished = time.perf_counter()
+
+
+async def _run_in_process(app, timeout: float, **kwargs) -> None:
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=timeout) as client:
+        await drive(client, **kwargs)
+
+
+async def _run_uvicorn(app, host: str, port: int, timeout: float, **kwargs) -> None:
+    import uvicorn
+
+    config = uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="off")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, name="loadtest-uvicorn", daemon=True)
+    thread.start()
+    try:
+        while not server.started:
+            if not thread.is_alive():
+                raise RuntimeError(f"uvicorn failed to start on {host}:{port}")
+            await asyncio.sleep(0.05)
+        bound_port = server.servers[0].sockets[0].getsockname()[1]
+        limits = httpx.Limits(max_connections=kwargs["concurrency"])
+        async with httpx.AsyncClient(base_url=f"http://{host}:{bound_port}", timeout=timeout, limits=limits) as client:
+            await drive(client, **kwargs)
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+
+def run_loadtest(
+    rps: float = 100.0,
+    duration: float = 10.0,
+    mix: Optional[Dict[str, int]] = None,
+    concurrency: int = 64,
+    db_path: Optional[str] = None,
+    shards: int = 0,
+    use_uvicorn: bool = False,
+    host: str = "127.0.0.1",
+    port: int = 0,
+    keep_ratelimit: bool = False,
+    write_queue: bool = False,
+    timeout: float = 30.0,
+    seed: Optional[int] = None,
+) -> Dict[str, Any]:
+    """运行一次压测并返回统计结果（见 LoadTestStats.summary）。
+
+    Args:
+        rps: 目标每秒请求数
+        duration: 持续时间（秒）
+        mix: 流量配比 {"new", "repeat", "list", "admin"} -> 权重
+        concurrency: 同时在途的最大请求数
+        db_path: 数据库文件；None 时使用临时目录中的新库
+        use_uvicorn: 为 True 时在本地端口启动 uvicorn，否则进程内 ASGI 调用
+        keep_ratelimit: 为 False 时临时关闭许可证限流，避免重复设备请求被 429 掩盖
+        write_queue: 是否启用写入串行器
+    """
+    if httpx is None:
+        raise RuntimeError("loadtest requires httpx (pip install httpx)")
+    if rps <= 0 or duration <= 0 or concurrency <= 0:
+        raise ValueError("rps, duration and concurrency must be > 0")
+
+    mix = mix or dict(DEFAULT_MIX)
+    stats = LoadTestStats()
+    saved_limiter = ratelimit.limiter
+    tmp_dir = None
+    if db_path is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="channel-license-loadtest-")
+        db_path = os.path.join(tmp_dir.name, "loadtest.db")
+
+    try:
+        channel_id = prepare_database(db_path, shards, max_devices=int(rps * duration) + 1000)
+        if not keep_ratelimit:
+            ratelimit.limiter = ratelimit.LicenseRateLimiter(
+                ip_per_second=UNLIMITED, ip_burst=UNLIMITED, device_per_minute=UNLIMITED
+            )
+        if write_queue:
+            database.start_write_queue()
+        app = build_app(stats)
+        kwargs = dict(
+            channel_id=channel_id, rps=rps, duration=duration, mix=mix, concurrency=concurrency, stats=stats, seed=seed
+        )
+        if use_uvicorn:
+            asyncio.run(_run_uvicorn(app, host, port, timeout, **kwargs))
+        else:
+            asyncio.run(_run_in_process(app, timeout, **kwargs))
+    finally:
+        ratelimit.limiter = saved_limiter
+        if write_queue:
+            database.stop_write_queue()
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    summary = stats.summary()
+    summary["target_rps"] = rps
+    summary["mode"] = "uvicorn" if use_uvicorn else "asgi"
+    return summary
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    lines = [
+        f"mode {summary['mode']}, target {summary['target_rps']} rps, {summary['elapsed_seconds']}s elapsed",
+        f"requests {summary['requests']}, throughput {summary['throughput_rps']} rps, "
+        f"errors {summary['error_count']}, database locked {summary['database_locked']}",
+        f"{'kind':<8}{'count':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+    ]
+    total = {"requests": summary["requests"], "rps": summary["throughput_rps"], **summary["latency_ms"]}
+    rows = list(summary["by_kind"].items()) + [("total", total)]
+    for kind, s in rows:
+        lines.append(
+            f"{kind:<8}{s['requests']:>8}{s['rps']:>9}{s['p50']:>10}{s['p95']:>10}{s['p99']:>10}{s['max']:>10}"
+        )
+    for key, count in summary["errors"].items():
+        lines.append(f"  {key}: {count}")
+    return "\n".join(lines)
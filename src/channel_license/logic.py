@@ -2,13 +2,50 @@
 
 文档未指定的低层实现使用占位函数或简单实现以便演示。
 """
+import hashlib
+import logging
+import multiprocessing
+import random
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime, timedelta, timezone
-from typing import Optional, cast, Callable
+from typing import Any, Dict, List, Optional, Tuple, cast, Callable
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
 
-from . import models
+from . import database, events, models
 from .config import CURRENT_LICENSE_VERSION
-from .exceptions import ChannelNotFound, DeviceLimitExceeded
+from .exceptions import ChannelNotFound, DeviceLimitExceeded, SigningUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+def record_change(db: Session, entity_type: str, entity_id: int, op: str = "upsert") -> None:
+    """在当前事务中追加一条变更记录（entity_type: channel/device/license，op: upsert/delete）。
+
+    与业务修改一起 commit，因此变更序列只包含已提交的修改。
+    """
+    db.add(models.ChangeLog(entity_type=entity_type, entity_id=entity_id, op=op))
+
+
+def license_event_data(device: models.Device, lic: models.License) -> Dict[str, Any]:
+    """许可证相关事件的负载（shared_index 用其中的完整字段在 commit 后更新共享索引）。"""
+    channel = device.channel
+    return {
+        "device_id": device.device_id_str,
+        "device_pk": device.id,
+        "channel_id": device.channel_id,
+        "license_id": lic.id,
+        "license_key": lic.license_key,
+        "version": lic.version,
+        "request_ip": lic.request_ip,
+        "status": lic.status,
+        "created_at": lic.created_at.isoformat() if lic.created_at is not None else None,
+        "expires_at": lic.expires_at.isoformat() if lic.expires_at is not None else None,
+        "renew_at": renewal_due_at(channel, lic).isoformat() if channel is not None and lic.expires_at is not None else None,
+    }
 
 
 def find_device_by_id(db: Session, device_id_str: str) -> Optional[models.Device]:
@@ -20,7 +57,23 @@ def find_channel_by_name(db: Session, channel_name: str) -> Optional[models.Chan
 
 
 def count_devices_in_channel(db: Session, channel_id: int) -> int:
-    return db.query(models.Device).filter(models.Device.channel_id == channel_id).count()
+    """统计渠道下的设备数。
+
+    分片模式下对所有分片扇出计数：db 所在的分片用 db 本身计数（包含其尚未提交的新设备），
+    其他分片用各自的新会话。跨分片的配额检查不在同一事务中，极端并发下可能短暂超出上限。
+    """
+    if not database.is_sharded():
+        return db.query(models.Device).filter(models.Device.channel_id == channel_id).count()
+
+    own_shard = db.info.get("shard")
+    total = 0
+    for i in range(len(database.ShardSessionLocals)):
+        if i == own_shard:
+            total += db.query(models.Device).filter(models.Device.channel_id == channel_id).count()
+            continue
+        with database.get_shard_session(i) as shard_db:
+            total += shard_db.query(models.Device).filter(models.Device.channel_id == channel_id).count()
+    return total
 
 
 def find_latest_active_license_for_device(db: Session, device: models.Device) -> Optional[models.License]:
@@ -44,8 +97,22 @@ def create_new_device(db: Session, device_id_str: str, channel_id: int) -> model
     return device
 
 
-def calculate_expiry_date(license_duration_days: int) -> datetime:
-    return datetime.now() + timedelta(days=license_duration_days)
+def calculate_expiry_date(
+    license_duration_days: int, jitter_seconds: int = 0, rng: Optional[random.Random] = None
+) -> datetime:
+    """计算过期时间；jitter_seconds > 0 时在此基础上随机延后 0~jitter_seconds 秒。
+
+    同一批激活的设备因此不会在同一时刻集中过期、集中续期。
+    """
+    expires_at = datetime.now() + timedelta(days=license_duration_days)
+    if jitter_seconds > 0:
+        expires_at += timedelta(seconds=(rng or random).uniform(0, jitter_seconds))
+    return expires_at
+
+
+def renewal_due_at(channel: models.Channel, lic: models.License) -> datetime:
+    """返回该许可证进入提前续期窗口的时间点；此后的请求会签发新许可证。"""
+    return cast(datetime, lic.expires_at) - timedelta(seconds=cast(int, channel.early_renewal_seconds or 0))
 
 
 def generate_license_key(device_id: str, expires_at: datetime) -> str:
@@ -56,6 +123,149 @@ def generate_license_key(device_id: str, expires_at: datetime) -> str:
     return f"LIC::{device_id}::{int(expires_at.timestamp())}"
 
 
+def hash_license_key(key: str) -> str:
+    """返回 license key 的定长哈希（SHA-256 hex），对应 License.license_key_hash。"""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def find_licenses_by_key_hashes(db: Session, key_hashes: List[str]) -> List[models.License]:
+    """通过 license_key_hash 索引批量查找许可证（单条 IN 查询），按 id 升序返回。
+
+    key 不保证唯一，同一哈希可能对应多条许可证；调用方以 id 最大（最新）的一条为准。
+    """
+    if not key_hashes:
+        return []
+    return (
+        db.query(models.License)
+        .filter(models.License.license_key_hash.in_(key_hashes))
+        .order_by(models.License.id.asc())
+        .all()
+    )
+
+
+def backfill_license_key_hashes(db: Session, batch_size: int = 1000, pause_seconds: float = 0.0) -> int:
+    """为 license_key_hash 为空的历史记录补齐哈希，按 id 分批提交，可中断后重跑。
+
+    每批之间可暂停 pause_seconds 秒，把写锁让给在线请求。
+    返回本次补齐的行数。
+    """
+    filled = 0
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(models.License.id, models.License.license_key)
+            .where(models.License.id > last_id)
+            .where(models.License.license_key_hash.is_(None))
+            .order_by(models.License.id.asc())
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        updates = [{"id": lic_id, "license_key_hash": hash_license_key(key)} for lic_id, key in rows]
+        db.execute(update(models.License), updates)
+        filled += len(updates)
+        last_id = rows[-1][0]
+        db.commit()
+        if pause_seconds > 0:
+            time.sleep(pause_seconds)
+    return filled
+
+
+# ---- 进程池签名服务 ----
+#
+# 非对称签名（RSA/ECDSA）是 CPU 密集型操作，在请求线程上执行会受 GIL 限制并阻塞其他请求。
+# SigningService 把签名交给进程池：私钥在每个工作进程启动时由 key_loader 加载一次并常驻，
+# 请求只传递 (device_id, expires_at)。实例本身可直接作为 generate_key_fn 使用。
+
+_worker_private_key: Any = None
+
+
+def _init_signing_worker(key_loader: Optional[Callable[[], Any]]) -> None:
+    global _worker_private_key
+    _worker_private_key = key_loader() if key_loader is not None else None
+
+
+def _sign_chunk(
+    sign_fn: Callable[[Any, str, datetime], str], items: List[Tuple[str, datetime]]
+) -> List[str]:
+    return [sign_fn(_worker_private_key, device_id, expires_at) for device_id, expires_at in items]
+
+
+def placeholder_sign(private_key: Any, device_id: str, expires_at: datetime) -> str:
+    """与 generate_license_key 相同的占位签名，签名函数签名为 (private_key, device_id, expires_at)。"""
+    return generate_license_key(device_id, expires_at)
+
+
+class SigningService:
+    """进程池签名服务。
+
+    Args:
+        sign_fn: 模块级函数 (private_key, device_id, expires_at) -> str，需可被 pickle
+        key_loader: 模块级函数 () -> private_key，在每个工作进程启动时调用一次
+        max_workers: 进程数，默认 CPU 核数
+        max_pending: 同时在途的签名任务上限，超出且等待 timeout 秒仍无空位时抛出 SigningUnavailable
+        timeout: 单次签名（或批量签名整体）的超时秒数
+        chunk_size: sign_many 每个任务包含的条数
+        mp_context: multiprocessing 启动方式，默认 spawn（多线程服务中 fork 不安全）
+    """
+
+    def __init__(
+        self,
+        sign_fn: Callable[[Any, str, datetime], str] = placeholder_sign,
+        key_loader: Optional[Callable[[], Any]] = None,
+        max_workers: Optional[int] = None,
+        max_pending: int = 64,
+        timeout: float = 5.0,
+        chunk_size: int = 64,
+        mp_context: str = "spawn",
+    ):
+        self.sign_fn = sign_fn
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context(mp_context),
+            initializer=_init_signing_worker,
+            initargs=(key_loader,),
+        )
+
+    def _submit(self, items: List[Tuple[str, datetime]], deadline: float) -> Future:
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise SigningUnavailable("signing queue is full")
+        try:
+            fut = self._executor.submit(_sign_chunk, self.sign_fn, items)
+        except Exception:
+            self._slots.release()
+            raise
+        # 任务真正结束（而不是调用方超时放弃）时才释放名额，避免慢签名无限堆积
+        fut.add_done_callback(lambda _: self._slots.release())
+        return fut
+
+    def __call__(self, device_id: str, expires_at: datetime) -> str:
+        return self.sign_many([(device_id, expires_at)])[0]
+
+    def sign_many(self, items: List[Tuple[str, datetime]]) -> List[str]:
+        """批量签名：按 chunk_size 切分后并行交给各工作进程，结果顺序与输入一致。"""
+        deadline = time.monotonic() + self.timeout
+        futures: List[Future] = []
+        try:
+            for i in range(0, len(items), self.chunk_size):
+                futures.append(self._submit(items[i:i + self.chunk_size], deadline))
+            keys: List[str] = []
+            for fut in futures:
+                keys.extend(fut.result(timeout=max(0.0, deadline - time.monotonic())))
+            return keys
+        except FuturesTimeoutError:
+            raise SigningUnavailable(f"signing timed out after {self.timeout}s")
+        finally:
+            for fut in futures:
+                fut.cancel()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
 def create_new_license(
     db: Session,
     device: models.Device,
@@ -66,6 +276,7 @@ def create_new_license(
 ) -> models.License:
     lic = models.License(
         license_key=key,
+        license_key_hash=hash_license_key(key),
         version=version,
         request_ip=ip,
         expires_at=expires_at,
@@ -83,21 +294,29 @@ def process_license_request(
     channel_name: str,
     request_ip: str,
     generate_key_fn: Callable[[str, datetime], str] = generate_license_key,
+    presigned: Optional[Tuple[datetime, str]] = None,
 ) -> models.License:
     """处理许可证请求的主函数（遵循 plan.md 中的伪代码流程）。
 
     对文档未指明的低层细节采用占位实现。
+    分片模式下 db 必须是该设备所属分片的会话（见 database.session_for_device）。
+    presigned 为预先算好的 (expires_at, license_key)（见 presign_license_batch），需要签发时直接使用。
     """
+    if database.is_sharded() and db.info.get("shard") != database.shard_index(device_id_str):
+        raise ValueError(f"session does not belong to the shard of device {device_id_str}")
+
     # 1. 查询设备
     device = find_device_by_id(db, device_id_str)
 
     # 2. 如果设备已存在
     if device is not None:
         latest_license = find_latest_active_license_for_device(db, device)
-        if latest_license is not None:
-            return latest_license
-
         channel = device.channel
+        # 进入提前续期窗口的许可证不再复用，直接签发下一张（旧许可证在过期前仍然有效）
+        if latest_license is not None and datetime.now() < renewal_due_at(channel, latest_license):
+            # 本次请求没有写入；但同一会话中可能有尚未 commit 的写入（如同批次刚签发的许可证）
+            events.publish_or_queue(db, "license-reused", license_event_data(device, latest_license))
+            return latest_license
 
     else:
         # 3. 设备不存在：查找渠道
@@ -106,19 +325,26 @@ def process_license_request(
             raise ChannelNotFound(f"渠道不存在: {channel_name}")
 
         # 3.2 检查渠道设备配额
-        channel_id_int = cast(int, channel.id)
-        current_device_count = count_devices_in_channel(db, channel_id_int)
+        current_device_count = count_devices_in_channel(db, cast(int, channel.id))
         channel_max_devices_int = cast(int, channel.max_devices)
         if current_device_count >= channel_max_devices_int:
             raise DeviceLimitExceeded(f"渠道设备已达上限: {channel_name}")
 
-        # 3.3 创建新设备
-        device = create_new_device(db, device_id_str, channel_id_int)
+    # 4. 计算过期时间并签名。必须在第一次 flush 之前完成：flush 会开启写事务并持有 SQLite 写锁，
+    #    签名（可能在进程池中排队）期间持锁会让其他写请求等待甚至 "database is locked"
+    if presigned is not None:
+        expires_at, license_key_str = presigned
+    else:
+        expires_at = calculate_expiry_date(
+            cast(int, channel.license_duration_days), cast(int, channel.expiry_jitter_seconds or 0)
+        )
+        # 允许外部传入生成 key 的函数以便替换默认实现（便于测试或自定义签名）
+        license_key_str = generate_key_fn(device_id_str, expires_at)
 
-    # 4. 创建新许可证
-    expires_at = calculate_expiry_date(cast(int, channel.license_duration_days))
-    # 允许外部传入生成 key 的函数以便替换默认实现（便于测试或自定义签名）
-    license_key_str = generate_key_fn(device_id_str, expires_at)
+    # 5. 创建新设备（如需要）和新许可证
+    if device is None:
+        device = create_new_device(db, device_id_str, cast(int, channel.id))
+        record_change(db, "device", cast(int, device.id))
 
     new_license = create_new_license(
         db=db,
@@ -128,6 +354,100 @@ def process_license_request(
         ip=request_ip,
         expires_at=expires_at,
     )
+    record_change(db, "license", cast(int, new_license.id))
+    events.queue_event(db, "license-issued", license_event_data(device, new_license))
 
     # 注意：调用者负责 commit/refresh
     return new_license
+
+
+def plan_license_request(db: Session, device_id_str: str, channel_name: str) -> Optional[datetime]:
+    """只读地预判一次许可证请求：需要签发新许可证时返回其过期时间，会复用或会失败时返回 None。"""
+    device = find_device_by_id(db, device_id_str)
+    if device is not None:
+        channel = device.channel
+        latest_license = find_latest_active_license_for_device(db, device)
+        if latest_license is not None and datetime.now() < renewal_due_at(channel, latest_license):
+            return None
+    else:
+        channel = find_channel_by_name(db, channel_name)
+        if channel is None:
+            return None
+    return calculate_expiry_date(
+        cast(int, channel.license_duration_days), cast(int, channel.expiry_jitter_seconds or 0)
+    )
+
+
+class LicenseJob:
+    """写入串行器中的一次许可证请求；presigned 由 presign_license_batch 在写事务开始前填入。"""
+
+    def __init__(
+        self,
+        device_id_str: str,
+        channel_name: str,
+        request_ip: str,
+        generate_key_fn: Callable[[str, datetime], str] = generate_license_key,
+    ):
+        self.device_id_str = device_id_str
+        self.channel_name = channel_name
+        self.request_ip = request_ip
+        self.generate_key_fn = generate_key_fn
+        self.presigned: Optional[Tuple[datetime, str]] = None
+
+    def __call__(self, db: Session) -> Dict[str, int]:
+        lic = process_license_request(
+            db, self.device_id_str, self.channel_name, self.request_ip, self.generate_key_fn, self.presigned
+        )
+        return {"license_id": cast(int, lic.id), "device_id": cast(int, lic.device_id)}
+
+
+def presign_license_batch(db: Session, jobs: List[Callable[[Session], Any]]) -> Dict[int, BaseException]:
+    """写入串行器的批次预处理：在写事务之外为本批次需要新许可证的请求统一签名。
+
+    只处理 generate_key_fn 支持 sign_many（如 SigningService）的请求：用只读查询预判哪些请求
+    需要签发，再按签名函数分组批量签名。预判与实际执行不一致时（例如同批次中同一设备出现两次），
+    多余的签名结果被忽略。签名失败的请求返回 {下标: SigningUnavailable}，由写入串行器直接结束，
+    不会在写线程中回退为逐个签名。
+    """
+    groups: Dict[int, Tuple[Callable[[str, datetime], str], List[Tuple[int, LicenseJob, datetime]]]] = {}
+    for i, job in enumerate(jobs):
+        if not isinstance(job, LicenseJob) or job.presigned is not None or not hasattr(job.generate_key_fn, "sign_many"):
+            continue
+        expires_at = plan_license_request(db, job.device_id_str, job.channel_name)
+        if expires_at is not None:
+            groups.setdefault(id(job.generate_key_fn), (job.generate_key_fn, []))[1].append((i, job, expires_at))
+    # 结束只读事务，签名期间不持有任何数据库锁
+    db.rollback()
+
+    failed: Dict[int, BaseException] = {}
+    for key_fn, items in groups.values():
+        try:
+            keys = getattr(key_fn, "sign_many")([(job.device_id_str, expires_at) for _, job, expires_at in items])
+        except Exception as e:
+            logger.warning("pre-signing %d licenses failed", len(items), exc_info=True)
+            exc = e if isinstance(e, SigningUnavailable) else SigningUnavailable(f"signing failed: {e}")
+            for i, _, _ in items:
+                failed[i] = exc
+            continue
+        for (_, job, expires_at), key in zip(items, keys):
+            job.presigned = (expires_at, key)
+    return failed
+
+
+def submit_license_request(
+    device_id_str: str,
+    channel_name: str,
+    request_ip: str,
+    generate_key_fn: Callable[[str, datetime], str] = generate_license_key,
+) -> Future:
+    """通过 database.write_queue（分片模式下为设备所属分片的写入串行器）组提交一次许可证请求。
+
+    返回的 Future 在所在批次 commit 后 resolve 为 {"license_id": ..., "device_id": ...}；
+    ChannelNotFound / DeviceLimitExceeded 会原样设置到 Future 上。
+    写入串行器以支持 sign_many 的 generate_key_fn 启动时，同一批次中需要签发的许可证在写事务
+    开始前由 presign_license_batch 统一签名，签名失败时 Future 上设置 SigningUnavailable。
+    """
+    queue = database.get_write_queue(device_id_str)
+    if queue is None:
+        raise Exception("Write queue not started")
+    return queue.submit(LicenseJob(device_id_str, channel_name, request_ip, generate_key_fn))
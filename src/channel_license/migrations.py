@@ -0,0 +1,215 @@
+"""轻量的版本化 schema 迁移。
+
+数据库在 schema_meta 表中记录当前 schema 版本。启动时只读取这一个值：版本已是最新则直接返回，
+不做任何表结构反射；否则按顺序执行尚未应用的迁移，每个迁移完成后立即记录版本号。
+
+迁移必须是幂等的（可能在中途被中断后重跑），大表上的回填按主键分批提交，
+索引在回填完成后再建立，升级期间在线请求仍能在批次之间拿到写锁。
+
+多个 worker 进程同时启动时，迁移由数据库文件旁的锁文件（<db>.migrate.lock）串行化：
+拿到锁后重新读取版本号，先完成迁移的进程之外的其他进程只会看到最新版本并直接返回。
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, NamedTuple, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - 非 POSIX 平台不支持跨进程锁，退化为不加锁
+    fcntl = None
+
+from sqlalchemy import Connection, Engine, text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_META_TABLE = "schema_meta"
+
+# 分片文件不包含 channels 表，迁移按角色跳过不存在的表
+ROLE_MAIN = "main"
+ROLE_SHARD = "shard"
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class MigrationContext(NamedTuple):
+    engine: Engine
+    role: str
+    batch_size: int
+    pause_seconds: float
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[MigrationContext], None]
+
+
+def _table_exists(conn: Connection, table: str) -> bool:
+    row = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table}
+    ).first()
+    return row is not None
+
+
+def _columns(conn: Connection, table: str) -> Set[str]:
+    return {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str) -> None:
+    if _table_exists(conn, table) and column not in _columns(conn, table):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _create_index(conn: Connection, name: str, table: str, columns: str, unique: bool = False) -> None:
+    if _table_exists(conn, table):
+        conn.execute(text(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def _m1_baseline(ctx: MigrationContext) -> None:
+    # 新库：按当前模型一次建好所有表（包含之后迁移中新增的列和索引，后续迁移会自动跳过）
+    from .models import Base, Channel
+
+    tables = Base.metadata.sorted_tables
+    if ctx.role == ROLE_SHARD:
+        tables = [t for t in tables if t.name != Channel.__tablename__]
+    Base.metadata.create_all(bind=ctx.engine, tables=tables)
+
+
+def _m2_channel_rate_limit(ctx: MigrationContext) -> None:
+    with ctx.engine.begin() as conn:
+        _add_column(conn, "channels", "rate_limit_per_minute", "INTEGER")
+
+
+def _m3_channel_renewal_policy(ctx: MigrationContext) -> None:
+    with ctx.engine.begin() as conn:
+        _add_column(conn, "channels", "expiry_jitter_seconds", "INTEGER NOT NULL DEFAULT 0")
+        _add_column(conn, "channels", "early_renewal_seconds", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _m4_license_key_hash(ctx: MigrationContext) -> None:
+    from .logic import backfill_license_key_hashes
+
+    with ctx.engine.begin() as conn:
+        _add_column(conn, "licenses", "license_key_hash", "VARCHAR(64)")
+        _add_column(conn, "licenses_archive", "license_key_hash", "VARCHAR(64)")
+        _create_index(conn, "ix_licenses_archive_license_key_hash", "licenses_archive", "license_key_hash")
+    # 先分批回填，再建索引
+    with Session(bind=ctx.engine) as db:
+        filled = backfill_license_key_hashes(db, batch_size=ctx.batch_size, pause_seconds=ctx.pause_seconds)
+    if filled:
+        logger.info("backfilled license_key_hash for %d licenses", filled)
+    with ctx.engine.begin() as conn:
+        _create_index(conn, "ix_licenses_license_key_hash", "licenses", "license_key_hash")
+
+
+def _m5_hot_path_indexes(ctx: MigrationContext) -> None:
+    with ctx.engine.begin() as conn:
+        _create_index(conn, "ix_licenses_device_expires", "licenses", "device_id, expires_at")
+    with ctx.engine.begin() as conn:
+        _create_index(conn, "ix_devices_channel_id", "devices", "channel_id")
+
+
+def _index_is_unique(conn: Connection, table: str, name: str) -> bool:
+    return any(row[1] == name and row[2] for row in conn.execute(text(f"PRAGMA index_list({table})")))
+
+
+def _m6_non_unique_key_hash_index(ctx: MigrationContext) -> None:
+    # 早期版本的 4 号迁移建的是唯一索引，相同 key 的许可证会插入失败，且回填时重复 key 被留空
+    with ctx.engine.begin() as conn:
+        if _table_exists(conn, "licenses") and _index_is_unique(conn, "licenses", "ix_licenses_license_key_hash"):
+            conn.execute(text("DROP INDEX ix_licenses_license_key_hash"))
+            _create_index(conn, "ix_licenses_license_key_hash", "licenses", "license_key_hash")
+    from .logic import backfill_license_key_hashes
+
+    with Session(bind=ctx.engine) as db:
+        filled = backfill_license_key_hashes(db, batch_size=ctx.batch_size, pause_seconds=ctx.pause_seconds)
+    if filled:
+        logger.info("backfilled license_key_hash for %d licenses with duplicate keys", filled)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline schema", _m1_baseline),
+    Migration(2, "channels.rate_limit_per_minute", _m2_channel_rate_limit),
+    Migration(3, "channel renewal policy columns", _m3_channel_renewal_policy),
+    Migration(4, "licenses.license_key_hash with backfill and index", _m4_license_key_hash),
+    Migration(5, "composite indexes for license and quota lookups", _m5_hot_path_indexes),
+    Migration(6, "non-unique license_key_hash index", _m6_non_unique_key_hash_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def get_schema_version(engine: Engine) -> int:
+    """读取数据库记录的 schema 版本；没有 schema_meta 表（新库或旧版本创建的库）时返回 0。"""
+    with engine.connect() as conn:
+        if not _table_exists(conn, SCHEMA_META_TABLE):
+            return 0
+        row = conn.execute(
+            text(f"SELECT value FROM {SCHEMA_META_TABLE} WHERE key = 'schema_version'")
+        ).first()
+        return int(row[0]) if row is not None else 0
+
+
+def _set_schema_version(engine: Engine, version: int) -> None:
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {SCHEMA_META_TABLE} (key VARCHAR(64) PRIMARY KEY, value TEXT NOT NULL)"))
+        conn.execute(
+            text(
+                f"INSERT INTO {SCHEMA_META_TABLE} (key, value) VALUES ('schema_version', :v) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+            ),
+            {"v": str(version)},
+        )
+
+
+@contextmanager
+def _migration_lock(engine: Engine) -> Iterator[None]:
+    """跨进程的迁移排他锁。不使用数据库内的 BEGIN IMMEDIATE：迁移本身要在其他连接上分批提交。"""
+    path = engine.url.database
+    if fcntl is None or not path or path == ":memory:":
+        yield
+        return
+    fd = os.open(f"{path}.migrate.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def migrate(
+    engine: Engine,
+    role: str = ROLE_MAIN,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pause_seconds: float = 0.0,
+    target_version: Optional[int] = None,
+) -> int:
+    """把数据库升级到 target_version（默认最新），返回升级后的版本号。"""
+    target = LATEST_VERSION if target_version is None else target_version
+    version = get_schema_version(engine)
+    if version >= target:
+        return version
+
+    with _migration_lock(engine):
+        # 等锁期间其他进程可能已经完成了（部分）迁移
+        return _migrate_locked(engine, role, batch_size, pause_seconds, target)
+
+
+def _migrate_locked(engine: Engine, role: str, batch_size: int, pause_seconds: float, target: int) -> int:
+    version = get_schema_version(engine)
+    if version >= target:
+        return version
+
+    ctx = MigrationContext(engine, role, batch_size, pause_seconds)
+    for m in MIGRATIONS:
+        if m.version <= version or m.version > target:
+            continue
+        started = time.monotonic()
+        m.apply(ctx)
+        _set_schema_version(engine, m.version)
+        logger.info("applied migration %d (%s) in %.2fs", m.version, m.description, time.monotonic() - started)
+        version = m.version
+    return version
@@ -7,6 +7,7 @@ from sqlalchemy import (
     Text,
     DateTime,
     ForeignKey,
+    Index,
 )
 from sqlalchemy.orm import declarative_base, relationship
 
@@ -22,6 +23,11 @@ class Channel(Base):
     max_devices = Column(Integer, nullable=False, default=1000)
     license_duration_days = Column(Integer, nullable=False, default=30)
     description = Column(Text, nullable=True)
+    # 单设备许可证请求限额（次/分钟），为空时使用 config 中的默认值
+    rate_limit_per_minute = Column(Integer, nullable=True)
+    # 续期策略：过期时间随机延后 0~expiry_jitter_seconds 秒，距过期不足 early_renewal_seconds 时提前签发新许可证
+    expiry_jitter_seconds = Column(Integer, nullable=False, default=0, server_default="0")
+    early_renewal_seconds = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime, nullable=False, default=datetime.now())
 
     devices = relationship("Device", back_populates="channel", cascade="save-update")
@@ -29,6 +35,7 @@ class Channel(Base):
 
 class Device(Base):
     __tablename__ = "devices"
+    __table_args__ = (Index("ix_devices_channel_id", "channel_id"),)
 
     id = Column(Integer, primary_key=True)
     device_id_str = Column(String(255), nullable=False, unique=True, index=True)
@@ -41,9 +48,14 @@ class Device(Base):
 
 class License(Base):
     __tablename__ = "licenses"
+    # 热路径：按设备查找最新许可证（find_latest_active_license_for_device）
+    __table_args__ = (Index("ix_licenses_device_expires", "device_id", "expires_at"),)
 
     id = Column(Integer, primary_key=True)
     license_key = Column(Text, nullable=False)
+    # license_key 的 SHA-256（hex），定长且带索引，用于按 key 反查许可证
+    # 占位 key 按秒生成，同一设备同一秒内签发的 key 可能相同，因此索引不是唯一索引
+    license_key_hash = Column(String(64), nullable=True, index=True)
     version = Column(String(64), nullable=False)
     request_ip = Column(String(64), nullable=True)
     status = Column(String(32), nullable=False, default="active", index=True)
@@ -52,3 +64,34 @@ class License(Base):
     device_id = Column(Integer, ForeignKey("devices.id", ondelete="RESTRICT"), nullable=False)
 
     device = relationship("Device", back_populates="licenses")
+
+
+class LicenseArchive(Base):
+    """已被取代或早已过期的历史许可证，由 archive.archive_licenses 从 licenses 表迁移过来。
+
+    保留原 license 的 id，方便按 id 追溯。
+    """
+    __tablename__ = "licenses_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    license_key = Column(Text, nullable=False)
+    license_key_hash = Column(String(64), nullable=True, index=True)
+    version = Column(String(64), nullable=False)
+    request_ip = Column(String(64), nullable=True)
+    status = Column(String(32), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    device_id = Column(Integer, nullable=False, index=True)
+    archived_at = Column(DateTime, nullable=False)
+
+
+class ChangeLog(Base):
+    """变更序列：每次提交对 channel/device/license 的修改时记录一行，id 单调递增，作为增量同步的游标。"""
+    __tablename__ = "change_log"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    entity_type = Column(String(16), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String(16), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
@@ -0,0 +1,131 @@
+"""清理长期不活跃的设备，回收渠道配额。
+
+渠道满额（DeviceLimitExceeded）后，逐台调用 delete_device 需要成千上万次请求；
+清理任务按批选出“超过 N 天没有有效许可证”的设备，每批一个事务删除设备及其许可证。
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import and_, exists, select
+from sqlalchemy.orm import Session
+
+from . import events, logic, models
+
+DEFAULT_STALE_DAYS = 90
+DEFAULT_BATCH_SIZE = 500
+
+
+def _stale_condition(cutoff: datetime):
+    """设备不活跃的条件：创建时间早于 cutoff，且没有 status == "active" 并在 cutoff 之后仍有效的许可证。
+
+    每台设备最新的许可证始终在 licenses 热表中（归档只迁移被取代的记录），因此不需要查看归档表。
+    """
+    dev = models.Device
+    lic = models.License
+    active_since_cutoff = exists().where(
+        and_(lic.device_id == dev.id, lic.status == "active", lic.expires_at >= cutoff)
+    )
+    return and_(dev.created_at < cutoff, ~active_since_cutoff)
+
+
+def _stale_devices_query(cutoff: datetime, channel_id: Optional[int], after_id: int, limit: int):
+    """选出不活跃的设备（按 id 键集分页）。"""
+    dev = models.Device
+    q = select(dev.id, dev.device_id_str, dev.channel_id).where(_stale_condition(cutoff)).where(dev.id > after_id)
+    if channel_id is not None:
+        q = q.where(dev.channel_id == channel_id)
+    return q.order_by(dev.id).limit(limit)
+
+
+def purge_stale_devices(
+    db: Session,
+    channel_id: Optional[int] = None,
+    stale_days: int = DEFAULT_STALE_DAYS,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    dry_run: bool = False,
+    now: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    """按批删除不活跃设备及其许可证（包括归档历史），每批一个事务。
+
+    Args:
+        db: SQLAlchemy Session（分片模式下为某个分片的会话）
+        channel_id: 只清理该渠道的设备，None 表示所有渠道
+        stale_days: 没有有效许可证的天数阈值
+        batch_size: 每批删除的最大设备数，控制单个写事务的持锁时间
+        dry_run: 为 True 时只统计，不做任何修改
+
+    返回:
+        dict: {"devices": 设备数, "licenses": 许可证数, "batches": 批次数,
+               "cutoff": ISO 时间, "freed": {channel_id: 释放的配额}}
+    """
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=stale_days)
+    devices = 0
+    licenses = 0
+    batches = 0
+    freed: Dict[int, int] = {}
+    last_id = 0
+
+    while True:
+        rows = db.execute(_stale_devices_query(cutoff, channel_id, last_id, batch_size)).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        ids: List[int] = [r.id for r in rows]
+        # 不活跃设备的 id，在写事务中再次求值
+        still_stale = select(models.Device.id).where(models.Device.id.in_(ids)).where(_stale_condition(cutoff))
+
+        if dry_run:
+            archived_count = (
+                db.query(models.LicenseArchive).filter(models.LicenseArchive.device_id.in_(ids)).count()
+            )
+        else:
+            # 上面的查询不在写事务中，期间设备可能重新签发了许可证。第一条写语句获得写锁后重新应用
+            # 不活跃条件，之后的查询和删除都只针对仍然不活跃的设备，不会删除刚续期的设备
+            archived_count = (
+                db.query(models.LicenseArchive)
+                .filter(models.LicenseArchive.device_id.in_(still_stale))
+                .delete(synchronize_session=False)
+            )
+            rows = db.execute(
+                select(models.Device.id, models.Device.device_id_str, models.Device.channel_id)
+                .where(models.Device.id.in_(still_stale))
+                .order_by(models.Device.id)
+            ).all()
+            ids = [r.id for r in rows]
+
+        license_rows = db.execute(
+            select(models.License.id, models.License.device_id).where(models.License.device_id.in_(ids))
+        ).all()
+        license_ids: List[int] = [lic_id for lic_id, _ in license_rows]
+        last_license_id: Dict[int, int] = {}
+        for lic_id, dev_id in license_rows:
+            last_license_id[dev_id] = max(lic_id, last_license_id.get(dev_id, 0))
+
+        if not dry_run:
+            for lic_id in license_ids:
+                logic.record_change(db, "license", lic_id, "delete")
+            for r in rows:
+                logic.record_change(db, "device", r.id, "delete")
+                events.queue_event(
+                    db,
+                    "device-deleted",
+                    {"device_id": r.device_id_str, "channel_id": r.channel_id, "last_license_id": last_license_id.get(r.id)},
+                )
+            db.query(models.License).filter(models.License.device_id.in_(still_stale)).delete(synchronize_session=False)
+            db.query(models.Device).filter(models.Device.id.in_(still_stale)).delete(synchronize_session=False)
+            db.commit()
+
+        devices += len(rows)
+        licenses += len(license_ids) + archived_count
+        batches += 1
+        for r in rows:
+            freed[r.channel_id] = freed.get(r.channel_id, 0) + 1
+
+    return {
+        "devices": devices,
+        "licenses": licenses,
+        "batches": batches,
+        "cutoff": cutoff.isoformat(),
+        "freed": freed,
+    }
@@ -0,0 +1,214 @@
+"""许可证请求的内存令牌桶限流。
+
+按 request_ip 和 device_id_str 分别限流，单设备限额可由渠道（Channel.rate_limit_per_minute）覆盖。
+检查完全在内存中完成，不需要数据库会话；桶按 key 的哈希分片，每个分片一把锁以减少竞争。
+
+渠道限额按设备实际所属的渠道生效（由许可证事件和共享索引得知），而不是请求中客户端填写的渠道名：
+尚不知道所属渠道的设备只会因请求中的渠道名而变得更严格，不会更宽松。
+"""
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from . import events, models, shared_index
+from .config import (
+    RATE_LIMIT_DEVICE_PER_MINUTE,
+    RATE_LIMIT_IP_BURST,
+    RATE_LIMIT_IP_PER_SECOND,
+    RATE_LIMIT_SHARDS,
+)
+from .exceptions import RateLimited
+
+# 渠道限额的刷新间隔（秒）：其他 worker 进程修改渠道后，最多这么久生效
+CHANNEL_LIMIT_REFRESH_SECONDS = 60.0
+
+# 设备 -> 渠道缓存的最大条目数，超出时淘汰最早写入的条目
+DEVICE_CHANNEL_CACHE_SIZE = 100000
+
+
+class TokenBucketLimiter:
+    """分片的令牌桶集合。
+
+    每个 key 一个桶：容量 burst，每秒补充 rate 个令牌。分片内桶数量超过
+    max_keys_per_shard 时，清理已经补满（与新桶等价）的桶，限制内存占用。
+    """
+
+    def __init__(self, rate: float, burst: float, shards: int = RATE_LIMIT_SHARDS, max_keys_per_shard: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys_per_shard = max_keys_per_shard
+        self._locks = [threading.Lock() for _ in range(shards)]
+        # key -> [tokens, last_refill, rate, burst]
+        self._buckets: List[Dict[str, List[float]]] = [{} for _ in range(shards)]
+
+    def acquire(
+        self, key: str, rate: Optional[float] = None, burst: Optional[float] = None, now: Optional[float] = None
+    ) -> Tuple[bool, float]:
+        """尝试消耗一个令牌。返回 (是否允许, 建议的重试等待秒数)。"""
+        rate = self.rate if rate is None else rate
+        burst = self.burst if burst is None else burst
+        now = time.monotonic() if now is None else now
+        idx = hash(key) % len(self._locks)
+        with self._locks[idx]:
+            buckets = self._buckets[idx]
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= self.max_keys_per_shard:
+                    self._evict_full(buckets, now)
+                bucket = [burst, now, rate, burst]
+                buckets[key] = bucket
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                bucket[2] = rate
+                bucket[3] = burst
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return True, 0.0
+            return False, (1.0 - bucket[0]) / rate if rate > 0 else 60.0
+
+    @staticmethod
+    def _evict_full(buckets: Dict[str, List[float]], now: float) -> None:
+        for k in [k for k, (tokens, last, rate, burst) in buckets.items() if tokens + (now - last) * rate >= burst]:
+            del buckets[k]
+
+
+class LicenseRateLimiter:
+    """许可证请求限流器：先按 IP、再按设备检查，并统计被限流的请求数。"""
+
+    def __init__(
+        self,
+        ip_per_second: float = RATE_LIMIT_IP_PER_SECOND,
+        ip_burst: float = RATE_LIMIT_IP_BURST,
+        device_per_minute: float = RATE_LIMIT_DEVICE_PER_MINUTE,
+        shards: int = RATE_LIMIT_SHARDS,
+    ):
+        self.ip_buckets = TokenBucketLimiter(ip_per_second, ip_burst, shards)
+        self.device_buckets = TokenBucketLimiter(device_per_minute / 60.0, device_per_minute, shards)
+        self._channel_limits: Dict[str, int] = {}
+        self._channel_limits_by_id: Dict[int, int] = {}
+        # device_id_str -> 设备实际所属的 channel_id
+        self._device_channels: Dict[str, int] = {}
+        self._channel_limits_loaded_at: Optional[float] = None
+        self._refreshing = False
+        self._stats_lock = threading.Lock()
+        self._stats = {"allowed": 0, "throttled_ip": 0, "throttled_device": 0}
+
+    def set_channel_limit(self, channel_name: str, per_minute: Optional[int], channel_id: Optional[int] = None) -> None:
+        if per_minute is None:
+            self._channel_limits.pop(channel_name, None)
+            if channel_id is not None:
+                self._channel_limits_by_id.pop(channel_id, None)
+        else:
+            self._channel_limits[channel_name] = per_minute
+            if channel_id is not None:
+                self._channel_limits_by_id[channel_id] = per_minute
+
+    def load_channel_limits(self, db: Session) -> None:
+        rows = (
+            db.query(models.Channel.id, models.Channel.name, models.Channel.rate_limit_per_minute)
+            .filter(models.Channel.rate_limit_per_minute.isnot(None))
+            .all()
+        )
+        self._channel_limits = {name: limit for _, name, limit in rows}
+        self._channel_limits_by_id = {channel_id: limit for channel_id, _, limit in rows}
+        self._channel_limits_loaded_at = time.monotonic()
+
+    def note_device_channel(self, device_id_str: str, channel_id: Optional[int]) -> None:
+        """记录设备实际所属的渠道；channel_id 为 None 表示设备已删除。"""
+        if channel_id is None:
+            self._device_channels.pop(device_id_str, None)
+            return
+        if device_id_str not in self._device_channels and len(self._device_channels) >= DEVICE_CHANNEL_CACHE_SIZE:
+            try:
+                del self._device_channels[next(iter(self._device_channels))]
+            except (KeyError, StopIteration, RuntimeError):
+                pass
+        self._device_channels[device_id_str] = channel_id
+
+    def handle_event(self, ev_type: str, data: Dict[str, Any]) -> None:
+        """events.bus 监听器：从许可证事件中学习设备所属的渠道。"""
+        if ev_type in ("license-issued", "license-reused"):
+            self.note_device_channel(data["device_id"], data.get("channel_id"))
+        elif ev_type == "device-deleted":
+            self.note_device_channel(data["device_id"], None)
+
+    def _device_limit(self, device_id_str: str, channel_name: Optional[str]) -> Optional[int]:
+        """设备的每分钟限额，None 表示使用默认值。"""
+        channel_id = self._device_channels.get(device_id_str)
+        if channel_id is None and shared_index.index is not None:
+            # 其他 worker 签发的许可证：从共享索引中读取所属渠道（栅栏记录的 channel_id 为 0）
+            entry = shared_index.index.lookup(device_id_str)
+            if entry is not None and entry.channel_id:
+                channel_id = entry.channel_id
+                self.note_device_channel(device_id_str, channel_id)
+        if channel_id is not None:
+            return self._channel_limits_by_id.get(channel_id)
+        # 所属渠道未知：请求中的渠道名只能收紧默认限额
+        per_minute = self._channel_limits.get(channel_name) if channel_name else None
+        if per_minute is not None and per_minute < self.device_buckets.rate * 60.0:
+            return per_minute
+        return None
+
+    def _maybe_refresh_channel_limits(self) -> None:
+        # 在后台线程中刷新，请求路径本身不打开数据库会话
+        loaded_at = self._channel_limits_loaded_at
+        if self._refreshing or (loaded_at is not None and time.monotonic() - loaded_at < CHANNEL_LIMIT_REFRESH_SECONDS):
+            return
+        self._refreshing = True
+
+        def _refresh():
+            from . import database
+
+            try:
+                with database.get_read_db_session() as db:
+                    self.load_channel_limits(db)
+            except Exception:
+                # 数据库未就绪时沿用旧值，下次请求再试
+                self._channel_limits_loaded_at = time.monotonic()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_refresh, name="ratelimit-refresh", daemon=True).start()
+
+    def _count(self, key: str) -> None:
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def check(self, request_ip: Optional[str], device_id_str: str, channel_name: Optional[str] = None) -> None:
+        """检查一次许可证请求，超限时抛出 RateLimited。"""
+        self._maybe_refresh_channel_limits()
+
+        if request_ip:
+            ok, retry_after = self.ip_buckets.acquire(request_ip)
+            if not ok:
+                self._count("throttled_ip")
+                raise RateLimited(f"too many requests from {request_ip}", "ip", retry_after)
+
+        per_minute = self._device_limit(device_id_str, channel_name)
+        if per_minute is not None:
+            ok, retry_after = self.device_buckets.acquire(device_id_str, per_minute / 60.0, per_minute)
+        else:
+            ok, retry_after = self.device_buckets.acquire(device_id_str)
+        if not ok:
+            self._count("throttled_device")
+            raise RateLimited(f"too many requests for device {device_id_str}", "device", retry_after)
+
+        self._count("allowed")
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+limiter = LicenseRateLimiter()
+
+
+def _handle_event(ev_type: str, data: Dict[str, Any]) -> None:
+    # 转发给当前的 limiter（测试和压测会替换模块级 limiter）
+    limiter.handle_event(ev_type, data)
+
+
+events.bus.add_listener(_handle_event)
@@ -0,0 +1,375 @@
+"""多进程共享的活跃许可证索引：内存映射的定长记录哈希表。
+
+同一台机器上的多个 uvicorn worker 映射同一个文件。以 device_id_str 的 8 字节 blake2b 哈希为键，
+记录设备最新的活跃许可证（id、过期时间、续期时间点、状态以及 key 等字段），
+任一 worker 都可以不访问数据库直接答复重复设备的许可证请求。
+
+一致性：
+- 只有提交写操作的 worker 更新索引：通过 events.bus 的同步监听器，在 commit 之后处理
+  license-issued / license-reused / status-changed / device-deleted / channel-changed 事件。
+- 每条记录带一个 seqlock 序号（写入期间为奇数），读者在读前读后比较序号，不加锁；
+  写者之间用线程锁加 fcntl.flock（在没有 fcntl 的平台上只能单进程使用）。
+- 状态变更和设备删除会写入“栅栏”记录：保留已知最大的 license id 且不可用于快速路径，
+  来得较晚的旧事件（license id 不大于栅栏）会被忽略，直到签发新的许可证。
+- 索引只是缓存：key 超出预留长度、字段无法编码、探测链已满或读到写入中的记录时一律回退到数据库。
+  从备份恢复数据库后需要删除索引文件。
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, NamedTuple, Optional, Tuple
+
+from . import events
+from .config import SHARED_INDEX_CAPACITY, SHARED_INDEX_KEY_SLOT
+
+try:  # fcntl 仅在 POSIX 上可用
+    import fcntl
+except ImportError:  # pragma: no cover - 取决于运行平台
+    fcntl = None
+
+MAGIC = b"CLIDX\x00\x00\x01"
+FORMAT_VERSION = 1
+HEADER_SIZE = 64
+# magic, format version, capacity, record size, key slot
+_HEADER = struct.Struct("<8sIIII")
+# seq, state, status, key_len, key_hash, license_id, device_pk, channel_id,
+# created_at, expires_at, renew_at（微秒时间戳）, version, request_ip；其后是 key 槽
+_RECORD = struct.Struct("<IBBHQ6q32s64s")
+_SEQ = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_CHANNEL_OFFSET = 32
+
+MAX_PROBE = 32
+READ_RETRIES = 64
+
+STATE_EMPTY = 0
+STATE_LIVE = 1
+STATE_FENCE = 2
+STATUS_OTHER = 0
+STATUS_ACTIVE = 1
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_us(dt: datetime) -> int:
+    # 数据库中是本地时间的 naive datetime，按原样换算，往返不丢精度
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_us(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def _parse_dt(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def device_key_hash(device_id_str: str) -> int:
+    """设备键：device_id_str 的 8 字节 blake2b（0 保留给空槽）。"""
+    h = int.from_bytes(hashlib.blake2b(device_id_str.encode("utf-8"), digest_size=8).digest(), "little")
+    return h or 1
+
+
+class IndexEntry(NamedTuple):
+    state: int
+    status: int
+    key_hash: int
+    license_id: int
+    device_pk: int
+    channel_id: int
+    created_at: datetime
+    expires_at: datetime
+    renew_at: datetime
+    version: str
+    request_ip: str
+    license_key: str
+
+    def servable(self, now: datetime) -> bool:
+        """能否直接复用：活跃记录且尚未进入提前续期窗口（与 logic.process_license_request 的判断一致）。"""
+        return self.state == STATE_LIVE and self.status == STATUS_ACTIVE and now < self.renew_at
+
+    def license_dict(self) -> Dict[str, Any]:
+        """与 api._license_to_dict 相同的字段。"""
+        return {
+            "id": self.license_id,
+            "license_key": self.license_key,
+            "version": self.version,
+            "request_ip": self.request_ip,
+            "status": "active",
+            "created_at": self.created_at.isoformat(),
+            "expires_at": self.expires_at.isoformat(),
+            "device_id": self.device_pk,
+        }
+
+    def event_data(self, device_id_str: str) -> Dict[str, Any]:
+        """与 logic.license_event_data 相同的字段。"""
+        return {
+            "device_id": device_id_str,
+            "device_pk": self.device_pk,
+            "channel_id": self.channel_id,
+            "license_id": self.license_id,
+            "license_key": self.license_key,
+            "version": self.version,
+            "request_ip": self.request_ip,
+            "status": "active",
+            "created_at": self.created_at.isoformat(),
+            "expires_at": self.expires_at.isoformat(),
+            "renew_at": self.renew_at.isoformat(),
+        }
+
+
+class SharedLicenseIndex:
+    """映射到文件的开放寻址哈希表（线性探测，记录只覆盖不删除）。
+
+    capacity 必须是 2 的幂；同一文件的所有进程必须使用相同的 capacity / key_slot。
+    """
+
+    def __init__(self, path: str, capacity: int = SHARED_INDEX_CAPACITY, key_slot: int = SHARED_INDEX_KEY_SLOT):
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+        self.path = path
+        self.capacity = capacity
+        self.key_slot = key_slot
+        # 记录按 8 字节对齐，序号字段的读写不会跨越缓存行
+        self.record_size = (_RECORD.size + key_slot + 7) // 8 * 8
+        self.size = HEADER_SIZE + capacity * self.record_size
+        self.hits = 0
+        self.misses = 0
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._init_file()
+            self._mm = mmap.mmap(self._fd, self.size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _expected_header(self) -> bytes:
+        return _HEADER.pack(MAGIC, FORMAT_VERSION, self.capacity, self.record_size, self.key_slot)
+
+    def _init_file(self) -> None:
+        with self._write_lock():
+            expected = self._expected_header()
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, self.size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, expected)
+                return
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            header = os.read(self._fd, _HEADER.size)
+            if header != expected or os.fstat(self._fd).st_size != self.size:
+                # 其他进程可能正映射着这个文件，不能就地截断重建
+                raise ValueError(f"shared index {self.path} was created with different settings; delete it to rebuild")
+
+    def close(self) -> None:
+        self._mm.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        # flock 按打开的文件描述归属，同一进程内的线程还需要线程锁互斥
+        with self._thread_lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, slot: int) -> int:
+        return HEADER_SIZE + slot * self.record_size
+
+    def _read_raw(self, slot: int) -> Optional[bytes]:
+        """按 seqlock 协议读出一条记录的快照；持续读到写入中的记录时返回 None。"""
+        off = self._offset(slot)
+        mm = self._mm
+        for _ in range(READ_RETRIES):
+            seq = _SEQ.unpack_from(mm, off)[0]
+            if seq & 1:
+                continue
+            raw = mm[off:off + self.record_size]
+            if _SEQ.unpack_from(mm, off)[0] == seq and _SEQ.unpack_from(raw, 0)[0] == seq:
+                return raw
+        return None
+
+    def _decode(self, raw: bytes) -> IndexEntry:
+        (_, state, status, key_len, h, license_id, device_pk, channel_id,
+         created_us, expires_us, renew_us, version, request_ip) = _RECORD.unpack_from(raw, 0)
+        key = raw[_RECORD.size:_RECORD.size + key_len].decode("utf-8")
+        return IndexEntry(
+            state, status, h, license_id, device_pk, channel_id,
+            _from_us(created_us), _from_us(expires_us), _from_us(renew_us),
+            version.rstrip(b"\0").decode("utf-8"), request_ip.rstrip(b"\0").decode("utf-8"), key,
+        )
+
+    def _find(self, h: int) -> Optional[Tuple[int, Optional[bytes]]]:
+        """沿探测链查找 h：返回 (槽位, 记录快照)；遇到空槽返回 (空槽位, None)；探测链已满或读失败返回 None。"""
+        mask = self.capacity - 1
+        for i in range(MAX_PROBE):
+            slot = (h + i) & mask
+            raw = self._read_raw(slot)
+            if raw is None:
+                return None
+            if raw[4] == STATE_EMPTY:
+                return slot, None
+            if _RECORD.unpack_from(raw, 0)[4] == h:
+                return slot, raw
+        return None
+
+    def _write(self, slot: int, entry: IndexEntry) -> None:
+        """按 seqlock 协议写入（调用方持有写锁）：序号先变为奇数，写完后再变为偶数。"""
+        off = self._offset(slot)
+        mm = self._mm
+        seq = _SEQ.unpack_from(mm, off)[0]
+        writing = (seq + 1) & 0xFFFFFFFF
+        _SEQ.pack_into(mm, off, writing)
+        key = entry.license_key.encode("utf-8")
+        _RECORD.pack_into(
+            mm, off, writing, entry.state, entry.status, len(key), entry.key_hash,
+            entry.license_id, entry.device_pk, entry.channel_id,
+            _to_us(entry.created_at), _to_us(entry.expires_at), _to_us(entry.renew_at),
+            entry.version.encode("utf-8"), entry.request_ip.encode("utf-8"),
+        )
+        mm[off + _RECORD.size:off + _RECORD.size + len(key)] = key
+        _SEQ.pack_into(mm, off, (seq + 2) & 0xFFFFFFFF)
+
+    def _fits(self, version: str, request_ip: str, key: str) -> bool:
+        return (
+            len(version.encode("utf-8")) <= 32
+            and len(request_ip.encode("utf-8")) <= 64
+            and len(key.encode("utf-8")) <= self.key_slot
+        )
+
+    def lookup(self, device_id_str: str) -> Optional[IndexEntry]:
+        found = self._find(device_key_hash(device_id_str))
+        if found is None or found[1] is None:
+            return None
+        return self._decode(found[1])
+
+    def reusable(self, device_id_str: str, now: Optional[datetime] = None) -> Optional[IndexEntry]:
+        """返回可以直接复用的许可证记录，否则返回 None（调用方走数据库路径）。"""
+        entry = self.lookup(device_id_str)
+        if entry is not None and entry.servable(now or datetime.now()):
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, device_id_str: str, data: Dict[str, Any], issued: bool = False) -> bool:
+        """按许可证事件负载写入记录；license id 不大于现有记录（包括栅栏）时忽略。"""
+        license_id = int(data["license_id"])
+        current = self.lookup(device_id_str)
+        if current is not None and license_id <= current.license_id:
+            return False
+
+        version = data.get("version") or ""
+        request_ip = data.get("request_ip")
+        key = data.get("license_key") or ""
+        created_at = _parse_dt(data.get("created_at"))
+        expires_at = _parse_dt(data.get("expires_at"))
+        renew_at = _parse_dt(data.get("renew_at"))
+        state = STATE_LIVE
+        if (
+            data.get("status") != "active"
+            or request_ip is None
+            or None in (created_at, expires_at, renew_at)
+            or not self._fits(version, request_ip, key)
+        ):
+            state = STATE_FENCE
+        h = device_key_hash(device_id_str)
+
+        with self._write_lock():
+            found = self._find(h)
+            if found is None:
+                return False
+            slot, raw = found
+            if raw is not None:
+                current = self._decode(raw)
+                if license_id <= current.license_id:
+                    return False
+                # 新许可证比现有的更早过期时，数据库中“最新”的仍是旧许可证，只记栅栏
+                if issued and current.state == STATE_LIVE and expires_at is not None and expires_at < current.expires_at:
+                    state = STATE_FENCE
+            if state != STATE_LIVE:
+                self._write(slot, _fence_entry(h, license_id))
+                return True
+            self._write(slot, IndexEntry(
+                STATE_LIVE, STATUS_ACTIVE, h, license_id, int(data.get("device_pk") or 0), int(data.get("channel_id") or 0),
+                created_at, expires_at, renew_at, version, request_ip, key,
+            ))
+            return True
+
+    def fence(self, device_id_str: str, license_id: Optional[int] = None) -> None:
+        """使设备记录失效，并把栅栏设为已知最大的 license id（设备未被索引时也写入）。"""
+        h = device_key_hash(device_id_str)
+        with self._write_lock():
+            found = self._find(h)
+            if found is None:
+                return
+            slot, raw = found
+            fence_id = max(self._decode(raw).license_id if raw is not None else 0, license_id or 0)
+            self._write(slot, _fence_entry(h, fence_id))
+
+    def update_channel(self, channel_id: int, early_renewal_seconds: int) -> int:
+        """渠道的提前续期窗口变化后，重算该渠道下记录的 renew_at；返回更新的记录数。"""
+        updated = 0
+        with self._write_lock():
+            for slot in range(self.capacity):
+                off = self._offset(slot)
+                # 持有写锁时记录不会变化，可以直接读取
+                if self._mm[off + 4] != STATE_LIVE or _I64.unpack_from(self._mm, off + _CHANNEL_OFFSET)[0] != channel_id:
+                    continue
+                entry = self._decode(self._mm[off:off + self.record_size])
+                self._write(slot, entry._replace(renew_at=entry.expires_at - timedelta(seconds=early_renewal_seconds)))
+                updated += 1
+        return updated
+
+    def handle_event(self, ev_type: str, data: Dict[str, Any]) -> None:
+        """events.bus 监听器：在写操作 commit 之后更新索引。"""
+        if ev_type in ("license-issued", "license-reused"):
+            self.store(data["device_id"], data, issued=ev_type == "license-issued")
+        elif ev_type == "status-changed":
+            self.fence(data["device_id"], data.get("license_id"))
+        elif ev_type == "device-deleted":
+            self.fence(data["device_id"], data.get("last_license_id"))
+        elif ev_type == "channel-changed" and data.get("op") == "updated":
+            # 只有提前续期窗口变化时才需要扫描整个索引
+            channel = data["channel"]
+            early_renewal_seconds = channel.get("early_renewal_seconds") or 0
+            if data.get("old_early_renewal_seconds") != early_renewal_seconds:
+                self.update_channel(channel["id"], early_renewal_seconds)
+
+    def stats(self) -> Dict[str, int]:
+        return {"capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+
+def _fence_entry(h: int, license_id: int) -> IndexEntry:
+    return IndexEntry(STATE_FENCE, STATUS_OTHER, h, license_id, 0, 0, _EPOCH, _EPOCH, _EPOCH, "", "", "")
+
+
+# 当前进程使用的共享索引；为 None 时 api.request_license 总是访问数据库
+index: Optional[SharedLicenseIndex] = None
+
+
+def open_index(
+    path: str, capacity: int = SHARED_INDEX_CAPACITY, key_slot: int = SHARED_INDEX_KEY_SLOT
+) -> SharedLicenseIndex:
+    """打开（或创建）共享索引并注册事件监听器。每个 worker 进程调用一次。"""
+    global index
+    close_index()
+    index = SharedLicenseIndex(path, capacity, key_slot)
+    events.bus.add_listener(index.handle_event)
+    return index
+
+
+def close_index() -> None:
+    global index
+    if index is not None:
+        events.bus.remove_listener(index.handle_event)
+        index.close()
+        index = None
@@ -0,0 +1,203 @@
+"""轻量的单请求追踪：按阶段累计耗时，输出抽样的结构化日志，以及可选的 Server-Timing 响应头。
+
+Server-Timing 会向客户端（包括未认证的设备接口）暴露内部耗时和 SQL 统计，默认关闭，
+仅在调试时通过 server_timing=True 或环境变量 LICENSE_TRACE_SERVER_TIMING=1 开启。
+
+TracingMiddleware 为每个 HTTP 请求创建一个 Trace 并放进 contextvar；各阶段用 span(name) 计时，
+同名 span 的耗时和次数累加。SQL 耗时、查询数和行数通过 SQLAlchemy 全局事件自动统计。
+没有活动 Trace 时 span() 和事件回调只做一次 contextvar 读取，开销可以忽略。
+
+Starlette 在线程池中执行同步路由和依赖时会复制 context，因此线程中的 span 也会记入同一个 Trace；
+写入串行器（WriteQueue）线程中的 SQL 不在请求的 context 中，不会被统计。
+"""
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger("channel_license.trace")
+
+# 默认抽样率与慢请求阈值，可分别由环境变量 LICENSE_TRACE_SAMPLE_RATE / LICENSE_TRACE_SLOW_MS 覆盖
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_SLOW_MS = 1000.0
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("channel_license_trace", default=None)
+
+
+class Trace:
+    """一个请求的追踪数据：span 名 -> [累计秒数, 次数]，以及 SQL 查询数和行数。"""
+
+    __slots__ = ("method", "path", "started", "spans", "queries", "rows")
+
+    def __init__(self, method: str = "", path: str = ""):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.spans: Dict[str, List[float]] = {}
+        self.queries = 0
+        self.rows = 0
+
+    def add(self, name: str, seconds: float) -> None:
+        entry = self.spans.get(name)
+        if entry is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        """Server-Timing 头的值。各阶段可能相互重叠（如 hydrate 中的延迟加载也计入 sql）。"""
+        parts = []
+        for name, (seconds, count) in self.spans.items():
+            desc = f';desc="{count}x"' if count > 1 else ""
+            parts.append(f"{name};dur={seconds * 1000:.2f}{desc}")
+        if self.queries:
+            parts.append(f'sql-rows;desc="{self.queries} queries, {self.rows} rows"')
+        parts.append(f"total;dur={self.elapsed_ms():.2f}")
+        return ", ".join(parts)
+
+    def to_dict(self, status: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "status": status,
+            "total_ms": round(self.elapsed_ms(), 3),
+            "spans": {name: {"ms": round(s * 1000, 3), "count": int(c)} for name, (s, c) in self.spans.items()},
+            "queries": self.queries,
+            "rows": self.rows,
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """把代码块的耗时记入当前 Trace 的 name 阶段；没有活动 Trace 时什么也不做。"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+@contextmanager
+def start_trace(method: str = "", path: str = "") -> Iterator[Trace]:
+    """在当前 context 中开始一个新的 Trace（TracingMiddleware 之外也可用于脚本和测试）。"""
+    trace = Trace(method, path)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("trace_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _current.get()
+    if trace is None:
+        return
+    starts = conn.info.get("trace_query_start")
+    if starts:
+        trace.add("sql", time.perf_counter() - starts.pop())
+    trace.queries += 1
+    # SELECT 的 rowcount 为 -1，读取的行数由 loaded_as_persistent 统计
+    if cursor.rowcount and cursor.rowcount > 0:
+        trace.rows += cursor.rowcount
+
+
+@event.listens_for(Session, "loaded_as_persistent")
+def _loaded_as_persistent(session, instance):
+    trace = _current.get()
+    if trace is not None:
+        trace.rows += 1
+
+
+class TracedJSONResponse(JSONResponse):
+    """JSON 编码计入 encode 阶段的 JSONResponse。"""
+
+    def render(self, content: Any) -> bytes:
+        with span("encode"):
+            return super().render(content)
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class TracingMiddleware:
+    """ASGI 中间件：为每个 HTTP 请求开启 Trace，并按抽样率记录结构化日志。
+
+    超过 slow_ms 的请求总是记录。server_timing 为 True 时额外添加 Server-Timing 响应头（仅用于调试）。
+    sample_rate / slow_ms / server_timing 为 None 时从环境变量读取。
+    """
+
+    def __init__(
+        self,
+        app,
+        sample_rate: Optional[float] = None,
+        slow_ms: Optional[float] = None,
+        server_timing: Optional[bool] = None,
+    ):
+        self.app = app
+        self.sample_rate = _env_float("LICENSE_TRACE_SAMPLE_RATE", DEFAULT_SAMPLE_RATE) if sample_rate is None else sample_rate
+        self.slow_ms = _env_float("LICENSE_TRACE_SLOW_MS", DEFAULT_SLOW_MS) if slow_ms is None else slow_ms
+        self.server_timing = _env_flag("LICENSE_TRACE_SERVER_TIMING") if server_timing is None else server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(scope.get("method", ""), scope.get("path", ""))
+        token = _current.set(trace)
+        status: List[Optional[int]] = [None]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if self.server_timing:
+                    headers: List[Tuple[bytes, bytes]] = list(message.get("headers", []))
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+            if sampled or trace.elapsed_ms() >= self.slow_ms:
+                record = trace.to_dict(status[0])
+                record["sampled"] = sampled
+                logger.info(json.dumps(record, ensure_ascii=False))
@@ -1,6 +1,10 @@
 import importlib
+import time
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.exc import OperationalError
 
 
 def setup_db(tmp_path: Path):
@@ -91,3 +95,215 @@ def test_edit_license_status_and_get_all_device_licenses(tmp_path):
         # since logic.find_latest_active_license_for_device filters active & not expired,
         # after revoking latest_license may be None; but edit_license_status updated DB
         assert latest is None or latest["status"] == "revoked"
+
+
+def test_read_session_is_read_only_and_can_point_to_replica(tmp_path):
+    license_pkg = setup_db(tmp_path)
+
+    with license_pkg.database.get_db_session() as db:
+        license_pkg.api.add_channel(db, name="primary-ch")
+
+    with license_pkg.database.get_read_db_session() as rdb:
+        assert [c["name"] for c in license_pkg.api.get_all_channels(rdb)["channels"]] == ["primary-ch"]
+        with pytest.raises(OperationalError):
+            license_pkg.api.add_channel(rdb, name="should-fail")
+
+    # WAL 模式下数据可能还在 -wal 文件中，副本用在线备份生成
+    replica = tmp_path / "replica.db"
+    license_pkg.backup.backup_database(str(tmp_path / "test_license.db"), str(replica))
+    with license_pkg.database.get_db_session() as db:
+        license_pkg.api.add_channel(db, name="after-copy")
+
+    license_pkg.database.configure_read_engine(str(replica))
+    with license_pkg.database.get_read_db_session() as rdb:
+        assert [c["name"] for c in license_pkg.api.get_all_channels(rdb)["channels"]] == ["primary-ch"]
+
+
+def test_archive_moves_superseded_licenses_and_history_reads_archive(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    models = license_pkg.models
+    now = datetime.now()
+
+    with license_pkg.database.get_db_session() as db:
+        ch = models.Channel(name="arch", max_devices=5, license_duration_days=30)
+        db.add(ch)
+        db.commit()
+        dev = models.Device(device_id_str="dev-arch", channel_id=ch.id)
+        db.add(dev)
+        db.commit()
+        for i, (created_days, expires_days) in enumerate([(-400, -370), (-200, -170), (-10, 20)]):
+            db.add(models.License(
+                license_key=f"K{i}",
+                version="1",
+                status="active",
+                created_at=now + timedelta(days=created_days),
+                expires_at=now + timedelta(days=expires_days),
+                device_id=dev.id,
+            ))
+        db.commit()
+
+        res = license_pkg.api.archive_licenses(db, retention_days=90, batch_size=1)
+        assert res["success"] is True
+        assert res["archived"] == 2
+        assert res["batches"] == 2
+        assert db.query(models.License).count() == 1
+
+        # 再次运行不应有可归档记录
+        assert license_pkg.api.archive_licenses(db, retention_days=90)["archived"] == 0
+
+        hot_only = license_pkg.api.get_device_license_history(db, device_id_str="dev-arch")
+        assert [lic["license_key"] for lic in hot_only["licenses"]] == ["K2"]
+        assert "archived_licenses" not in hot_only
+
+        full = license_pkg.api.get_device_license_history(db, device_id_str="dev-arch", include_archived=True)
+        assert [lic["license_key"] for lic in full["archived_licenses"]] == ["K1", "K0"]
+
+        assert license_pkg.api.delete_device(db, device_id_str="dev-arch", force=True)["success"] is True
+        assert db.query(models.LicenseArchive).count() == 0
+
+
+def test_change_feed_returns_only_changes_since_cursor(tmp_path):
+    license_pkg = setup_db(tmp_path)
+
+    with license_pkg.database.get_db_session() as db:
+        ch_id = license_pkg.api.add_channel(db, name="feed", max_devices=10)["channel"]["id"]
+        first = license_pkg.api.get_changes(db, since=0)
+        assert [c["id"] for c in first["channels"]] == [ch_id]
+        assert first["devices"] == [] and first["licenses"] == []
+        cursor = first["next_cursor"]
+
+        lic = license_pkg.logic.process_license_request(db, "dev-feed", "feed", "1.1.1.1")
+        db.commit()
+        lic_id = lic.id
+        second = license_pkg.api.get_changes(db, since=cursor)
+        assert second["channels"] == []
+        assert [d["device_id"] for d in second["devices"]] == ["dev-feed"]
+        assert [l["id"] for l in second["licenses"]] == [lic_id]
+        cursor = second["next_cursor"]
+
+        assert license_pkg.api.get_changes(db, since=cursor)["licenses"] == []
+
+        license_pkg.api.edit_license_status(db, lic_id, "revoked")
+        license_pkg.api.delete_device(db, device_id_str="dev-feed", force=True)
+        # 本页包含 revoke 与随后的删除：只报告删除
+        third = license_pkg.api.get_changes(db, since=cursor, limit=2)
+        assert third["has_more"] is True
+        assert third["licenses"] == []
+        assert third["deleted"]["licenses"] == [lic_id]
+        rest = license_pkg.api.get_changes(db, since=third["next_cursor"])
+        assert rest["has_more"] is False
+        assert rest["deleted"]["devices"] == [second["devices"][0]["id"]]
+
+
+def test_purge_stale_devices_in_chunks_with_dry_run(tmp_path, monkeypatch):
+    license_pkg = setup_db(tmp_path)
+    models = license_pkg.models
+    now = datetime.now()
+
+    with license_pkg.database.get_db_session() as db:
+        ch = models.Channel(name="full", max_devices=5, license_duration_days=30)
+        other = models.Channel(name="other", max_devices=5, license_duration_days=30)
+        db.add_all([ch, other])
+        db.commit()
+
+        def add_device(name, channel, created_days, expires_days, status="active"):
+            dev = models.Device(device_id_str=name, channel_id=channel.id, created_at=now + timedelta(days=created_days))
+            db.add(dev)
+            db.flush()
+            if expires_days is not None:
+                db.add(models.License(
+                    license_key=f"K-{name}",
+                    version="1",
+                    status=status,
+                    created_at=now + timedelta(days=created_days),
+                    expires_at=now + timedelta(days=expires_days),
+                    device_id=dev.id,
+                ))
+
+        add_device("stale-1", ch, -200, -150)
+        add_device("stale-2", ch, -200, None)
+        add_device("revoked", ch, -200, 10, status="revoked")
+        add_device("active", ch, -200, 10)
+        add_device("new", ch, -1, None)
+        add_device("other-stale", other, -200, -150)
+        db.commit()
+
+        preview = license_pkg.api.purge_stale_devices(db, channel_name="full", stale_days=90, batch_size=2, dry_run=True)
+        assert preview["success"] is True
+        assert preview["devices"] == 3 and preview["licenses"] == 2
+        assert preview["channels"] == [
+            {"channel_id": ch.id, "name": "full", "max_devices": 5, "freed": 3, "device_count": 2}
+        ]
+        assert db.query(models.Device).count() == 6
+
+        cursor = license_pkg.api.get_changes(db, since=0)["next_cursor"]
+        res = license_pkg.api.purge_stale_devices(db, channel_name="full", stale_days=90, batch_size=2)
+        assert res["batches"] == 2
+        assert res["channels"][0]["freed"] == 3 and res["channels"][0]["device_count"] == 2
+        remaining = {d.device_id_str for d in db.query(models.Device).all()}
+        assert remaining == {"active", "new", "other-stale"}
+        assert db.query(models.License).count() == 2
+
+        changes = license_pkg.api.get_changes(db, since=cursor)
+        assert len(changes["deleted"]["devices"]) == 3
+        assert len(changes["deleted"]["licenses"]) == 2
+
+        # 选出之后又续期的设备（用不带条件的查询模拟过时的读取结果）在写事务中被排除，不会删除
+        purge = license_pkg.purge
+        monkeypatch.setattr(
+            purge,
+            "_stale_devices_query",
+            lambda cutoff, channel_id, after_id, limit: purge.select(
+                models.Device.id, models.Device.device_id_str, models.Device.channel_id
+            ).where(models.Device.id > after_id).order_by(models.Device.id).limit(limit),
+        )
+        res = license_pkg.api.purge_stale_devices(db, stale_days=90)
+        assert res["channels"] == [{"channel_id": other.id, "name": "other", "max_devices": 5, "freed": 1, "device_count": 0}]
+        assert {d.device_id_str for d in db.query(models.Device).all()} == {"active", "new"}
+        assert db.query(models.License).count() == 1
+        monkeypatch.undo()
+
+        assert license_pkg.api.purge_stale_devices(db, channel_name="missing")["success"] is False
+        assert license_pkg.api.purge_stale_devices(db, stale_days=0)["success"] is False
+
+
+def test_reissued_duplicate_license_key_is_accepted_and_lookup_returns_newest(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    api = license_pkg.api
+
+    def same_key(device_id, expires_at):
+        return f"LIC::{device_id}::fixed"
+
+    with license_pkg.database.get_db_session() as db:
+        api.add_channel(db, name="dupkey", max_devices=10)
+    first = api.request_license("dev-dup", "dupkey", "1.1.1.1", same_key)["license"]
+    with license_pkg.database.get_db_session() as db:
+        assert api.edit_license_status(db, first["id"], "revoked")["success"] is True
+    second = api.request_license("dev-dup", "dupkey", "1.1.1.1", same_key)["license"]
+    assert second["id"] > first["id"] and second["license_key"] == first["license_key"]
+
+    with license_pkg.database.get_db_session() as db:
+        found = api.get_license_by_key(db, first["license_key"])
+    assert found["license"]["id"] == second["id"]
+
+
+def test_request_license_write_queue_timeout_cancels_queued_job(tmp_path, monkeypatch):
+    license_pkg = setup_db(tmp_path)
+    with license_pkg.database.get_db_session() as db:
+        license_pkg.api.add_channel(db, name="slow", max_devices=10)
+
+    monkeypatch.setattr(license_pkg.api, "WRITE_QUEUE_TIMEOUT", 0.1)
+    license_pkg.database.start_write_queue(max_delay_ms=1)
+    try:
+        # 占住写线程，后面的请求在超时前无法开始执行
+        blocker = license_pkg.database.write_queue.submit(lambda db: time.sleep(0.5))
+        time.sleep(0.05)
+        with pytest.raises(license_pkg.exceptions.WriteQueueTimeout) as exc_info:
+            license_pkg.api.request_license("dev-slow", "slow", "1.1.1.1")
+        assert exc_info.value.cancelled is True
+        blocker.result(timeout=5)
+    finally:
+        license_pkg.database.stop_write_queue()
+
+    with license_pkg.database.get_db_session() as db:
+        assert license_pkg.logic.find_device_by_id(db, "dev-slow") is None
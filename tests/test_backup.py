@@ -0,0 +1,76 @@
+import importlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+
+def setup_db(tmp_path: Path):
+    """将 license.database 的 DATABASE_FILE_PATH 指向临时文件并初始化数据库。"""
+    import channel_license
+
+    db_file = tmp_path / "test_license.db"
+    channel_license.config.DATABASE_FILE_PATH = str(db_file)
+    importlib.reload(channel_license.database)
+    channel_license.database.init_db()
+    return channel_license
+
+
+def test_online_backup_while_issuing_licenses(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    with license_pkg.database.get_db_session() as db:
+        license_pkg.api.add_channel(db, name="bk", max_devices=100000, description="x" * 2000)
+        for i in range(300):
+            license_pkg.logic.process_license_request(db, f"dev-bk-{i}", "bk", "1.1.1.1")
+        db.commit()
+
+    stop = threading.Event()
+
+    def _writer():
+        i = 0
+        while not stop.is_set():
+            license_pkg.api.request_license(f"dev-bk-live-{i}", "bk", "2.2.2.2")
+            i += 1
+
+    writer = threading.Thread(target=_writer)
+    writer.start()
+    progress = []
+    try:
+        res = license_pkg.backup.backup_database(
+            str(tmp_path / "test_license.db"),
+            str(tmp_path / "out" / "copy.db"),
+            pages_per_step=4,
+            step_pause_seconds=0.001,
+            progress=lambda copied, total: progress.append((copied, total)),
+        )
+    finally:
+        stop.set()
+        writer.join()
+
+    assert res["integrity"] == "ok"
+    assert progress and progress[-1][0] == progress[-1][1]
+    # 同一快照内复制，写入不会让备份重启（已复制页数单调递增）
+    assert [c for c, _ in progress] == sorted(c for c, _ in progress)
+    conn = sqlite3.connect(res["destination"])
+    assert conn.execute("SELECT COUNT(*) FROM devices").fetchone()[0] >= 300
+    conn.close()
+
+
+def test_cli_snapshots_apply_retention(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    snap_dir = tmp_path / "snaps"
+    snap_dir.mkdir()
+    for stamp in ("20240101-000000", "20240102-000000", "20240103-000000"):
+        (snap_dir / f"test_license-{stamp}.db").write_bytes(b"")
+    (snap_dir / "unrelated.db").write_bytes(b"")
+
+    rc = license_pkg.cli.main([
+        "backup", "--db", str(tmp_path / "test_license.db"), "--snapshot-dir", str(snap_dir), "--keep", "2", "-q",
+    ])
+    assert rc == 0
+    names = sorted(os.listdir(snap_dir))
+    assert "unrelated.db" in names
+    kept = [n for n in names if n.startswith("test_license-")]
+    assert len(kept) == 2
+    assert "test_license-20240103-000000.db" in kept
+    assert license_pkg.backup.verify_database(str(snap_dir / kept[-1])) == "ok"
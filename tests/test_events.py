@@ -0,0 +1,71 @@
+import importlib
+from pathlib import Path
+
+
+def setup_db(tmp_path: Path):
+    """将 license.database 的 DATABASE_FILE_PATH 指向临时文件并初始化数据库。"""
+    import channel_license
+
+    db_file = tmp_path / "test_license.db"
+    channel_license.config.DATABASE_FILE_PATH = str(db_file)
+    importlib.reload(channel_license.database)
+    channel_license.database.init_db()
+    return channel_license
+
+
+def test_events_published_only_after_commit(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    bus = license_pkg.events.bus
+    sub = bus.subscribe()
+    try:
+        with license_pkg.database.get_db_session() as db:
+            license_pkg.api.add_channel(db, name="ev", max_devices=10)
+            assert [e[1] for e in sub.drain()] == ["channel-changed"]
+
+            lic = license_pkg.logic.process_license_request(db, "dev-ev", "ev", "1.1.1.1")
+            assert sub.drain() == []
+            db.commit()
+            issued = sub.drain()
+            assert [e[1] for e in issued] == ["license-issued"]
+            assert issued[0][2]["device_id"] == "dev-ev"
+
+            license_pkg.logic.process_license_request(db, "dev-ev", "ev", "1.1.1.1")
+            assert [e[1] for e in sub.drain()] == ["license-reused"]
+
+            license_pkg.logic.process_license_request(db, "dev-ev-2", "ev", "1.1.1.1")
+            db.rollback()
+            assert sub.drain() == []
+
+            # 复用同一事务中尚未 commit 的许可证（写入串行器的同一批次）：复用事件也等到 commit
+            license_pkg.logic.process_license_request(db, "dev-ev-3", "ev", "1.1.1.1")
+            license_pkg.logic.process_license_request(db, "dev-ev-3", "ev", "1.1.1.1")
+            assert sub.drain() == []
+            db.rollback()
+            assert sub.drain() == []
+
+            license_pkg.api.edit_license_status(db, lic.id, "revoked")
+            license_pkg.api.delete_device(db, device_id_str="dev-ev", force=True)
+            assert [e[1] for e in sub.drain()] == ["status-changed", "device-deleted"]
+    finally:
+        bus.unsubscribe(sub)
+
+
+def test_resume_with_last_event_id_and_bounded_buffer():
+    from channel_license import events
+
+    bus = events.EventBus(history_size=5, subscriber_buffer=2)
+    seqs = [bus.publish("license-issued", {"n": i}) for i in range(4)]
+
+    resumed = bus.subscribe(events.format_event_id(seqs[1]))
+    assert [e[2]["n"] for e in resumed.drain()] == [2, 3]
+
+    # 来自其他进程（或已超出历史窗口）的 id 需要重新同步
+    stale = bus.subscribe("deadbeef-1")
+    assert [e[1] for e in stale.drain()] == ["resync"]
+
+    slow = bus.subscribe()
+    for i in range(3):
+        bus.publish("status-changed", {"n": i})
+    drained = slow.drain()
+    assert [e[1] for e in drained] == ["resync", "status-changed", "status-changed"]
+    assert "event: status-changed" in events.format_sse(drained[-1])
@@ -0,0 +1,282 @@
+import importlib
+import json
+import logging
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+
+def setup_db(tmp_path: Path):
+    """将 license.database 的 DATABASE_FILE_PATH 指向临时文件并初始化数据库。"""
+    import channel_license
+
+    db_file = tmp_path / "test_license.db"
+    channel_license.config.DATABASE_FILE_PATH = str(db_file)
+    importlib.reload(channel_license.database)
+    channel_license.database.init_db()
+    return channel_license
+
+
+def create_client(license_pkg) -> TestClient:
+    app = FastAPI()
+    license_pkg.fastapi_app.api_init_routes(app, enable_basic_auth=False)
+    return TestClient(app)
+
+
+def test_static_assets_are_cached_and_precompressed(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    client = create_client(license_pkg)
+
+    index = client.get("/")
+    assert index.status_code == 200
+    assert index.headers["cache-control"] == "no-cache"
+    assert "static/app.js?v=" in index.text
+    assert client.get("/", headers={"If-None-Match": index.headers["etag"]}).status_code == 304
+
+    js = client.get("/static/app.js", headers={"Accept-Encoding": "gzip"})
+    assert js.status_code == 200
+    assert js.headers["content-encoding"] == "gzip"
+    assert "immutable" in js.headers["cache-control"]
+    assert "apiFetch" in js.text
+
+    again = client.get("/static/app.js", headers={"Accept-Encoding": "gzip", "If-None-Match": js.headers["etag"]})
+    assert again.status_code == 304
+
+
+def test_list_endpoints_return_304_until_data_changes(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    client = create_client(license_pkg)
+
+    first = client.get("/api/channels")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert client.get("/api/channels", headers={"If-None-Match": etag}).status_code == 304
+
+    # 不合法的续期设置被拒绝，不改变数据版本
+    bad = {"name": "bad-ch", "license_duration_days": 1, "early_renewal_seconds": 86400}
+    assert client.post("/api/channels", json=bad).status_code == 400
+    assert client.post("/api/channels", json={"name": "bad-ch", "expiry_jitter_seconds": -5}).status_code == 400
+    assert client.get("/api/channels", headers={"If-None-Match": etag}).status_code == 304
+
+    assert client.post("/api/channels", json={"name": "etag-ch"}).status_code == 200
+    ch_id = client.get("/api/channels").json()["channels"][0]["id"]
+    assert client.put(f"/api/channels/{ch_id}", json={"early_renewal_seconds": 31 * 86400}).status_code == 400
+
+    changed = client.get("/api/channels", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert [c["name"] for c in changed.json()["channels"]] == ["etag-ch"]
+
+    devices = client.get("/api/devices?include_expired=true")
+    assert client.get(
+        "/api/devices?include_expired=true", headers={"If-None-Match": devices.headers["etag"]}
+    ).status_code == 304
+
+    # 版本只取自数据库文件：另一个 worker（这里用独立的 sqlite3 连接模拟）提交后 ETag 改变，
+    # 同一份数据在任何进程中算出的 ETag 相同
+    etag = client.get("/api/channels").headers["etag"]
+    conn = sqlite3.connect(str(tmp_path / "test_license.db"))
+    conn.execute("UPDATE channels SET description = 'other worker'")
+    conn.commit()
+    conn.close()
+    assert client.get("/api/channels", headers={"If-None-Match": etag}).status_code == 200
+    version = license_pkg.database.get_data_version()
+    code = (
+        "import sys; from channel_license import database as d; "
+        "d._read_database_file_path = sys.argv[1]; print(d.get_data_version())"
+    )
+    out = subprocess.run([sys.executable, "-c", code, str(tmp_path / "test_license.db")], capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == version
+
+
+def test_license_lookup_by_key_and_bulk(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    client = create_client(license_pkg)
+
+    with license_pkg.database.get_db_session() as db:
+        db.add(license_pkg.models.Channel(name="keys", max_devices=10, license_duration_days=7))
+        db.commit()
+        keys = []
+        for i in range(3):
+            lic = license_pkg.logic.process_license_request(db, f"dev-key-{i}", "keys", "1.1.1.1")
+            db.commit()
+            keys.append(lic.license_key)
+            assert lic.license_key_hash == license_pkg.logic.hash_license_key(lic.license_key)
+
+    single = client.get("/api/licenses/by-key", params={"key": keys[1]})
+    assert single.status_code == 200
+    assert single.json()["license"]["license_key"] == keys[1]
+    assert client.get("/api/licenses/by-key", params={"key": "nope"}).status_code == 404
+
+    bulk = client.post("/api/licenses/lookup", json={"keys": keys + ["nope"]})
+    assert bulk.status_code == 200
+    body = bulk.json()
+    assert body["found"] == 3 and body["missing"] == 1
+    assert body["licenses"]["nope"] is None
+    assert body["licenses"][keys[0]]["license_key"] == keys[0]
+
+
+def test_license_endpoint_rate_limits_before_db(tmp_path, monkeypatch):
+    license_pkg = setup_db(tmp_path)
+    limiter = license_pkg.ratelimit.LicenseRateLimiter(ip_per_second=1000, ip_burst=1000, device_per_minute=2)
+    monkeypatch.setattr(license_pkg.ratelimit, "limiter", limiter)
+    client = create_client(license_pkg)
+
+    assert client.post("/api/channels", json={"name": "rl"}).status_code == 200
+    assert client.post("/api/channels", json={"name": "rl-strict", "rate_limit_per_minute": 1}).status_code == 200
+
+    for _ in range(2):
+        ok = client.post("/api/license", json={"device_id": "dev-rl", "channel": "rl"})
+        assert ok.status_code == 200
+        assert ok.json()["license"]["status"] == "active"
+
+    # 第三次请求在打开数据库会话之前就被拒绝
+    def _no_db():
+        raise AssertionError("database session opened for a throttled request")
+
+    with monkeypatch.context() as m:
+        m.setattr(license_pkg.database, "SessionLocal", _no_db)
+        throttled = client.post("/api/license", json={"device_id": "dev-rl", "channel": "rl"})
+    assert throttled.status_code == 429
+    assert int(throttled.headers["retry-after"]) >= 1
+
+    # 渠道限额覆盖默认单设备限额
+    assert client.post("/api/license", json={"device_id": "dev-strict", "channel": "rl-strict"}).status_code == 200
+    assert client.post("/api/license", json={"device_id": "dev-strict", "channel": "rl-strict"}).status_code == 429
+
+    # 限额按设备实际所属的渠道生效：换用更宽松的渠道名不会改变桶的速率和容量
+    assert client.post("/api/channels", json={"name": "rl-lax", "rate_limit_per_minute": 600}).status_code == 200
+    for name in ("rl-lax", "rl-strict", "rl-lax"):
+        assert client.post("/api/license", json={"device_id": "dev-strict", "channel": name}).status_code == 429
+    assert limiter._device_limit("dev-strict", "rl-lax") == 1
+    # 所属渠道未知的设备只会被请求中的渠道名收紧，不会放宽
+    assert limiter._device_limit("dev-new", "rl-lax") is None
+    assert limiter._device_limit("dev-new", "rl-strict") == 1
+
+    assert client.post("/api/license", json={"device_id": "dev-x", "channel": "missing"}).status_code == 404
+    stats = client.get("/api/ratelimit/stats").json()["stats"]
+    assert stats["throttled_device"] == 5
+
+
+def test_list_devices_compact_and_field_projection(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    client = create_client(license_pkg)
+
+    assert client.post("/api/channels", json={"name": "compact"}).status_code == 200
+    for i in range(3):
+        assert client.post("/api/license", json={"device_id": f"dev-c-{i}", "channel": "compact"}).status_code == 200
+
+    full = client.get("/api/devices")
+    compact = client.get("/api/devices", params={"compact": "true", "fields": "id,expires_at,status"})
+    assert compact.status_code == 200
+    assert compact.headers["etag"] != full.headers["etag"]
+
+    body = compact.json()
+    assert list(body["channels"]) == [str(body["devices"][0]["channel_id"])]
+    assert body["channels"][str(body["devices"][0]["channel_id"])]["name"] == "compact"
+    for d in body["devices"]:
+        assert "channel" not in d
+        assert set(d["latest_license"]) == {"id", "expires_at", "status"}
+
+    bare = client.get("/api/devices", params={"fields": ""}).json()
+    assert len(bare["devices"]) == 3
+    assert all("latest_license" not in d for d in bare["devices"])
+    assert "channels" not in bare
+
+    assert client.get("/api/devices", params={"fields": "id,bogus"}).status_code == 400
+
+
+def test_loadtest_drives_app_in_process(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    limiter = license_pkg.ratelimit.limiter
+
+    summary = license_pkg.loadtest.run_loadtest(
+        rps=50, duration=0.4, mix=license_pkg.loadtest.parse_mix("new=1,repeat=1,list=1,admin=1"),
+        db_path=str(tmp_path / "loadtest.db"), seed=7,
+    )
+    assert summary["requests"] == 20
+    assert summary["error_count"] == 0 and summary["database_locked"] == 0
+    assert set(summary["by_kind"]) <= {"new", "repeat", "list", "admin"}
+    assert summary["latency_ms"]["p50"] <= summary["latency_ms"]["p99"]
+    assert license_pkg.ratelimit.limiter is limiter
+
+
+def test_server_timing_header_and_sampled_trace_log(tmp_path, monkeypatch, caplog):
+    license_pkg = setup_db(tmp_path)
+    monkeypatch.setenv("LICENSE_TRACE_SAMPLE_RATE", "1")
+
+    # 默认不向客户端暴露 Server-Timing
+    default_client = create_client(license_pkg)
+    assert default_client.post("/api/channels", json={"name": "trace"}).status_code == 200
+    issued = default_client.post("/api/license", json={"device_id": "dev-trace", "channel": "trace"})
+    assert issued.status_code == 200 and "server-timing" not in issued.headers
+
+    app = FastAPI()
+    license_pkg.fastapi_app.api_init_routes(app, enable_basic_auth=False, server_timing=True)
+    client = TestClient(app)
+
+    with caplog.at_level(logging.INFO, logger="channel_license.trace"):
+        resp = client.get("/api/devices")
+    assert resp.status_code == 200
+    timing = resp.headers["server-timing"]
+    for stage in ("session", "api", "sql", "hydrate", "encode", "total"):
+        assert f"{stage};dur=" in timing
+
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record["path"] == "/api/devices" and record["status"] == 200
+    assert record["sampled"] is True
+    assert record["queries"] >= 2 and record["rows"] >= 2
+    assert record["spans"]["hydrate"]["count"] == 1
+
+    # 没有活动 Trace 时 span 不记录任何内容
+    with license_pkg.tracing.span("noop"):
+        pass
+    assert license_pkg.tracing.current_trace() is None
+
+
+def test_sharded_mode_fans_out_device_reads(tmp_path):
+    import channel_license as license_pkg
+
+    license_pkg.config.DATABASE_FILE_PATH = str(tmp_path / "test_license.db")
+    importlib.reload(license_pkg.database)
+    license_pkg.database.init_db(shard_count=2)
+    client = create_client(license_pkg)
+
+    assert client.post("/api/channels", json={"name": "sh"}).status_code == 200
+    issued = {}
+    for i in range(4):
+        res = client.post("/api/license", json={"device_id": f"dev-sh-{i}", "channel": "sh"})
+        assert res.status_code == 200
+        issued[f"dev-sh-{i}"] = res.json()["license"]
+    key = issued["dev-sh-1"]["license_key"]
+
+    by_key = client.get("/api/licenses/by-key", params={"key": key})
+    assert by_key.status_code == 200 and by_key.json()["license"]["license_key"] == key
+    lookup = client.post("/api/licenses/lookup", json={"keys": [lic["license_key"] for lic in issued.values()] + ["nope"]})
+    assert lookup.json()["found"] == 4 and lookup.json()["missing"] == 1
+
+    history = client.get("/api/devices/licenses", params={"device_id_str": "dev-sh-2"})
+    assert history.status_code == 200
+    assert [lic["id"] for lic in history.json()["licenses"]] == [issued["dev-sh-2"]["id"]]
+    assert client.get("/api/devices/licenses", params={"device_id": 1}).status_code == 400
+
+    changes = client.get("/api/changes").json()
+    assert [c["name"] for c in changes["channels"]] == ["sh"]
+    assert sorted(d["device_id"] for d in changes["devices"]) == sorted(issued)
+    assert sorted(d["shard"] for d in changes["devices"]) == sorted(
+        license_pkg.database.shard_index(d) for d in issued
+    )
+    assert len(changes["licenses"]) == 4
+    cursor = changes["next_cursor"]
+    assert cursor.startswith("main:")
+    assert client.post("/api/license", json={"device_id": "dev-sh-new", "channel": "sh"}).status_code == 200
+    again = client.get("/api/changes", params={"since": cursor}).json()
+    assert [d["device_id"] for d in again["devices"]] == ["dev-sh-new"]
+    assert client.get("/api/changes", params={"since": "bogus"}).status_code == 400
+
+    archived = client.post("/api/licenses/archive", params={"retention_days": 0})
+    assert archived.status_code == 200 and "archived" in archived.json()
@@ -1,5 +1,7 @@
 import importlib
+import sqlite3
 import tempfile
+import time
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 
@@ -131,3 +133,291 @@ def test_channel_not_found_raises(tmp_path):
     with license_pkg.database.get_db_session() as db:
         with pytest.raises(license_pkg.exceptions.ChannelNotFound):
             license_pkg.logic.process_license_request(db, "dev-nochan", "no-such-channel", "8.8.8.8")
+
+
+def test_write_queue_group_commits_and_keeps_semantics(tmp_path):
+    license_pkg = setup_db(tmp_path)
+
+    with license_pkg.database.get_db_session() as db:
+        db.add(license_pkg.models.Channel(name="batch", max_devices=3, license_duration_days=7))
+        db.commit()
+
+    license_pkg.database.start_write_queue(max_batch=16, max_delay_ms=20)
+    try:
+        futures = [
+            license_pkg.logic.submit_license_request(f"dev-q-{i}", "batch", "1.1.1.1") for i in range(4)
+        ]
+        repeat = license_pkg.logic.submit_license_request("dev-q-0", "batch", "1.1.1.1")
+        missing = license_pkg.logic.submit_license_request("dev-q-x", "no-such-channel", "1.1.1.1")
+
+        ids = [f.result(timeout=5) for f in futures[:3]]
+        with pytest.raises(license_pkg.exceptions.DeviceLimitExceeded):
+            futures[3].result(timeout=5)
+        with pytest.raises(license_pkg.exceptions.ChannelNotFound):
+            missing.result(timeout=5)
+        assert repeat.result(timeout=5) == ids[0]
+    finally:
+        license_pkg.database.stop_write_queue()
+
+    with license_pkg.database.get_db_session() as db:
+        assert db.query(license_pkg.models.Device).count() == 3
+        assert db.query(license_pkg.models.License).count() == 3
+
+
+def test_init_db_backfills_key_hash_on_legacy_database(tmp_path):
+    db_file = tmp_path / "test_license.db"
+    conn = sqlite3.connect(db_file)
+    conn.executescript(
+        """
+        CREATE TABLE channels (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL UNIQUE, max_devices INTEGER NOT NULL,
+            license_duration_days INTEGER NOT NULL, description TEXT, created_at DATETIME NOT NULL);
+        CREATE TABLE devices (id INTEGER PRIMARY KEY, device_id_str VARCHAR(255) NOT NULL UNIQUE,
+            channel_id INTEGER NOT NULL, created_at DATETIME NOT NULL);
+        CREATE TABLE licenses (id INTEGER PRIMARY KEY, license_key TEXT NOT NULL, version VARCHAR(64) NOT NULL,
+            request_ip VARCHAR(64), status VARCHAR(32) NOT NULL, created_at DATETIME NOT NULL,
+            expires_at DATETIME NOT NULL, device_id INTEGER NOT NULL);
+        INSERT INTO channels VALUES (1, 'legacy', 10, 7, NULL, '2024-01-01 00:00:00');
+        INSERT INTO devices VALUES (1, 'dev-legacy', 1, '2024-01-01 00:00:00');
+        INSERT INTO licenses VALUES (1, 'KEY-A', '1', NULL, 'active', '2024-01-01 00:00:00', '2024-01-08 00:00:00', 1);
+        INSERT INTO licenses VALUES (2, 'KEY-B', '1', NULL, 'active', '2024-01-08 00:00:00', '2024-01-15 00:00:00', 1);
+        """
+    )
+    conn.commit()
+    conn.close()
+
+    license_pkg = setup_db(tmp_path)
+
+    with license_pkg.database.get_db_session() as db:
+        hashes = dict(db.query(license_pkg.models.License.license_key, license_pkg.models.License.license_key_hash).all())
+        assert hashes == {
+            "KEY-A": license_pkg.logic.hash_license_key("KEY-A"),
+            "KEY-B": license_pkg.logic.hash_license_key("KEY-B"),
+        }
+
+
+def test_expiry_jitter_and_early_renewal(tmp_path):
+    license_pkg = setup_db(tmp_path)
+
+    with license_pkg.database.get_db_session() as db:
+        ch = license_pkg.models.Channel(
+            name="renew", max_devices=100, license_duration_days=1,
+            expiry_jitter_seconds=3600, early_renewal_seconds=0,
+        )
+        db.add(ch)
+        db.commit()
+
+    with license_pkg.database.get_db_session() as db:
+        base = datetime.now() + timedelta(days=1)
+        expiries = []
+        for i in range(20):
+            lic = license_pkg.logic.process_license_request(db, f"dev-wave-{i}", "renew", "1.1.1.1")
+            db.commit()
+            expiries.append(lic.expires_at)
+        assert all(base <= e <= base + timedelta(seconds=3601) for e in expiries)
+        assert len(set(expiries)) > 1
+
+        # 续期窗口外复用已有许可证
+        first_id = license_pkg.logic.find_device_by_id(db, "dev-wave-0").licenses[0].id
+        reused = license_pkg.logic.process_license_request(db, "dev-wave-0", "renew", "1.1.1.1")
+        assert reused.id == first_id
+
+        # 有效期改为 30 天、续期窗口 2 天：剩余不足 2 天的旧许可证进入续期窗口，提前签发新许可证
+        assert license_pkg.api.edit_channel(
+            db, channel_name="renew", license_duration_days=30, early_renewal_seconds=2 * 86400
+        )["success"] is True
+        renewed = license_pkg.logic.process_license_request(db, "dev-wave-0", "renew", "1.1.1.1")
+        db.commit()
+        assert renewed.id != first_id
+        assert renewed.expires_at >= datetime.now() + timedelta(days=29)
+
+        # 续期窗口必须小于有效期，抖动不能为负
+        assert license_pkg.api.edit_channel(db, channel_name="renew", early_renewal_seconds=30 * 86400)["success"] is False
+        assert license_pkg.api.edit_channel(db, channel_name="renew", license_duration_days=2)["success"] is False
+        assert license_pkg.api.edit_channel(db, channel_name="renew", expiry_jitter_seconds=-1)["success"] is False
+        assert license_pkg.api.add_channel(db, name="bad", license_duration_days=1, early_renewal_seconds=86400)["success"] is False
+        assert license_pkg.api.add_channel(db, name="bad", early_renewal_seconds=-1)["success"] is False
+        assert license_pkg.logic.find_channel_by_name(db, "renew").license_duration_days == 30
+        assert license_pkg.logic.find_channel_by_name(db, "bad") is None
+
+        before_count = db.query(license_pkg.models.License).count()
+        again = license_pkg.logic.process_license_request(db, "dev-wave-0", "renew", "1.1.1.1")
+        db.commit()
+        assert db.query(license_pkg.models.License).count() == before_count
+        assert again.id == renewed.id
+
+
+def test_sharded_storage_routes_devices_and_fans_out(tmp_path):
+    import channel_license as license_pkg
+
+    license_pkg.config.DATABASE_FILE_PATH = str(tmp_path / "test_license.db")
+    importlib.reload(license_pkg.database)
+    license_pkg.database.init_db(shard_count=3)
+    assert all((tmp_path / f"test_license.shard{i}.db").exists() for i in range(3))
+
+    with license_pkg.database.get_db_session() as db:
+        license_pkg.api.add_channel(db, name="sharded", max_devices=10, license_duration_days=7)
+
+    for i in range(10):
+        res = license_pkg.api.request_license(f"dev-shard-{i}", "sharded", "1.1.1.1")
+        assert res["success"] is True
+
+    # 配额在所有分片上合计检查
+    with pytest.raises(license_pkg.exceptions.DeviceLimitExceeded):
+        license_pkg.api.request_license("dev-shard-overflow", "sharded", "1.1.1.1")
+
+    per_shard = []
+    for i in range(3):
+        with license_pkg.database.get_shard_session(i) as db:
+            per_shard.append(db.query(license_pkg.models.Device).count())
+    assert sum(per_shard) == 10
+    assert sum(1 for n in per_shard if n > 0) > 1
+
+    listed = license_pkg.api.get_all_device_licenses_with_session()["devices"]
+    assert sorted(d["device_id"] for d in listed) == sorted(f"dev-shard-{i}" for i in range(10))
+    assert all(d["channel"]["name"] == "sharded" for d in listed)
+    assert all(d["shard"] == license_pkg.database.shard_index(d["device_id"]) for d in listed)
+
+    # 使用错误分片的会话会被拒绝
+    wrong = (license_pkg.database.shard_index("dev-shard-0") + 1) % 3
+    with license_pkg.database.get_shard_session(wrong) as db:
+        with pytest.raises(ValueError):
+            license_pkg.logic.process_license_request(db, "dev-shard-0", "sharded", "1.1.1.1")
+
+    # 渠道删除和许可证状态修改同样需要看到分片中的数据
+    with license_pkg.database.get_db_session() as db:
+        assert license_pkg.api.delete_channel(db, channel_name="sharded")["success"] is False
+    lic_id = next(d for d in listed if d["device_id"] == "dev-shard-1")["latest_license"]["id"]
+    assert license_pkg.api.edit_license_status_with_session(lic_id, "revoked")["success"] is False
+    res = license_pkg.api.edit_license_status_with_session(lic_id, "revoked", device_id_str="dev-shard-1")
+    assert res["success"] is True and res["license"]["status"] == "revoked"
+
+    res = license_pkg.api.delete_device_with_session(device_id_str="dev-shard-3", force=True)
+    assert res["success"] is True
+    assert len(license_pkg.api.get_all_device_licenses_with_session()["devices"]) == 9
+
+    license_pkg.database.start_write_queue(max_delay_ms=1)
+    try:
+        assert license_pkg.api.request_license("dev-shard-q", "sharded", "1.1.1.1")["success"] is True
+    finally:
+        license_pkg.database.stop_write_queue()
+
+
+def _test_key_loader():
+    return "test-private-key"
+
+
+def _test_sign(private_key, device_id, expires_at):
+    return f"SIG[{private_key}]::{device_id}::{int(expires_at.timestamp())}"
+
+
+def _slow_sign(private_key, device_id, expires_at):
+    time.sleep(2)
+    return "late"
+
+
+def test_signing_service_offloads_to_process_pool(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    logic = license_pkg.logic
+    service = logic.SigningService(_test_sign, key_loader=_test_key_loader, max_workers=2, chunk_size=3, timeout=30)
+    try:
+        expires = datetime(2030, 1, 1)
+        items = [(f"dev-sig-{i}", expires) for i in range(10)]
+        keys = service.sign_many(items)
+        assert keys == [_test_sign("test-private-key", d, e) for d, e in items]
+
+        with license_pkg.database.get_db_session() as db:
+            db.add(license_pkg.models.Channel(name="sig", max_devices=10, license_duration_days=7))
+            db.commit()
+            lic = logic.process_license_request(db, "dev-sig", "sig", "1.1.1.1", generate_key_fn=service)
+            assert lic.license_key.startswith("SIG[test-private-key]::dev-sig::")
+    finally:
+        service.shutdown()
+
+    slow = logic.SigningService(_slow_sign, max_workers=1, max_pending=1, timeout=0.2)
+    try:
+        with pytest.raises(license_pkg.exceptions.SigningUnavailable):
+            slow("dev-slow", datetime(2030, 1, 1))
+        # 超时的任务仍占用名额，队列已满
+        with pytest.raises(license_pkg.exceptions.SigningUnavailable):
+            slow("dev-slow-2", datetime(2030, 1, 1))
+    finally:
+        slow.shutdown(wait=False)
+
+
+class _RecordingSigner:
+    """记录调用方式的签名函数：sign_many 批量签名，单个调用计数。"""
+
+    def __init__(self):
+        self.batches = []
+        self.single = 0
+
+    def __call__(self, device_id, expires_at):
+        self.single += 1
+        return f"one::{device_id}"
+
+    def sign_many(self, items):
+        self.batches.append([d for d, _ in items])
+        return [f"many::{d}" for d, _ in items]
+
+
+def test_write_queue_presigns_batch_with_sign_many(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    with license_pkg.database.get_db_session() as db:
+        db.add(license_pkg.models.Channel(name="presign", max_devices=10, license_duration_days=7))
+        db.commit()
+
+    signer = _RecordingSigner()
+    license_pkg.database.start_write_queue(max_batch=16, max_delay_ms=50, generate_key_fn=signer)
+    try:
+        futures = [
+            license_pkg.logic.submit_license_request(f"dev-ps-{i}", "presign", "1.1.1.1", generate_key_fn=signer)
+            for i in range(5)
+        ]
+        results = [f.result(timeout=5) for f in futures]
+        # 已有有效许可证的设备复用，不再签名
+        again = license_pkg.logic.submit_license_request("dev-ps-0", "presign", "1.1.1.1", generate_key_fn=signer)
+        assert again.result(timeout=5) == results[0]
+    finally:
+        license_pkg.database.stop_write_queue()
+
+    assert signer.single == 0
+    assert sorted(d for batch in signer.batches for d in batch) == [f"dev-ps-{i}" for i in range(5)]
+    with license_pkg.database.get_db_session() as db:
+        keys = {lic.license_key for lic in db.query(license_pkg.models.License).all()}
+    assert keys == {f"many::dev-ps-{i}" for i in range(5)}
+
+
+class _FailingSigner(_RecordingSigner):
+    def sign_many(self, items):
+        self.batches.append([d for d, _ in items])
+        raise RuntimeError("pool saturated")
+
+
+def test_write_queue_presign_failure_skips_jobs_without_inline_signing(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    with license_pkg.database.get_db_session() as db:
+        db.add(license_pkg.models.Channel(name="presign-fail", max_devices=10, license_duration_days=7))
+        db.commit()
+
+    # 默认的廉价签名函数不安装预签名
+    license_pkg.database.start_write_queue()
+    assert license_pkg.database.write_queue.prepare_batch is None
+    license_pkg.database.stop_write_queue()
+
+    signer = _FailingSigner()
+    license_pkg.database.start_write_queue(max_batch=16, max_delay_ms=50, generate_key_fn=signer)
+    try:
+        futures = [
+            license_pkg.logic.submit_license_request(f"dev-pf-{i}", "presign-fail", "1.1.1.1", generate_key_fn=signer)
+            for i in range(4)
+        ]
+        for f in futures:
+            with pytest.raises(license_pkg.exceptions.SigningUnavailable):
+                f.result(timeout=5)
+    finally:
+        license_pkg.database.stop_write_queue()
+
+    # 失败的请求不进入写事务，也不在写线程中逐个补签
+    assert signer.single == 0
+    with license_pkg.database.get_db_session() as db:
+        assert db.query(license_pkg.models.Device).count() == 0
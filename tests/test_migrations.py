@@ -0,0 +1,104 @@
+import importlib
+import subprocess
+import sys
+from pathlib import Path
+
+from sqlalchemy import create_engine, text
+
+
+def setup_db(tmp_path: Path):
+    """将 license.database 的 DATABASE_FILE_PATH 指向临时文件并初始化数据库。"""
+    import channel_license
+
+    db_file = tmp_path / "test_license.db"
+    channel_license.config.DATABASE_FILE_PATH = str(db_file)
+    importlib.reload(channel_license.database)
+    channel_license.database.init_db()
+    return channel_license
+
+
+def test_fresh_database_is_stamped_and_restart_skips_schema_work(tmp_path, monkeypatch):
+    license_pkg = setup_db(tmp_path)
+    migrations = license_pkg.migrations
+    engine = license_pkg.database.engine
+
+    assert migrations.get_schema_version(engine) == migrations.LATEST_VERSION
+    with engine.connect() as conn:
+        indexes = {row[1] for row in conn.execute(text("PRAGMA index_list(licenses)"))}
+    assert {"ix_licenses_device_expires", "ix_licenses_license_key_hash"} <= indexes
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("schema work on an up-to-date database")
+
+    monkeypatch.setattr(license_pkg.models.Base.metadata, "create_all", _fail)
+    monkeypatch.setattr(migrations, "MIGRATIONS", [migrations.Migration(1, "boom", _fail)])
+    importlib.reload(license_pkg.database)
+    license_pkg.database.init_db()
+    assert migrations.migrate(license_pkg.database.engine) == migrations.LATEST_VERSION
+
+
+def test_interrupted_backfill_resumes_from_recorded_version(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    migrations = license_pkg.migrations
+
+    with license_pkg.database.get_db_session() as db:
+        license_pkg.api.add_channel(db, name="mig", max_devices=100)
+        for i in range(25):
+            license_pkg.logic.process_license_request(db, f"dev-mig-{i}", "mig", "1.1.1.1")
+        db.commit()
+
+    # 模拟升级到一半：哈希被清空、索引尚未建立、版本停在 3
+    engine = create_engine(f"sqlite:///{tmp_path / 'test_license.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_licenses_license_key_hash"))
+        conn.execute(text("UPDATE licenses SET license_key_hash = NULL WHERE id > 10"))
+        conn.execute(text("UPDATE schema_meta SET value = '3' WHERE key = 'schema_version'"))
+
+    assert migrations.migrate(engine, batch_size=4) == migrations.LATEST_VERSION
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM licenses WHERE license_key_hash IS NULL")).scalar() == 0
+        indexes = {row[1] for row in conn.execute(text("PRAGMA index_list(licenses)"))}
+    assert "ix_licenses_license_key_hash" in indexes
+
+
+def test_unique_key_hash_index_is_relaxed_and_duplicates_backfilled(tmp_path):
+    license_pkg = setup_db(tmp_path)
+    migrations = license_pkg.migrations
+
+    with license_pkg.database.get_db_session() as db:
+        license_pkg.api.add_channel(db, name="dup", max_devices=10)
+        for i in range(2):
+            license_pkg.logic.process_license_request(db, f"dev-dup-{i}", "dup", "1.1.1.1", lambda d, e: "SAME-KEY")
+        db.commit()
+
+    # 早期版本：唯一索引，重复 key 的第二条许可证没有哈希
+    engine = create_engine(f"sqlite:///{tmp_path / 'test_license.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE licenses SET license_key_hash = NULL WHERE id = 2"))
+        conn.execute(text("DROP INDEX ix_licenses_license_key_hash"))
+        conn.execute(text("CREATE UNIQUE INDEX ix_licenses_license_key_hash ON licenses (license_key_hash)"))
+        conn.execute(text("UPDATE schema_meta SET value = '5' WHERE key = 'schema_version'"))
+
+    assert migrations.migrate(engine) == migrations.LATEST_VERSION
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM licenses WHERE license_key_hash IS NULL")).scalar() == 0
+        unique = {row[1]: row[2] for row in conn.execute(text("PRAGMA index_list(licenses)"))}
+    assert unique["ix_licenses_license_key_hash"] == 0
+
+
+def test_concurrent_workers_migrate_fresh_database_once(tmp_path):
+    db_file = tmp_path / "race.db"
+    code = (
+        "import sys; from sqlalchemy import create_engine; from channel_license import migrations; "
+        "print(migrations.migrate(create_engine('sqlite:///' + sys.argv[1])))"
+    )
+    procs = [
+        subprocess.Popen([sys.executable, "-c", code, str(db_file)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        for _ in range(4)
+    ]
+    results = [p.communicate(timeout=60) for p in procs]
+    assert [p.returncode for p in procs] == [0] * 4, [err for _, err in results]
+
+    import channel_license
+
+    assert {out.strip() for out, _ in results} == {str(channel_license.migrations.LATEST_VERSION)}
@@ -0,0 +1,103 @@
+import importlib
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+
+def setup_db(tmp_path: Path):
+    """将 license.database 的 DATABASE_FILE_PATH 指向临时文件并初始化数据库。"""
+    import channel_license
+
+    db_file = tmp_path / "test_license.db"
+    channel_license.config.DATABASE_FILE_PATH = str(db_file)
+    importlib.reload(channel_license.database)
+    channel_license.database.init_db()
+    return channel_license
+
+
+@pytest.fixture
+def license_pkg(tmp_path):
+    pkg = setup_db(tmp_path)
+    pkg.shared_index.open_index(str(tmp_path / "active.idx"), capacity=1024)
+    yield pkg
+    pkg.shared_index.close_index()
+
+
+def test_repeat_requests_served_from_shared_index(license_pkg, tmp_path, monkeypatch):
+    api = license_pkg.api
+    with license_pkg.database.get_db_session() as db:
+        api.add_channel(db, name="idx", max_devices=10)
+
+    first = api.request_license("dev-idx", "idx", "1.1.1.1")["license"]
+    index = license_pkg.shared_index.index
+    assert index.lookup("dev-idx").license_id == first["id"]
+
+    # 命中索引时不打开任何数据库会话，返回内容与数据库路径一致
+    def _no_db():
+        raise AssertionError("database session opened for an indexed device")
+
+    with monkeypatch.context() as m:
+        m.setattr(license_pkg.database, "SessionLocal", _no_db)
+        again = api.request_license("dev-idx", "idx", "2.2.2.2")["license"]
+    assert again == first
+    assert index.stats()["hits"] == 1
+
+    # 另一个进程映射同一文件即可读到记录
+    code = (
+        "import sys; from channel_license import shared_index as s; "
+        "e = s.SharedLicenseIndex(sys.argv[1], capacity=1024).lookup('dev-idx'); print(e.license_id, e.license_key)"
+    )
+    out = subprocess.run([sys.executable, "-c", code, str(tmp_path / "active.idx")], capture_output=True, text=True, check=True)
+    assert out.stdout.split() == [str(first["id"]), first["license_key"]]
+
+    # 吊销后记录成为栅栏，下一次请求回到数据库并签发新许可证
+    with license_pkg.database.get_db_session() as db:
+        assert api.edit_license_status(db, first["id"], "revoked")["success"] is True
+    assert index.reusable("dev-idx") is None
+    renewed = api.request_license("dev-idx", "idx", "1.1.1.1")["license"]
+    assert renewed["id"] > first["id"]
+    assert index.reusable("dev-idx").license_id == renewed["id"]
+
+    # 迟到的旧事件不会覆盖较新的记录
+    assert index.store("dev-idx", {**index.lookup("dev-idx").event_data("dev-idx"), "license_id": first["id"]}) is False
+
+    with license_pkg.database.get_db_session() as db:
+        assert api.delete_device(db, device_id_str="dev-idx", force=True)["success"] is True
+    assert index.lookup("dev-idx").state == license_pkg.shared_index.STATE_FENCE
+    assert index.lookup("dev-idx").license_id == renewed["id"]
+
+
+def test_channel_renewal_window_change_updates_index(license_pkg):
+    api = license_pkg.api
+    with license_pkg.database.get_db_session() as db:
+        ch = api.add_channel(db, name="win", max_devices=10, license_duration_days=1)["channel"]
+
+    api.request_license("dev-win", "win", "1.1.1.1")
+    index = license_pkg.shared_index.index
+    assert index.reusable("dev-win") is not None
+
+    # 不涉及提前续期窗口的修改不扫描索引
+    scans = []
+    original_update_channel = index.update_channel
+    index.update_channel = lambda *args: scans.append(args) or original_update_channel(*args)
+    with license_pkg.database.get_db_session() as db:
+        assert api.edit_channel(db, ch["id"], max_devices=20)["success"] is True
+    assert scans == []
+    assert index.reusable("dev-win") is not None
+
+    # 有效期延长、续期窗口覆盖旧许可证的剩余时间后，索引不再复用该许可证
+    with license_pkg.database.get_db_session() as db:
+        assert api.edit_channel(db, ch["id"], license_duration_days=30, early_renewal_seconds=2 * 86400)["success"] is True
+    assert index.reusable("dev-win") is None
+    assert scans == [(ch["id"], 2 * 86400)]
+
+
+def test_index_file_settings_must_match(tmp_path):
+    import channel_license
+
+    path = str(tmp_path / "other.idx")
+    channel_license.shared_index.SharedLicenseIndex(path, capacity=64).close()
+    with pytest.raises(ValueError):
+        channel_license.shared_index.SharedLicenseIndex(path, capacity=128)